@@ -1,23 +1,33 @@
 '''Main application file'''
 from datetime import datetime, timedelta
-from flask import Flask, request, jsonify
+import atexit
+import io
+import json
+from flask import Flask, Response, request, jsonify
+from loguru import logger
 import dash
 import dash_bootstrap_components as dbc
 from dash import ctx, dcc, html
 from dash_bootstrap_templates import load_figure_template
 from dash.dependencies import Input, Output, State
-from loguru import logger
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import requests
 import tzlocal
 
 #layouts
+from happiness.tasks.bulktasks import MIMETYPES
+from happiness.tasks.duescheduler import DueScheduler
 from happiness.tasks.reportshelper import ReportsHelper
-from happiness.tasks.model import db
-from happiness.tasks.task import TaskWrapper
-from happiness.tasks.taskrepository import TaskRepository
+from happiness.tasks.migrations import migrate
+from happiness.tasks.model import db, enable_concurrent_access
+from happiness.tasks.recurrence import TaskRecurrences
+from happiness.tasks.rollups import ReportRollups
+from happiness.tasks.taskpage import TaskPage
+from happiness.tasks.taskrepository import TRAINED_MODEL_FILE, TaskRepository
+from happiness.tasks.taskservice import TaskService
+from happiness.tasks.training import save_model, train
+from happiness.tasks.writebehind import WriteBehindQueue
 from happiness.ui.add_task_tab import add_task_layout
 from happiness.ui.reports_tab import reports_layout
 from happiness.ui.reschedule_tasks import reschedule_tasks_layout
@@ -30,128 +40,137 @@ server = Flask(__name__)
 server.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///tasks.db'
 server.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 server.config['SQLALCHEMY_ECHO'] = True
+server.config['REPORT_ENGINE'] = 'rollup' # one of pandas, sql, rollup
+server.config['RECOMMENDER'] = 'epsilon-greedy' # one of random, epsilon-greedy, thompson
+server.config['RETRAIN_ON_START_DAY'] = True
+server.config['POOL_SLATES'] = False # opt in to rank arms per context off the request path
+server.config['AUTO_RESCHEDULE'] = True # reschedule due repeatable tasks in the background
 db.init_app(server)
 
+# db.session is scoped to the app context, so every request gets its own session and
+# the shared state below is safe to use from threaded or multi-process servers
 with server.app_context():
+    enable_concurrent_access(db.engine)
     db.create_all()
+    migrate(db.engine)
+    writer = WriteBehindQueue(db.engine)
+atexit.register(writer.close) # apply queued bookkeeping writes on shutdown
+
 
-repository = TaskRepository(db.session)
-helper = ReportsHelper(db.session)
-#TODO: URL is hardcoded, should be in a config file
-SERVER_URL = 'http://127.0.0.1:8050'
+def reschedule_due_tasks(task_ids):
+    '''Due scheduler callback, runs on its thread in an app context of its own'''
+    logger.info(f'Tasks {task_ids} are due')
+    with server.app_context():
+        logger.info(service.auto_reschedule()['message'])
+
+
+scheduler = DueScheduler(reschedule_due_tasks) if server.config['AUTO_RESCHEDULE'] else None
+repository = TaskRepository(db.session, writer, server.config['RECOMMENDER'],
+                            server.config['RETRAIN_ON_START_DAY'], server.config['POOL_SLATES'],
+                            scheduler)
+helper = ReportsHelper(db.session, server.config['REPORT_ENGINE'])
+service = TaskService(repository, helper)
+if scheduler is not None:
+    with server.app_context():
+        scheduler.load(repository.get_scheduled_tasks()) # past dates fire right away
+    atexit.register(scheduler.close)
 
 
 @server.route('/add_task', methods=['POST'])
 def add_task():
     '''Add a new task'''
-    data = request.json
-    logger.info(f'add_task invoked with {data}')
-    task = TaskWrapper.from_dict(data)
-    task_name = data['name']
-    repository.add_task(task)
-    return jsonify({'message': f'Task "{task_name}" added successfully!'})
+    return jsonify(service.add_task(request.json))
+
+
+@server.route('/import_tasks', methods=['POST'])
+def import_tasks():
+    '''Bulk import tasks from an NDJSON (default) or CSV body, ?format=csv'''
+    lines = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8')
+    try:
+        return jsonify(service.import_tasks(lines, request.args.get('format', 'ndjson')))
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+
+
+@server.route('/export/<table_name>', methods=['GET'])
+def export_table(table_name):
+    '''Stream tasks, worklogs or summaries as NDJSON (default) or CSV, ?format=csv'''
+    fmt = request.args.get('format', 'ndjson')
+    try:
+        chunks = service.export_table(table_name, fmt)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return Response(chunks, mimetype=MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename={table_name}.{fmt}'})
 
 
 @server.route('/get_tasks', methods=['GET'])
 def get_tasks():
-    '''Get all pending tasks'''
-    tasks = repository.get_tasks()
-    tasks_list = [
-        {
-            'task_id': task.get_id(),
-            'name': task.get_name(),
-            'complexity': task.get_complexity(),
-            'type': task.get_type(),
-            'priority': task.get_priority(),
-            'repeatable': task.is_repeatable(),
-            'status': task.get_status()
-        } for task in tasks
-    ]
-    logger.info(f'Returning get_tasks with {len(tasks)} tasks')
-    return jsonify({'tasks': tasks_list})
+    '''Get a page of pending tasks, query args as in TaskPage.from_args'''
+    try:
+        page = TaskPage.from_args(request.args)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return jsonify(service.get_tasks(page))
 
 
 @server.route('/get_resched_tasks', methods=['GET'])
 def get_reschedulable_tasks():
-    '''Get tasks that can be rescheduled'''
-    tasks = repository.get_reschedulable_tasks()
-    tasks_list = [
-        {
-            'task_id': task.get_id(),
-            'name': task.get_name(),
-            'complexity': task.get_complexity(),
-            'type': task.get_type(),
-            'priority': task.get_priority(),
-        } for task in tasks
-    ]
-    logger.info(f'Returning get_resched_tasks with {len(tasks)} tasks')
-    return jsonify({'tasks': tasks_list})
+    '''Get a page of tasks that can be rescheduled, query args as in TaskPage.from_args'''
+    try:
+        page = TaskPage.from_args(request.args)
+    except ValueError as err:
+        return jsonify({'message': str(err)}), 400
+    return jsonify(service.get_reschedulable_tasks(page))
 
 
 @server.route('/recommend_tasks', methods=['GET'])
 def recommend_tasks():
     '''Recommend tasks based on user's mood'''
     num_tasks = 5 #TODO: this is a bad place to control rec size
-    tasks = repository.recommend_tasks(num_tasks)
-    tasks_list = [
-        {
-            'task_id': task.get_id(),
-            'rec_id': task.get_rec_id(),
-            'name': task.get_name(),
-            'type': task.get_type(),
-            'priority': task.get_priority(),
-        } for task in tasks
-    ]
-    logger.debug(f'Recommended tasks: {tasks_list}')
-    return jsonify({'tasks': tasks_list})
+    return jsonify(service.recommend_tasks(num_tasks))
 
 
 @server.route('/transact_task', methods=['POST'])
 def transact_task():
     '''Start, stop or end a task'''
-    data = request.json
-    logger.info(f'transact_task called with {data}')
-    task_id = data['task_id']
-    rec_id = data['rec_id']
-    action = data['action']
-
-    message = 'Invalid request'
-
-    if action == 'start':
-        message = repository.start_task(task_id, rec_id)
-    elif action == 'stop':
-        message = repository.stop_task(task_id, rec_id)
-    elif action == 'end':
-        rating = data['rating']
-        message = repository.finish_task(task_id, rec_id, rating)
-
-    return jsonify({'message': message})
+    return jsonify(service.transact_task(request.json))
 
 
 @server.route('/reschedule_tasks', methods=['POST'])
 def reschedule_tasks():
     '''Reschedule selected tasks'''
-    data = request.json
-    logger.info(f'reschedule_tasks called with {data}')
-    task_ids = data['tasks']
-
-    message = repository.reschedule_tasks(task_ids=[int(task_id) for task_id in task_ids])
-    return jsonify({'message': message})
+    return jsonify(service.reschedule_tasks(request.json['tasks']))
 
 
 @server.route('/start_day', methods=['POST'])
 def start_day():
     '''Start day'''
-    repository.start_day()
-    message = repository.auto_reschedule()
-    return jsonify({'message': message})
+    return jsonify(service.start_day())
 
 
 @server.route('/end_day', methods=['POST'])
 def end_day():
     '''End day'''
-    repository.end_day()
-    return jsonify({})
+    return jsonify(service.end_day())
+
+
+@server.cli.command('backfill-rollups')
+def backfill_rollups():
+    '''Rebuild the daily report rollups from the raw work logs'''
+    ReportRollups(db.session).backfill()
+
+
+@server.cli.command('backfill-recurrences')
+def backfill_recurrences():
+    '''Rebuild the recurrence statistics of tasks from the task summaries'''
+    TaskRecurrences(db.session).backfill()
+
+
+@server.cli.command('train-model')
+def train_model():
+    '''Retrain the recommender model from the recommendation history'''
+    save_model(train(db.engine).to_model(), TRAINED_MODEL_FILE)
 
 
 # Dash setup
@@ -196,30 +215,71 @@ def update_output(n_clicks, name, complexity, task_type, priority, repeatable):
             'priority': priority,
             'repeatable': bool(repeatable)
         }
-        response = requests.post(f'{SERVER_URL}/add_task', json=task, timeout=5)
-        return response.json()['message']
+        return service.add_task(task)['message']
+
+def load_table_page(get_page, page_current, page_size, sort_by, filter_query, cursors):
+    '''Load one page of a custom paged task table
+
+    cursors keeps the cursor of every page reached under the current sort and
+    filter, so paging back and forth seeks into the index. Pages jumped to
+    without a cursor are read with an offset. A new sort or filter drops the
+    cursors and goes back to the first page.
+    '''
+    key = json.dumps([sort_by, filter_query])
+    if not cursors or cursors['key'] != key:
+        cursors = {'key': key, 'pages': {}}
+        page_current = 0
+    try:
+        page = TaskPage.from_table(page_current, page_size, sort_by, filter_query,
+                                   cursors['pages'].get(str(page_current)))
+    except ValueError as err:
+        logger.warning(f'Invalid task table page: {err}')
+        return [], 1, 0, [], cursors
+    result = get_page(page)
+    if result['next_cursor']:
+        cursors['pages'][str(page_current + 1)] = result['next_cursor']
+    page_count = page_current + 2 if result['next_cursor'] else page_current + 1
+    return result['tasks'], page_count, page_current, [], cursors
 
 @app.callback(
     Output('tasks-table', 'data'),
-    Input('tabs', 'value')
+    Output('tasks-table', 'page_count'),
+    Output('tasks-table', 'page_current'),
+    Output('tasks-table', 'selected_rows'),
+    Output('tasks-table-cursors', 'data'),
+    Input('tabs', 'value'),
+    Input('tasks-table', 'page_current'),
+    Input('tasks-table', 'page_size'),
+    Input('tasks-table', 'sort_by'),
+    Input('tasks-table', 'filter_query'),
+    State('tasks-table-cursors', 'data')
 )
-def load_tasks(tab):
-    '''Load tasks into the table'''
+def load_tasks(tab, page_current, page_size, sort_by, filter_query, cursors):
+    '''Load a page of tasks into the table'''
     if tab == 'view-tasks':
-        tasks_response = requests.get(f'{SERVER_URL}/get_tasks', timeout=5)
-        return tasks_response.json()['tasks']
-    return []
+        return load_table_page(service.get_tasks, page_current, page_size, sort_by,
+                               filter_query, cursors)
+    return [], 1, 0, [], None
 
 @app.callback(
     Output('reschedule-tasks-table', 'data'),
-    Input('tabs', 'value')
+    Output('reschedule-tasks-table', 'page_count'),
+    Output('reschedule-tasks-table', 'page_current'),
+    Output('reschedule-tasks-table', 'selected_rows'),
+    Output('reschedule-tasks-table-cursors', 'data'),
+    Input('tabs', 'value'),
+    Input('reschedule-tasks-table', 'page_current'),
+    Input('reschedule-tasks-table', 'page_size'),
+    Input('reschedule-tasks-table', 'sort_by'),
+    Input('reschedule-tasks-table', 'filter_query'),
+    State('reschedule-tasks-table-cursors', 'data')
 )
-def load_resched_tasks(tab):
-    '''Load tasks into the table'''
+def load_resched_tasks(tab, page_current, page_size, sort_by, filter_query, cursors):
+    '''Load a page of tasks into the table'''
     if tab == 'resched-tasks':
-        tasks_response = requests.get(f'{SERVER_URL}/get_resched_tasks', timeout=5)
-        return tasks_response.json()['tasks']
-    return []
+        return load_table_page(service.get_reschedulable_tasks, page_current, page_size,
+                               sort_by, filter_query, cursors)
+    return [], 1, 0, [], None
 
 @app.callback(
     Output('recommended-tasks-table', 'data'),
@@ -229,8 +289,7 @@ def load_resched_tasks(tab):
 def load_recommended_tasks(tab, n_clicks):
     '''Load recommended tasks into the table'''
     if tab == 'workflow' or (n_clicks and n_clicks > 0):
-        tasks_response = requests.get(f'{SERVER_URL}/recommend_tasks', timeout=5)
-        return tasks_response.json()['tasks']
+        return service.recommend_tasks()['tasks']
     return []
 
 @app.callback(
@@ -268,8 +327,7 @@ def manage_workflow(start_clicks, stop_clicks, selected_rows, tasks):
     action = ctx.triggered_id.split('-')[0]
 
     data['action'] = action
-    response = requests.post(f'{SERVER_URL}/transact_task', json=data, timeout=5)
-    return response.json()['message']
+    return service.transact_task(data)['message']
 
 @app.callback(
     Output('workflow-output', 'children', allow_duplicate=True),
@@ -290,8 +348,7 @@ def submit_rating(n_clicks, selected_rows, tasks, rating):
     rec_id = selected_task['rec_id']
     data = {'task_id': task_id, 'rec_id': rec_id, 'action': 'end', 'rating': rating}
 
-    response = requests.post(f'{SERVER_URL}/transact_task', json=data, timeout=5)
-    return response.json()['message'], False
+    return service.transact_task(data)['message'], False
 
 @app.callback(
     Output('viewtasks-output', 'children'),
@@ -315,8 +372,7 @@ def manage_view_tasks(view_stop_clicks, view_end_clicks, selected_rows, tasks):
     data['action'] = ctx.triggered_id.split('-')[0]
     data['rating'] = 5 # TODO: get rating from user
 
-    response = requests.post(f'{SERVER_URL}/transact_task', json=data, timeout=5)
-    return response.json()['message']
+    return service.transact_task(data)['message']
 
 @app.callback(
     Output('resched-output', 'children'),
@@ -333,9 +389,7 @@ def manage_reschedule_tasks(regen_clicks, selected_rows, tasks):
         return 'Invalid action'
 
     task_ids = [tasks[idx]['task_id'] for idx in selected_rows]
-    data = {'tasks' : task_ids}
-    response = requests.post(f'{SERVER_URL}/reschedule_tasks', json=data, timeout=5)
-    return response.json()['message']
+    return service.reschedule_tasks(task_ids)['message']
 
 @app.callback(
     Output('tasks-table-row', 'style'),
@@ -349,12 +403,11 @@ def manage_reschedule_tasks(regen_clicks, selected_rows, tasks):
 def toggle_day(n_clicks):
     '''Toggle the day start/end and show/hide buttons'''
     if n_clicks % 2 == 1:
-        response = requests.post(f'{SERVER_URL}/start_day', timeout=5)
-        rescheduled_tasks = response.json().get('message', '')
+        rescheduled_tasks = service.start_day().get('message', '')
         toast_message = 'No tasks were rescheduled.' if not rescheduled_tasks else rescheduled_tasks
         return {'display': 'flex'}, {'display': 'flex'}, 'End Day', True, toast_message
     else:
-        requests.post(f'{SERVER_URL}/end_day', timeout=5)
+        service.end_day()
         return {'display': 'none'}, {'display': 'none'}, 'Start Day', False, ''
 
 @app.callback(
@@ -369,7 +422,7 @@ def update_worklog_summary_chart(selected_week):
     start_date =  datetime.strptime(selected_week, '%Y-%m-%d').replace(
         tzinfo=tzlocal.get_localzone())
     end_date = start_date + timedelta(days=7)
-    summary = repository.get_worklog_summary(start_date, end_date)
+    summary = helper.get_worklog_summary(start_date, end_date)
     data = [(date, task_type, hours) for (date, task_type), hours in summary.items()]
     df = pd.DataFrame(data, columns=['date', 'type', 'hours_worked'])
     fig = px.bar(df, x='date', y='hours_worked',
@@ -388,12 +441,8 @@ def update_task_completion_heatmap(selected_week):
     start_date =  datetime.strptime(selected_week, '%Y-%m-%d').replace(
         tzinfo=tzlocal.get_localzone())
     end_date = start_date + timedelta(days=7)
-    data_list = repository.get_task_completion_summary(start_date, end_date)
-    df = pd.DataFrame(data_list)
-
-    # Count occurrences
-    heatmap_df = df.value_counts().reset_index()
-    heatmap_df.columns = ["day_of_week", "hour_of_day", "task_count"]
+    data_list = helper.get_task_completion_summary(start_date, end_date)
+    heatmap_df = pd.DataFrame(data_list, columns=["day_of_week", "hour_of_day", "task_count"])
 
     # Map weekday numbers to labels
     weekday_labels = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
@@ -441,7 +490,7 @@ def update_worklog_grouped_output(selected_week):
     end_date = start_date + timedelta(days=7)
 
     # get data
-    data = repository.get_worklog_splits(start_date, end_date)
+    data = helper.get_worklog_splits(start_date, end_date)
 
     # Convert query result to DataFrame
     df = pd.DataFrame(data, columns=["priority", "complexity", "total_time"])
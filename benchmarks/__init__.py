@@ -0,0 +1,8 @@
+'''Standalone performance benchmarks, run as python -m benchmarks.<name>'''
+import sys
+
+from loguru import logger
+
+# keep per-request debug logging out of the timings
+logger.remove()
+logger.add(sys.stderr, level='WARNING')
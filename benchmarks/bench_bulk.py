@@ -0,0 +1,120 @@
+'''Benchmark streaming bulk task import and export
+
+Imports generated NDJSON and CSV task files through bulktasks.import_tasks
+and compares the rate with committing one ORM task per call, as /add_task
+does. Exports tasks, work logs and summaries of a synthetic db. Reports rows
+per second and the peak traced memory of every run.
+
+Usage: python -m benchmarks.bench_bulk [--rows 100000] [--per-task-rows 2000]
+'''
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+
+from benchmarks.synthetic import COMPLEXITIES, PRIORITIES, TYPES, create_db
+from happiness.tasks.bulktasks import EXPORT_TABLES, FORMATTERS, export_table, import_tasks
+from happiness.tasks.migrations import migrate
+from happiness.tasks.model import Task, db
+
+
+def _task_records(num_rows: int, seed: int = 42) -> list:
+    '''Random valid task records'''
+    rng = random.Random(seed)
+    return [{'name': f'task {idx}', 'complexity': rng.choice(COMPLEXITIES),
+             'type': rng.choice(TYPES), 'priority': rng.choice(PRIORITIES),
+             'repeatable': rng.random() < 0.3} for idx in range(num_rows)]
+
+
+def _write_files(tmp_dir: str, num_rows: int) -> dict:
+    '''Write the records as NDJSON and CSV files, returns the path per format'''
+    records = _task_records(num_rows)
+    paths = {fmt: os.path.join(tmp_dir, f'tasks.{fmt}') for fmt in FORMATTERS}
+    with open(paths['ndjson'], 'w', encoding='utf-8') as f:
+        f.writelines(json.dumps(record) + '\n' for record in records)
+    with open(paths['csv'], 'w', encoding='utf-8') as f:
+        f.write(','.join(records[0]) + '\n')
+        f.writelines(','.join(str(value) for value in record.values()) + '\n'
+                     for record in records)
+    return paths
+
+
+def _fresh_engine(path: str):
+    '''Engine of an empty, migrated task db'''
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+    migrate(engine)
+    return engine
+
+
+def _measure(func) -> tuple:
+    '''(rows, seconds, peak MB) of func, timed untraced, then traced in a second run'''
+    start = time.perf_counter()
+    num_rows = func()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return num_rows, seconds, peak / 2**20
+
+
+def _print_row(name: str, num_rows: int, seconds: float, peak_mb: float) -> None:
+    '''Print one result line'''
+    print(f'{name:<24} {num_rows:>9} {seconds:>9.3f} {num_rows / seconds:>12.0f} {peak_mb:>8.1f}')
+
+
+def run(args) -> None:
+    '''Run the import and export benchmarks'''
+    print(f'{"run":<24} {"rows":>9} {"seconds":>9} {"rows/s":>12} {"peak MB":>8}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = _fresh_engine(os.path.join(tmp_dir, 'per-task.db'))
+        records = _task_records(args.per_task_rows)
+
+        def add_per_task():
+            with Session(engine) as session:
+                for record in records:
+                    session.add(Task(**record))
+                    session.commit()
+            return len(records)
+        _print_row('import per-task orm', *_measure(add_per_task))
+        engine.dispose()
+
+        paths = _write_files(tmp_dir, args.rows)
+        for fmt, path in paths.items():
+            engine = _fresh_engine(os.path.join(tmp_dir, f'import-{fmt}.db'))
+
+            def bulk_import(fmt=fmt, path=path, engine=engine):
+                with open(path, encoding='utf-8') as f:
+                    return import_tasks(engine, f, fmt, args.batch_size).imported
+            _print_row(f'import {fmt}', *_measure(bulk_import))
+            engine.dispose()
+
+        engine = create_db(os.path.join(tmp_dir, 'export.db'), args.rows)
+        for table_name in EXPORT_TABLES:
+            for fmt in FORMATTERS:
+                def bulk_export(table_name=table_name, fmt=fmt):
+                    num_lines = 0
+                    with open(os.devnull, 'w', encoding='utf-8') as out:
+                        for chunk in export_table(engine, table_name, fmt, args.batch_size):
+                            out.write(chunk)
+                            num_lines += chunk.count('\n')
+                    return num_lines
+                _print_row(f'export {table_name} {fmt}', *_measure(bulk_export))
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=100_000,
+                        help='imported tasks and exported work logs')
+    parser.add_argument('--per-task-rows', type=int, default=2_000)
+    parser.add_argument('--batch-size', type=int, default=5_000)
+    run(parser.parse_args())
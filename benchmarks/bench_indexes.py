@@ -0,0 +1,79 @@
+'''Benchmark the hot TaskRepository predicates with and without indexes
+
+Usage: python -m benchmarks.bench_indexes [--sizes 10000 100000 1000000]
+'''
+from datetime import timedelta
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import text
+
+from benchmarks.synthetic import BASE_DATE, create_db, drop_indexes
+from happiness.tasks.migrations import migrate
+
+WEEK_START = (BASE_DATE - timedelta(days=30)).strftime('%Y-%m-%d %H:%M:%S')
+WEEK_END = (BASE_DATE - timedelta(days=23)).strftime('%Y-%m-%d %H:%M:%S')
+
+QUERIES = {
+    'task(status)': (
+        "SELECT count(*) FROM task WHERE status = 'in_progress'", {}),
+    'task(repeatable, status)': (
+        "SELECT id FROM task WHERE repeatable = 1 AND status = 'done'", {}),
+    'task(next_scheduled, repeatable)': (
+        'SELECT id FROM task WHERE next_scheduled = :dt AND repeatable = 1',
+        {'dt': BASE_DATE.date().isoformat()}),
+    'work_log(task_id, rec_id, end_ts)': (
+        'SELECT id FROM work_log WHERE task_id = :task_id AND rec_id = :rec_id '
+        'AND end_ts IS NULL ORDER BY start_ts DESC LIMIT 1', {'task_id': 7, 'rec_id': 1000}),
+    'work_log(start_ts, end_ts)': (
+        'SELECT id, task_id FROM work_log WHERE start_ts >= :start AND end_ts < :end',
+        {'start': WEEK_START, 'end': WEEK_END}),
+    'task_summary(task_id, has_ended)': (
+        'SELECT id FROM task_summary WHERE task_id = :task_id AND has_ended = 0 LIMIT 1',
+        {'task_id': 7}),
+    'task_summary(has_ended, end_date)': (
+        'SELECT end_date FROM task_summary WHERE has_ended = 1 '
+        'AND end_date >= :start AND end_date < :end',
+        {'start': WEEK_START, 'end': WEEK_END}),
+}
+
+
+def _time_queries(engine, repeat: int) -> dict:
+    '''Run each query repeat times, returns best time in ms'''
+    timings = {}
+    with engine.connect() as conn:
+        for name, (query, params) in QUERIES.items():
+            best = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                conn.execute(text(query), params).all()
+                best = min(best, time.perf_counter() - start)
+            timings[name] = best * 1000
+    return timings
+
+
+def run(sizes: list, repeat: int) -> None:
+    '''Run the benchmark for every size'''
+    print(f'{"rows":>9} {"query":<36} {"no index ms":>12} {"indexed ms":>12} {"speedup":>8}')
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_db(os.path.join(tmp_dir, 'bench.db'), size)
+            drop_indexes(engine)
+            before = _time_queries(engine, repeat)
+            migrate(engine)
+            after = _time_queries(engine, repeat)
+            engine.dispose()
+        for name in QUERIES:
+            speedup = before[name] / after[name] if after[name] else float('inf')
+            print(f'{size:>9} {name:<36} {before[name]:>12.3f} {after[name]:>12.3f} '
+                  f'{speedup:>7.1f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,99 @@
+'''Benchmark recommendation inserts per save_recommendations call
+
+Compares the ORM add_all path, which flushes and reads each id back, with a
+single insert().returning() and with the executemany of ids handed out from
+reserved counter blocks that TaskRepository uses.
+
+Usage: python -m benchmarks.bench_recommendations [--recs 5 50 500]
+'''
+from datetime import datetime, timezone
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import insert, select, text
+from sqlalchemy.orm import Session
+
+from benchmarks.synthetic import create_db
+from happiness.tasks.counters import RECOMMENDATION_IDS, IdBlocks
+from happiness.tasks.migrations import migrate
+from happiness.tasks.model import Recommendation
+from happiness.tasks.task import TASK_VIEW_COLUMNS, TaskView
+from happiness.tasks.taskrepository import REC_ID_BLOCK, insert_recommendations
+
+
+def save_orm(session: Session, tasks: list) -> list:
+    '''add_all, then read every generated id back from the instances'''
+    curr_ts = datetime.now(timezone.utc)
+    recommendations = [Recommendation(task_id=task.get_id(), rec_ts=curr_ts) for task in tasks]
+    session.add_all(recommendations)
+    session.commit()
+    return [recommendation.id for recommendation in recommendations]
+
+
+def save_returning(session: Session, tasks: list) -> list:
+    '''One executemany insert returning the generated ids in parameter order'''
+    curr_ts = datetime.now(timezone.utc)
+    rows = [{'task_id': task.get_id(), 'rec_ts': curr_ts} for task in tasks]
+    rec_ids = session.connection().execute(
+        insert(Recommendation.__table__).returning(
+            Recommendation.id, sort_by_parameter_order=True), rows).scalars().all()
+    session.commit()
+    return rec_ids
+
+
+class PreallocatedSaver:
+    '''Hand out ids from reserved counter blocks, then insert them with one executemany'''
+    def __init__(self):
+        '''Initialize saver, the first call reserves an id block'''
+        self._rec_ids = None
+
+    def __call__(self, session: Session, tasks: list) -> list:
+        '''Save recommendations of the given tasks, returns their ids'''
+        if self._rec_ids is None:
+            # the other strategies insert without the id sequence, catch it up with their rows
+            session.execute(text('UPDATE counter SET value = (SELECT MAX(id) FROM recommendation)'
+                                 ' WHERE name = :name'), {'name': RECOMMENDATION_IDS})
+            self._rec_ids = IdBlocks(RECOMMENDATION_IDS, REC_ID_BLOCK)
+        rec_ids = self._rec_ids.allocate(session, len(tasks))
+        curr_ts = datetime.now(timezone.utc)
+        rows = [{'id': rec_id, 'task_id': task.get_id(), 'rec_ts': curr_ts}
+                for task, rec_id in zip(tasks, rec_ids)]
+        insert_recommendations(session.connection(), [rows])
+        session.commit()
+        return rec_ids
+
+
+def run(rec_sizes: list, calls: int, num_worklogs: int) -> None:
+    '''Run the benchmark for every number of recommendations per call'''
+    print(f'{"recs/call":>9} {"strategy":<12} {"ms/call":>10} {"recs/s":>12}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_db(os.path.join(tmp_dir, 'bench.db'), num_worklogs)
+        migrate(engine)
+        with Session(engine) as session:
+            rows = session.execute(select(*TASK_VIEW_COLUMNS)).all()
+            for num_recs in rec_sizes:
+                strategies = {'orm_add_all': save_orm, 'returning': save_returning,
+                              'preallocated': PreallocatedSaver()}
+                for name, save in strategies.items():
+                    start = time.perf_counter()
+                    for call in range(calls):
+                        offset = call * num_recs % len(rows)
+                        tasks = [TaskView(rows[(offset + idx) % len(rows)])
+                                 for idx in range(num_recs)]
+                        rec_ids = save(session, tasks)
+                        assert len(rec_ids) == num_recs and all(rec_ids), name
+                    elapsed = time.perf_counter() - start
+                    print(f'{num_recs:>9} {name:<12} {elapsed / calls * 1000:>10.3f} '
+                          f'{num_recs * calls / elapsed:>12.0f}')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--recs', type=int, nargs='+', default=[5, 50, 500])
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--worklogs', type=int, default=10_000)
+    args = parser.parse_args()
+    run(args.recs, args.calls, args.worklogs)
@@ -0,0 +1,124 @@
+'''Replay benchmark of the task recommenders
+
+Replays logged slates through every recommender and reports the replay
+click-through, p50/p99 recommend latency and peak traced memory. Synthetic
+backlogs are generated per size, or a real task db can be replayed instead.
+Threshold flags make the run exit non-zero, so changes can be gated on it.
+
+Without a trained model epsilon-greedy only explores and replays like random.
+So unless --model is given, the bandits start from a model trained on the
+leading --train-fraction of the slates and only the rest are replayed.
+
+Usage: python -m benchmarks.bench_recommenders [--tasks 1000 100000 1000000]
+       python -m benchmarks.bench_recommenders --db instance/tasks.db --model models/eps-cmab.pkl
+'''
+import argparse
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+from loguru import logger
+from sqlalchemy import create_engine
+import numpy as np
+
+from benchmarks.replay import ReplayClock, load_arm_index, load_slates, replay, train_model
+from benchmarks.synthetic import create_replay_db
+from happiness.tasks.mabrecommender import MABRecommender
+from happiness.tasks.randomrecommender import RandomRecommender
+from happiness.tasks.thompsonrecommender import ThompsonRecommender
+from happiness.tasks.training import save_model
+
+# Recommender factories given a fresh model store, an optional trained model and the clock
+RECOMMENDERS = {
+    'random': lambda store, model, clock: RandomRecommender(),
+    'epsilon-greedy': lambda store, model, clock: MABRecommender(
+        mdl_file=store, pkl_file=model, clock=clock),
+    'thompson': lambda store, model, clock: ThompsonRecommender(
+        mdl_file=store, pkl_file=model, clock=clock, seed=42),
+    'epsilon-greedy-pooled': lambda store, model, clock: MABRecommender(
+        mdl_file=store, pkl_file=model, clock=clock, pool_slates=True),
+    'thompson-pooled': lambda store, model, clock: ThompsonRecommender(
+        mdl_file=store, pkl_file=model, clock=clock, seed=42, pool_slates=True),
+}
+MEMORY_SLATES = 200
+
+
+def _peak_memory(engine, name: str, tmp_dir: str, model: str, slates: list) -> float:
+    '''Peak MB allocated while indexing the backlog and replaying a few slates'''
+    tracemalloc.start()
+    clock = ReplayClock()
+    recommender = RECOMMENDERS[name](os.path.join(tmp_dir, f'{name}-mem.db'), model, clock)
+    replay(recommender, load_arm_index(engine), slates[:MEMORY_SLATES], clock)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak / 2**20
+
+
+def run_db(engine, label: str, model: str, tmp_dir: str, args) -> bool:
+    '''Replay one db through all recommenders, returns False if a threshold failed'''
+    slates = load_slates(engine)
+    if model is None and args.train_fraction > 0:
+        split = int(len(slates) * args.train_fraction)
+        model = os.path.join(tmp_dir, 'trained.pkl')
+        save_model(train_model(slates[:split]), model)
+        slates = slates[split:]
+    elif model is None:
+        logger.warning('Replaying without a trained model, epsilon-greedy is random')
+    passed = True
+    for name in args.recommenders:
+        random.seed(42)
+        clock = ReplayClock()
+        recommender = RECOMMENDERS[name](os.path.join(tmp_dir, f'{name}.db'), model, clock)
+        arm_index = load_arm_index(engine)
+        result = replay(recommender, arm_index, slates, clock, args.num_tasks)
+        p50, p99 = np.percentile(result.latencies, [50, 99]) * 1000
+        peak_mb = _peak_memory(engine, name, tmp_dir, model, slates)
+        print(f'{label:>9} {name:<21} {result.num_slates:>7} {result.matched:>8} '
+              f'{result.get_ctr():>7.4f} {p50:>8.3f} {p99:>8.3f} {peak_mb:>8.1f}')
+        if args.max_p99_ms is not None and p99 > args.max_p99_ms:
+            print(f'{name}: p99 {p99:.3f} ms over {args.max_p99_ms} ms', file=sys.stderr)
+            passed = False
+        if args.min_ctr is not None and name != 'random' and result.get_ctr() < args.min_ctr:
+            print(f'{name}: ctr {result.get_ctr():.4f} under {args.min_ctr}', file=sys.stderr)
+            passed = False
+    return passed
+
+
+def run(args) -> bool:
+    '''Run the benchmark on the given db or on synthetic backlogs of every size'''
+    logger.disable('happiness') # per pull debug logs would dominate the latencies
+    print(f'{"tasks":>9} {"recommender":<21} {"slates":>7} {"matched":>8} {"ctr":>7} '
+          f'{"p50 ms":>8} {"p99 ms":>8} {"peak MB":>8}')
+    passed = True
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        if args.db:
+            engine = create_engine(f'sqlite:///{args.db}')
+            passed = run_db(engine, 'db', args.model, tmp_dir, args)
+            engine.dispose()
+            return passed
+        for size in args.tasks:
+            size_dir = os.path.join(tmp_dir, str(size)) # fresh model stores per size
+            os.makedirs(size_dir)
+            engine = create_replay_db(os.path.join(size_dir, 'replay.db'), size, args.slates)
+            passed &= run_db(engine, str(size), args.model, size_dir, args)
+            engine.dispose()
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tasks', type=int, nargs='+', default=[1_000, 100_000, 1_000_000])
+    parser.add_argument('--slates', type=int, default=5_000)
+    parser.add_argument('--db', help='replay a task db instead of synthetic backlogs')
+    parser.add_argument('--model', help='trained model pickle to start the bandits from')
+    parser.add_argument('--train-fraction', type=float, default=0.5,
+                        help='share of the slates to train on when no --model is given')
+    parser.add_argument('--num-tasks', type=int, default=5, help='recommendations per slate')
+    parser.add_argument('--recommenders', nargs='+', choices=list(RECOMMENDERS),
+                        default=list(RECOMMENDERS))
+    parser.add_argument('--max-p99-ms', type=float)
+    parser.add_argument('--min-ctr', type=float, help='minimum ctr of the learning recommenders')
+    sys.exit(0 if run(parser.parse_args()) else 1)
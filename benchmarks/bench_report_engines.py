@@ -0,0 +1,83 @@
+'''Benchmark the report aggregation engines against each other
+
+Every report is computed cold (fresh engine, empty dataset cache) for one
+week of a synthetic work log, and all engines must agree on the results.
+
+Usage: python -m benchmarks.bench_report_engines [--sizes 10000 100000 1000000]
+'''
+from datetime import timedelta
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy.orm import Session
+import numpy as np
+import pandas as pd
+import tzlocal
+
+from benchmarks.synthetic import BASE_DATE, create_db
+from happiness.tasks.migrations import migrate
+from happiness.tasks.reportshelper import REPORT_ENGINES
+
+REPORTS = ['get_worklog_summary', 'get_task_completion_summary', 'get_worklog_splits',
+           'get_focus_summary', 'get_completion_analysis']
+
+
+def _normalize(result) -> pd.DataFrame:
+    '''Comparable dataframe form of a report result'''
+    if isinstance(result, dict):
+        result = [(*key, value) for key, value in result.items()]
+    elif not isinstance(result, pd.DataFrame):
+        result = [tuple(row.values()) if isinstance(row, dict) else tuple(row) for row in result]
+    df = pd.DataFrame(result)
+    numeric = df.select_dtypes('number').columns
+    df = df.astype({col: float if col in numeric else str for col in df.columns})
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def _check_equal(name: str, results: dict) -> None:
+    '''Assert every engine produced the same report'''
+    expected_engine, expected = next(iter(results.items()))
+    for engine, result in results.items():
+        numeric = expected.select_dtypes('number').columns
+        same = expected.shape == result.shape and np.allclose(
+            expected[numeric], result[numeric], rtol=1e-6) and expected.drop(
+                columns=numeric).equals(result.drop(columns=numeric))
+        assert same, f'{name}: {engine} differs from {expected_engine}'
+
+
+def run(sizes: list, repeat: int) -> None:
+    '''Run the benchmark for every size'''
+    start_date = (BASE_DATE - timedelta(days=30)).replace(tzinfo=tzlocal.get_localzone())
+    end_date = start_date + timedelta(days=7)
+    print(f'{"rows":>9} {"report":<28} ' + ' '.join(f'{name + " ms":>12}'
+                                                     for name in REPORT_ENGINES))
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            engine = create_db(os.path.join(tmp_dir, 'bench.db'), size)
+            migrate(engine)
+            with Session(engine) as session:
+                for report in REPORTS:
+                    timings, results = {}, {}
+                    for name, engine_class in REPORT_ENGINES.items():
+                        best = float('inf')
+                        for _ in range(repeat):
+                            report_engine = engine_class(session)
+                            start = time.perf_counter()
+                            result = getattr(report_engine, report)(start_date, end_date)
+                            best = min(best, time.perf_counter() - start)
+                        timings[name] = best * 1000
+                        results[name] = _normalize(result)
+                    _check_equal(report, results)
+                    print(f'{size:>9} {report:<28} ' + ' '.join(f'{timings[name]:>12.2f}'
+                                                                for name in REPORT_ENGINES))
+            engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
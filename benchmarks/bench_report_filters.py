@@ -0,0 +1,81 @@
+'''Regression benchmark for the ReportsHelper time-range predicates
+
+Compares the legacy strftime('%s', ...) filters against the sargable
+native timestamp filters of PandasReportEngine over a large synthetic work
+log. Both sides select the same columns and fetch raw rows, so only the
+predicates differ.
+
+Usage: python -m benchmarks.bench_report_filters [--size 1000000]
+'''
+from datetime import timedelta, timezone
+import argparse
+import os
+import tempfile
+import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from benchmarks.synthetic import BASE_DATE, create_db
+from happiness.tasks.pandasreportengine import completions_query, worklogs_query
+
+LEGACY_QUERIES = {
+    'worklogs': '''
+        SELECT W.task_id, W.start_ts, W.end_ts, T.type, T.priority, T.complexity
+        FROM work_log W JOIN task T ON T.id = W.task_id
+        WHERE strftime('%s', W.start_ts) >= :start_ts AND strftime('%s', W.start_ts) < :end_ts
+        AND W.end_ts IS NOT NULL
+    ''',
+    'completions': '''
+        SELECT task_id, start_date, end_date FROM task_summary
+        WHERE strftime('%s', end_date) >= :start_ts AND strftime('%s', end_date) < :end_ts
+        AND has_ended = 1
+    ''',
+}
+
+
+def _best_of(func, repeat: int) -> tuple:
+    '''Best wall time in ms and the last result of calling func'''
+    best = float('inf')
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000, result
+
+
+def run(size: int, repeat: int) -> None:
+    '''Run the benchmark on a synthetic db of the given size'''
+    start_date = (BASE_DATE - timedelta(days=30)).replace(tzinfo=timezone.utc)
+    end_date = start_date + timedelta(days=7)
+    params = {'start_ts': str(int(start_date.timestamp())),
+              'end_ts': str(int(end_date.timestamp()))}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        engine = create_db(os.path.join(tmp_dir, 'bench.db'), size)
+        with Session(engine) as session:
+            current = {
+                'worklogs': worklogs_query(start_date, end_date),
+                'completions': completions_query(start_date, end_date),
+            }
+            print(f'{size} work log rows')
+            print(f'{"query":<15} {"rows":>6} {"strftime ms":>12} {"sargable ms":>12} '
+                  f'{"speedup":>8}')
+            for name, query in LEGACY_QUERIES.items():
+                legacy_ms, legacy_rows = _best_of(
+                    lambda q=query: session.execute(text(q), params).all(), repeat)
+                current_ms, current_rows = _best_of(
+                    lambda stmt=current[name]: session.execute(stmt).all(), repeat)
+                assert len(legacy_rows) == len(current_rows), f'{name} results differ'
+                print(f'{name:<15} {len(current_rows):>6} {legacy_ms:>12.2f} {current_ms:>12.2f} '
+                      f'{legacy_ms / current_ms:>7.1f}x')
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+    run(args.size, args.repeat)
@@ -0,0 +1,143 @@
+'''Offline replay evaluation of task recommenders
+
+Logged slates (the recommendation/work log join mab.ipynb trains on) are
+replayed in time order with rejection sampling. For every slate the
+recommender picks its own slate from an arm index of the backlog. Slates with
+no logged recommendation of an arm it also recommended are rejected: they
+neither count nor update the recommender. Of a matched slate only the matched
+recommendations are rewarded and counted. Their pick rate is the replay
+click-through, an unbiased estimate of the online one when the logged slates
+were random.
+'''
+from datetime import datetime, timezone
+from typing import Iterable, List, Set
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+import numpy as np
+
+from happiness.tasks.armindex import ArmIndex
+from happiness.tasks.mabrecommender import ContextEncoder
+from happiness.tasks.recommender import TaskRecommenderInterface
+from happiness.tasks.training import RewardTotals
+
+# A recommendation counts as picked when its work log lasted over a minute
+EVENTS_QUERY = '''
+    SELECT R.id AS rec_id, R.rec_ts, T.arm_code,
+    MAX(CASE
+        WHEN W.id IS NOT NULL
+            AND CAST((julianday(W.end_ts) - julianday(W.start_ts)) * 24 * 60 * 60
+                     AS INTEGER) > 60
+        THEN 1
+        ELSE 0
+    END) AS was_picked
+    FROM recommendation R
+    INNER JOIN task T ON T.id = R.task_id
+    LEFT JOIN work_log W ON R.id = W.rec_id
+    GROUP BY R.id, R.rec_ts, T.arm_code
+    ORDER BY R.rec_ts, R.id
+'''
+
+
+class Slate:
+    '''Recommendations logged together'''
+    __slots__ = ('ts', 'arms', 'picked_arms')
+
+    def __init__(self, ts: datetime):
+        '''Initialize an empty slate logged at ts'''
+        self.ts = ts
+        self.arms: List[int] = []
+        self.picked_arms: Set[int] = set()
+
+
+class ReplayClock:
+    '''Clock for recommenders that returns the time of the slate being replayed'''
+    def __init__(self):
+        '''Initialize clock'''
+        self.ts = datetime.now(timezone.utc)
+
+    def __call__(self) -> datetime:
+        '''Current replay time'''
+        return self.ts
+
+
+class ReplayResult:
+    '''Replay click-through and recommend latencies'''
+    def __init__(self):
+        '''Initialize empty result, num_slates counts the matched slates'''
+        self.num_slates = 0
+        self.matched = 0
+        self.clicks = 0
+        self.latencies: List[float] = []
+
+    def get_ctr(self) -> float:
+        '''Picks per matched recommendation'''
+        return self.clicks / self.matched if self.matched else 0.0
+
+
+def load_slates(engine: Engine) -> List[Slate]:
+    '''Load logged recommendations grouped into slates, recs of one slate share rec_ts'''
+    slates = []
+    with engine.connect() as conn:
+        for row in conn.execute(text(EVENTS_QUERY)):
+            if not slates or slates[-1].ts != row.rec_ts:
+                slates.append(Slate(row.rec_ts))
+            slates[-1].arms.append(row.arm_code)
+            if row.was_picked:
+                slates[-1].picked_arms.add(row.arm_code)
+    for slate in slates:
+        slate.ts = datetime.fromisoformat(str(slate.ts)).replace(tzinfo=timezone.utc)
+    return slates
+
+
+def load_arm_index(engine: Engine) -> ArmIndex:
+    '''Index every task of the db, the backlog at replay time is not logged'''
+    arm_index = ArmIndex()
+    with engine.connect() as conn:
+        arm_index.load(conn.execute(text('SELECT id, arm_code FROM task')))
+    return arm_index
+
+
+def train_model(slates: Iterable[Slate], ce: ContextEncoder = None) -> dict:
+    '''Train a model on logged slates, in the format MABRecommender imports'''
+    if ce is None:
+        ce = ContextEncoder(6, 22, 4)
+    hours, arms, rewards = [], [], []
+    for slate in slates:
+        hours.extend([slate.ts.hour] * len(slate.arms))
+        arms.extend(slate.arms)
+        rewards.extend(arm in slate.picked_arms for arm in slate.arms)
+    totals = RewardTotals(ce.get_num_intervals())
+    totals.add(ce.get_contexts(np.array(hours, dtype=np.int64)), np.array(arms, dtype=np.int64),
+               np.array(rewards, dtype=np.float64))
+    return totals.to_model()
+
+
+def replay(recommender: TaskRecommenderInterface, arm_index: ArmIndex,
+           slates: Iterable[Slate], clock: ReplayClock, num_tasks: int = 5) -> ReplayResult:
+    '''Replay slates through a recommender, feeding the matched recommendations back to it
+
+    The recommendations of a rejected slate were never shown, so its round is
+    closed without rewarding any of them.
+    '''
+    result = ReplayResult()
+    for slate in slates:
+        clock.ts = slate.ts
+        start = time.perf_counter()
+        task_ids = recommender.recommend_from_index(arm_index, num_tasks)
+        result.latencies.append(time.perf_counter() - start)
+
+        recommended = {arm_index.get_arm(task_id): task_id for task_id in task_ids}
+        # a logged slate can hold several tasks of one arm, each arm is shown once
+        matched = list(dict.fromkeys(arm for arm in slate.arms if arm in recommended))
+        if not matched:
+            recommender.update_shown_tasks([], None)
+            continue
+        picked = [arm for arm in matched if arm in slate.picked_arms]
+        result.num_slates += 1
+        result.matched += len(matched)
+        result.clicks += len(picked)
+        recommender.update_shown_tasks([recommended[arm] for arm in matched],
+                                       recommended[picked[0]] if picked else None)
+    return result
@@ -0,0 +1,141 @@
+'''Synthetic task db generator for benchmarks'''
+from datetime import datetime, timedelta
+import random
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Engine
+
+from happiness.tasks.armcode import get_arm_code
+from happiness.tasks.model import db
+
+COMPLEXITIES = ['simple', 'medium', 'hard']
+TYPES = ['chores', 'learning', 'constructive', 'creative']
+PRIORITIES = ['low', 'medium', 'high']
+STATUSES = ['pending', 'pending', 'done', 'in_progress']
+
+# worklogs are spread over this many days ending at BASE_DATE
+HISTORY_DAYS = 365
+BASE_DATE = datetime(2025, 1, 1)
+_TS_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+
+def create_db(path: str, num_worklogs: int, seed: int = 42) -> Engine:
+    '''Create a sqlite db at path with num_worklogs synthetic work logs'''
+    random.seed(seed)
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+
+    num_tasks = max(num_worklogs // 20, 10)
+    num_recs = num_worklogs
+    start = BASE_DATE - timedelta(days=HISTORY_DAYS)
+    span = HISTORY_DAYS * 24 * 3600
+
+    tasks = []
+    for task_id in range(1, num_tasks + 1):
+        attrs = {'complexity': random.choice(COMPLEXITIES), 'type': random.choice(TYPES),
+                 'priority': random.choice(PRIORITIES), 'repeatable': random.random() < 0.3}
+        tasks.append((
+            task_id, f'task {task_id}', *attrs.values(), random.choice(STATUSES),
+            (BASE_DATE + timedelta(days=random.randint(0, 30))).date().isoformat(),
+            get_arm_code(attrs)
+        ))
+
+    recs, worklogs, summaries = [], [], []
+    for idx in range(1, num_recs + 1):
+        task_id = random.randint(1, num_tasks)
+        start_ts = start + timedelta(seconds=random.randint(0, span))
+        end_ts = start_ts + timedelta(seconds=random.randint(60, 3 * 3600))
+        recs.append((idx, task_id, start_ts.strftime(_TS_FORMAT)))
+        worklogs.append((idx, task_id, idx, start_ts.strftime(_TS_FORMAT),
+                         end_ts.strftime(_TS_FORMAT)))
+        if idx % 5 == 0:
+            has_ended = random.random() < 0.9
+            summaries.append((
+                len(summaries) + 1, task_id, int((end_ts - start_ts).total_seconds()), 0,
+                start_ts.strftime(_TS_FORMAT),
+                end_ts.strftime(_TS_FORMAT) if has_ended else None,
+                random.randint(1, 5), has_ended
+            ))
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO task (id, name, complexity, type, priority, '
+                           'repeatable, status, next_scheduled, arm_code) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', tasks)
+        cursor.executemany('INSERT INTO recommendation (id, task_id, rec_ts) '
+                           'VALUES (?, ?, ?)', recs)
+        cursor.executemany('INSERT INTO work_log (id, task_id, rec_id, start_ts, end_ts) '
+                           'VALUES (?, ?, ?, ?, ?)', worklogs)
+        cursor.executemany('INSERT INTO task_summary (id, task_id, time_worked, num_restarts, '
+                           'start_date, end_date, rating, has_ended) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', summaries)
+        conn.commit()
+    finally:
+        conn.close()
+    return engine
+
+
+def create_replay_db(path: str, num_tasks: int, num_slates: int, slate_size: int = 5,
+                     seed: int = 42) -> Engine:
+    '''Create a sqlite db with a pending backlog and logged recommendation slates
+
+    Slates are drawn uniformly from the backlog, the unbiased logging policy
+    replay evaluation needs. The user picks at most one task per slate, each
+    with a hidden probability per arm and time of day, so a recommender that
+    learns those preferences gets a higher replay click-through.
+    '''
+    random.seed(seed)
+    engine = create_engine(f'sqlite:///{path}')
+    db.metadata.create_all(engine)
+
+    tasks, arms = [], []
+    for task_id in range(1, num_tasks + 1):
+        attrs = {'complexity': random.choice(COMPLEXITIES), 'type': random.choice(TYPES),
+                 'priority': random.choice(PRIORITIES), 'repeatable': random.random() < 0.3}
+        arms.append(get_arm_code(attrs))
+        tasks.append((task_id, f'task {task_id}', *attrs.values(), 'pending', arms[-1]))
+
+    preferences = {} # (hour bucket, arm) -> pick probability
+    start = BASE_DATE - timedelta(days=HISTORY_DAYS)
+    recs, worklogs = [], []
+    for slate in range(num_slates):
+        rec_ts = start + timedelta(days=slate * HISTORY_DAYS / num_slates,
+                                   hours=random.randint(6, 21), minutes=random.randint(0, 59))
+        slate_tasks = random.sample(range(1, num_tasks + 1), min(slate_size, num_tasks))
+        picked = None
+        for task_id in slate_tasks:
+            recs.append((len(recs) + 1, task_id, rec_ts.strftime(_TS_FORMAT)))
+            key = (rec_ts.hour // 6, arms[task_id - 1])
+            if key not in preferences:
+                preferences[key] = random.betavariate(1, 6)
+            if picked is None and random.random() < preferences[key]:
+                picked = task_id
+                end_ts = rec_ts + timedelta(minutes=random.randint(5, 90))
+                worklogs.append((len(worklogs) + 1, task_id, len(recs),
+                                 rec_ts.strftime(_TS_FORMAT), end_ts.strftime(_TS_FORMAT)))
+
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        cursor.executemany('INSERT INTO task (id, name, complexity, type, priority, '
+                           'repeatable, status, arm_code) VALUES (?, ?, ?, ?, ?, ?, ?, ?)', tasks)
+        cursor.executemany('INSERT INTO recommendation (id, task_id, rec_ts) '
+                           'VALUES (?, ?, ?)', recs)
+        cursor.executemany('INSERT INTO work_log (id, task_id, rec_id, start_ts, end_ts) '
+                           'VALUES (?, ?, ?, ?, ?)', worklogs)
+        conn.commit()
+    finally:
+        conn.close()
+    return engine
+
+
+def drop_indexes(engine: Engine) -> None:
+    '''Drop all declared indexes and reset the schema version'''
+    with engine.begin() as conn:
+        names = conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")).scalars()
+        for name in list(names):
+            conn.execute(text(f'DROP INDEX {name}'))
+        conn.execute(text('PRAGMA user_version = 0'))
+        conn.execute(text('ANALYZE'))
@@ -0,0 +1,46 @@
+'''Stable encoding of task attributes into bandit arm codes
+
+Arm codes key the q-values of trained models, so the lookups below must not
+change. Any change needs a new ARM_CODE_VERSION, a migration re-encoding the
+stored task.arm_code column and retrained models.
+'''
+from typing import Mapping
+
+ARM_CODE_VERSION = 1
+
+# Field order and value codes of version 1; values not listed here (including
+# missing ones) all map to one fixed "other" code per field, len(lookups)
+ARM_FIELD_LOOKUPS = {
+    'complexity': {'simple': 0, 'medium': 1, 'hard': 2},
+    'type': {'chores': 0, 'learning': 1, 'constructive': 2, 'creative': 3},
+    'priority': {'low': 0, 'medium': 1, 'high': 2},
+    'repeatable': {1: 0, 0: 1}
+}
+FIELD_BITS = 3
+# Arm codes are below this bound
+NUM_ARM_CODES = 1 << (FIELD_BITS * len(ARM_FIELD_LOOKUPS))
+
+
+class ArmEncoder:
+    '''Encodes task attributes into an arm code'''
+    def __init__(self):
+        '''Initialize encoder'''
+        self.version = ARM_CODE_VERSION
+        self.fields = list(ARM_FIELD_LOOKUPS)
+        self.field_lookups = ARM_FIELD_LOOKUPS
+
+    def get_hash(self, values: Mapping) -> int:
+        '''Get the arm code of a mapping of field -> value, e.g. a task row'''
+        value = 0
+        for field, lookups in self.field_lookups.items():
+            value = value << FIELD_BITS
+            value += lookups.get(values.get(field), len(lookups))
+        return value
+
+
+ENCODER = ArmEncoder()
+
+
+def get_arm_code(values: Mapping) -> int:
+    '''Get the arm code of a mapping of field -> value with the shared encoder'''
+    return ENCODER.get_hash(values)
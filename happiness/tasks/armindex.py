@@ -0,0 +1,113 @@
+'''In-memory index of open tasks by bandit arm'''
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import random
+import threading
+
+
+class ArmIndex:
+    '''Maps arm hash codes to the ids of tasks that are not done
+
+    Task ids are kept in per arm lists with a position lookup so adding,
+    removing and sampling a task are all O(1).
+    '''
+    def __init__(self):
+        '''Initialize an empty, unloaded index'''
+        self._arms: Dict[int, List[int]] = {}
+        self._positions: Dict[int, Tuple[int, int]] = {} # task id -> (arm, position)
+        self._lock = threading.RLock()
+        self._loaded = False
+        self._version = 0 # bumped whenever the set of arms changes
+
+    def is_loaded(self) -> bool:
+        '''Check if the index has been populated'''
+        return self._loaded
+
+    def get_version(self) -> int:
+        '''Counter of changes to the set of arms, equal versions mean equal arms'''
+        return self._version
+
+    def load(self, rows: Iterable[Tuple[int, int]]) -> None:
+        '''Replace the index contents with the given (task id, arm) rows'''
+        with self._lock:
+            self._arms.clear()
+            self._positions.clear()
+            for task_id, arm in rows:
+                self.add(task_id, arm)
+            self._loaded = True
+            self._version += 1
+
+    def add(self, task_id: int, arm: int) -> None:
+        '''Add a task under the given arm, moving it if indexed under another arm'''
+        with self._lock:
+            if task_id in self._positions:
+                if self._positions[task_id][0] == arm:
+                    return
+                self.remove(task_id)
+            if arm not in self._arms:
+                self._arms[arm] = []
+                self._version += 1
+            tasks = self._arms[arm]
+            self._positions[task_id] = (arm, len(tasks))
+            tasks.append(task_id)
+
+    def remove(self, task_id: int) -> None:
+        '''Remove a task from the index, no-op if missing'''
+        with self._lock:
+            if task_id not in self._positions:
+                return
+            arm, pos = self._positions.pop(task_id)
+            tasks = self._arms[arm]
+            last = tasks.pop()
+            if last != task_id:
+                tasks[pos] = last
+                self._positions[last] = (arm, pos)
+            if not tasks:
+                del self._arms[arm]
+                self._version += 1
+
+    def get_arms(self) -> Set[int]:
+        '''Arms that have at least one task'''
+        with self._lock:
+            return set(self._arms)
+
+    def get_arm(self, task_id: int) -> Optional[int]:
+        '''Arm the given task is indexed under'''
+        with self._lock:
+            entry = self._positions.get(task_id)
+            return entry[0] if entry else None
+
+    def sample(self, arm: int, exclude: Set[int] = frozenset()) -> Optional[int]:
+        '''Pick a random task id of the given arm that is not excluded'''
+        with self._lock:
+            tasks = self._arms.get(arm, [])
+            # exclusions are a handful of last recs, a few random probes suffice
+            for _ in range(len(exclude) + 1):
+                if not tasks:
+                    break
+                task_id = random.choice(tasks)
+                if task_id not in exclude:
+                    return task_id
+            candidates = [task_id for task_id in tasks if task_id not in exclude]
+            return random.choice(candidates) if candidates else None
+
+    def sample_tasks(self, num_tasks: int, exclude: Set[int] = frozenset()) -> List[int]:
+        '''Pick up to num_tasks random task ids across all arms'''
+        with self._lock:
+            picks = []
+            arms = list(self._arms)
+            weights = [len(self._arms[arm]) for arm in arms]
+            available = len(self._positions) - len(exclude & self._positions.keys())
+            while arms and len(picks) < min(num_tasks, available):
+                arm = random.choices(arms, weights)[0]
+                task_id = self.sample(arm, exclude | set(picks))
+                if task_id is None:
+                    idx = arms.index(arm)
+                    arms.pop(idx)
+                    weights.pop(idx)
+                    continue
+                picks.append(task_id)
+            return picks
+
+    def __len__(self) -> int:
+        '''Number of indexed tasks'''
+        return len(self._positions)
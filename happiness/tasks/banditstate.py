@@ -0,0 +1,124 @@
+'''Dense NumPy state of a contextual bandit'''
+from typing import Dict, Iterable, Iterator, List, Tuple
+
+import numpy as np
+
+
+class BanditState:
+    '''Q-values and counts as contexts x arms arrays
+
+    Arm codes are mapped to columns on first sight and the arrays grow by
+    doubling, so updates and rankings index arrays instead of nested dicts.
+    Arms never seen in a context have a q-value and count of 0.
+    '''
+    def __init__(self, num_contexts: int, capacity: int = 64):
+        '''Initialize an empty state'''
+        self.num_contexts = num_contexts
+        self._arm_ids: Dict[int, int] = {} # arm code -> column
+        self._arms = np.zeros(capacity, dtype=np.int64) # column -> arm code
+        self.qvalues = np.zeros((num_contexts, capacity))
+        self.counts = np.zeros((num_contexts, capacity), dtype=np.int64)
+        self._known = np.zeros((num_contexts, capacity), dtype=bool)
+        self._loaded = np.zeros(num_contexts, dtype=bool)
+
+    def reset(self) -> None:
+        '''Forget all values, contexts have to be loaded again'''
+        self.qvalues[:] = 0
+        self.counts[:] = 0
+        self._known[:] = False
+        self._loaded[:] = False
+
+    def _grow(self, capacity: int) -> None:
+        '''Widen the arrays to hold at least capacity arms'''
+        new_capacity = max(capacity, 2 * len(self._arms))
+        extra = new_capacity - len(self._arms)
+        self._arms = np.concatenate([self._arms, np.zeros(extra, dtype=np.int64)])
+        self.qvalues = np.pad(self.qvalues, ((0, 0), (0, extra)))
+        self.counts = np.pad(self.counts, ((0, 0), (0, extra)))
+        self._known = np.pad(self._known, ((0, 0), (0, extra)))
+
+    def arm_ids(self, arms: Iterable[int]) -> np.ndarray:
+        '''Columns of the given arm codes, new arms get a column'''
+        ids = []
+        for arm in arms:
+            arm_id = self._arm_ids.get(arm)
+            if arm_id is None:
+                arm_id = len(self._arm_ids)
+                if arm_id >= len(self._arms):
+                    self._grow(arm_id + 1)
+                self._arm_ids[arm] = arm_id
+                self._arms[arm_id] = arm
+            ids.append(arm_id)
+        return np.array(ids, dtype=np.int64)
+
+    def is_loaded(self, ctx: int) -> bool:
+        '''Check if the values of a context were loaded'''
+        return bool(self._loaded[ctx])
+
+    def load_context(self, ctx: int, qvalues: Dict[int, float], counts: Dict[int, int]) -> None:
+        '''Set the values of a context from arm -> value mappings'''
+        ids = self.arm_ids(qvalues)
+        self.qvalues[ctx, ids] = list(qvalues.values())
+        self.counts[ctx, ids] = [counts.get(arm, 0) for arm in qvalues]
+        self._known[ctx, ids] = True
+        self._loaded[ctx] = True
+
+    def has_values(self, ctx: int) -> bool:
+        '''Check if any arm has a value in the context'''
+        return bool(self._known[ctx].any())
+
+    def get_values(self, ctx: int, arms: Iterable[int]) -> np.ndarray:
+        '''Q-values of the given arms in a context'''
+        return self.qvalues[ctx, self.arm_ids(arms)]
+
+    def _ranked(self, ids: np.ndarray, scores: np.ndarray, k: int) -> Iterator[int]:
+        '''Yield the arm codes of the given columns by score, highest first
+
+        Only the top k are selected up front with argpartition, the remaining
+        arms are sorted only if the caller reads past them.
+        '''
+        if not len(ids):
+            return
+        neg_scores = -scores
+        k = min(k, len(ids))
+        order = np.argpartition(neg_scores, k - 1) if k < len(ids) else np.arange(len(ids))
+        top = order[:k]
+        yield from self._arms[ids[top[np.argsort(neg_scores[top], kind='stable')]]].tolist()
+        rest = order[k:]
+        if len(rest):
+            yield from self._arms[ids[rest[np.argsort(neg_scores[rest],
+                                                      kind='stable')]]].tolist()
+
+    def ranked_arms(self, ctx: int, arms: Iterable[int], k: int) -> Iterator[int]:
+        '''Iterate the given arms by q-value, highest first
+
+        The state is read on the call, not lazily, so it may change while the
+        ranking is iterated.
+        '''
+        ids = self.arm_ids(arms)
+        return self._ranked(ids, self.qvalues[ctx, ids], k)
+
+    def sampled_arms(self, ctx: int, arms: Iterable[int], k: int,
+                     rng: np.random.Generator) -> Iterator[int]:
+        '''Iterate the given arms by one Thompson draw each, highest first
+
+        Rewards are 0 or 1, so an arm with mean q over n pulls has the posterior
+        Beta(1 + q * n, 1 + (1 - q) * n). All arms are drawn in one call.
+        '''
+        ids = self.arm_ids(arms)
+        counts = self.counts[ctx, ids]
+        successes = self.qvalues[ctx, ids] * counts
+        draws = rng.beta(1 + successes, 1 + counts - successes)
+        return self._ranked(ids, draws, k)
+
+    def update(self, ctx: int, arms: List[int],
+               rewards: List[float]) -> List[Tuple[int, float, int]]:
+        '''Apply one reward per distinct arm, returns the new (arm, qvalue, count) rows'''
+        ids = self.arm_ids(arms)
+        counts = self.counts[ctx, ids] + 1
+        qvalues = self.qvalues[ctx, ids]
+        qvalues += (np.asarray(rewards, dtype=float) - qvalues) / counts
+        self.counts[ctx, ids] = counts
+        self.qvalues[ctx, ids] = qvalues
+        self._known[ctx, ids] = True
+        return list(zip(arms, qvalues.tolist(), counts.tolist()))
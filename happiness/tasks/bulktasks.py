@@ -0,0 +1,212 @@
+'''Streaming bulk import and export of tasks, work logs and summaries
+
+Imports read NDJSON or CSV line by line and insert validated tasks in batched
+transactions. Exports stream table rows from a db cursor in chunks, so
+neither side holds a whole file or result set in memory.
+'''
+from datetime import date
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
+import csv
+import io
+import json
+
+from loguru import logger
+from sqlalchemy import insert, select
+from sqlalchemy.engine import Connection, Engine
+
+from happiness.tasks.armcode import ARM_FIELD_LOOKUPS, get_arm_code
+from happiness.tasks.counters import TASK_CHANGES, bump_counter
+from happiness.tasks.model import Task, TaskSummary, WorkLog
+
+# Columns of an imported task, only name is required
+IMPORT_FIELDS = ('name', 'complexity', 'type', 'priority', 'repeatable', 'due_date')
+# Columns of a task export that are ignored, so exported tasks import as new pending ones
+IGNORED_FIELDS = ('id', 'status', 'next_scheduled', 'arm_code')
+MAX_NAME_LENGTH = Task.name.type.length
+MAX_REPORTED_ERRORS = 100
+
+# Exportable tables by name, rows are streamed in id order
+EXPORT_TABLES = {
+    'tasks': Task.__table__,
+    'worklogs': WorkLog.__table__,
+    'summaries': TaskSummary.__table__,
+}
+MIMETYPES = {'ndjson': 'application/x-ndjson', 'csv': 'text/csv'}
+
+
+def _read_ndjson(lines: Iterable[str]) -> Iterator[Tuple[int, Any]]:
+    '''(line number, object) of every non-blank NDJSON line, ValueError objects for bad json'''
+    for line_no, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_no, json.loads(line)
+        except ValueError as err:
+            yield line_no, ValueError(f'Invalid json: {err}')
+
+
+def _read_csv(lines: Iterable[str]) -> Iterator[Tuple[int, Any]]:
+    '''(line number, dict) of every CSV record, the first line names the columns'''
+    reader = csv.DictReader(lines)
+    for record in reader:
+        # empty cells are missing values, not empty strings
+        yield reader.line_num, {key: value for key, value in record.items() if value != ''}
+
+
+READERS = {'ndjson': _read_ndjson, 'csv': _read_csv}
+
+
+def _parse_repeatable(value: Any) -> bool:
+    '''Repeatable flag of a json bool or a CSV/json string or number'''
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('1', 'true', 'yes'):
+        return True
+    if str(value).strip().lower() in ('0', 'false', 'no'):
+        return False
+    raise ValueError(f'repeatable {value} is not a boolean')
+
+
+def validate_task(data: Any) -> dict:
+    '''Task row of an imported record, raises ValueError if it is not a valid task'''
+    if isinstance(data, Exception):
+        raise data
+    if not isinstance(data, dict):
+        raise ValueError('Record is not an object')
+    unknown = set(data) - set(IMPORT_FIELDS) - set(IGNORED_FIELDS)
+    if unknown:
+        raise ValueError(f'Unknown fields {sorted(unknown)}')
+    name = data.get('name')
+    if not isinstance(name, str) or not name.strip() or len(name) > MAX_NAME_LENGTH:
+        raise ValueError(f'name must be a non-empty string of at most {MAX_NAME_LENGTH} chars')
+    row = {
+        'name': name.strip(),
+        'complexity': data.get('complexity', 'simple'),
+        'type': data.get('type'),
+        'priority': data.get('priority', 'low'),
+        'repeatable': _parse_repeatable(data.get('repeatable', False)),
+        'due_date': data.get('due_date'),
+        'status': 'pending',
+    }
+    for field in ('complexity', 'type', 'priority'):
+        if row[field] is not None and (not isinstance(row[field], str)
+                                       or row[field] not in ARM_FIELD_LOOKUPS[field]):
+            raise ValueError(f'{field} {row[field]} is not one of '
+                             f'{list(ARM_FIELD_LOOKUPS[field])}')
+    if row['due_date'] is not None:
+        try:
+            date.fromisoformat(str(row['due_date']))
+        except ValueError as err:
+            raise ValueError(f'due_date {row["due_date"]} is not a YYYY-MM-DD date') from err
+    # core inserts skip the ORM event that sets it on Task instances
+    row['arm_code'] = get_arm_code(row)
+    return row
+
+
+class ImportResult:
+    '''Counts and the first errors of a bulk import'''
+    def __init__(self):
+        '''Initialize empty result'''
+        self.imported = 0
+        self.rejected = 0
+        self.errors: List[str] = []
+
+    def reject(self, line_no: int, err: ValueError) -> None:
+        '''Record an invalid line'''
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(f'Line {line_no}: {err}')
+
+    def to_dict(self) -> dict:
+        '''Json serializable result'''
+        return {'imported': self.imported, 'rejected': self.rejected, 'errors': self.errors}
+
+
+def _insert_batch(engine: Engine, rows: List[dict]) -> None:
+    '''Insert a batch of task rows in one transaction, bumping TASK_CHANGES with it'''
+    with engine.begin() as conn:
+        conn.execute(insert(Task.__table__), rows)
+        bump_counter(conn, TASK_CHANGES)
+
+
+def import_tasks(engine: Engine, lines: Iterable[str], fmt: str = 'ndjson',
+                 batch_size: int = 5000) -> ImportResult:
+    '''Validate and insert the tasks of an NDJSON or CSV stream
+
+    Every batch of valid rows is committed in one executemany transaction,
+    invalid lines are skipped and reported. A failing batch stops the import,
+    the batches committed before it stay.
+    '''
+    if fmt not in READERS:
+        raise ValueError(f'Unknown import format {fmt}, expected one of {list(READERS)}')
+    result = ImportResult()
+    batch = []
+    for line_no, data in READERS[fmt](lines):
+        try:
+            batch.append(validate_task(data))
+        except ValueError as err:
+            result.reject(line_no, err)
+            continue
+        if len(batch) >= batch_size:
+            _insert_batch(engine, batch)
+            result.imported += len(batch)
+            batch = []
+    if batch:
+        _insert_batch(engine, batch)
+        result.imported += len(batch)
+    logger.info(f'Imported {result.imported} tasks, rejected {result.rejected} lines')
+    return result
+
+
+def _format_ndjson(columns: List[str], rows: List[tuple], header: bool) -> str:
+    '''NDJSON lines of rows, dates as iso strings'''
+    return ''.join(json.dumps(dict(zip(columns, row)), default=str) + '\n' for row in rows)
+
+
+def _format_csv(columns: List[str], rows: List[tuple], header: bool) -> str:
+    '''CSV lines of rows, with the header line before the first chunk'''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    if header:
+        writer.writerow(columns)
+    writer.writerows(rows)
+    return buffer.getvalue()
+
+
+FORMATTERS: Dict[str, Callable[[List[str], List[tuple], bool], str]] = {
+    'ndjson': _format_ndjson,
+    'csv': _format_csv,
+}
+
+
+def _stream_rows(conn: Connection, table_name: str, fmt: str, chunk_size: int) -> Iterator[str]:
+    '''Formatted chunks of a table read through a streaming cursor'''
+    table = EXPORT_TABLES[table_name]
+    result = conn.execution_options(yield_per=chunk_size).execute(
+        select(table).order_by(table.c.id))
+    columns = list(result.keys())
+    header = True
+    for rows in result.partitions():
+        yield FORMATTERS[fmt](columns, rows, header)
+        header = False
+    if header and fmt == 'csv': # no rows, still name the columns
+        yield FORMATTERS[fmt](columns, [], header)
+
+
+def export_table(engine: Engine, table_name: str, fmt: str = 'ndjson',
+                 chunk_size: int = 5000) -> Iterator[str]:
+    '''Stream a table as NDJSON or CSV chunks of chunk_size rows
+
+    Raises ValueError for unknown tables or formats right away, the rows are
+    only read while the returned iterator is consumed. The connection is
+    opened on first use and closed when the iterator finishes or is closed.
+    '''
+    if table_name not in EXPORT_TABLES:
+        raise ValueError(f'Unknown export {table_name}, expected one of {list(EXPORT_TABLES)}')
+    if fmt not in FORMATTERS:
+        raise ValueError(f'Unknown export format {fmt}, expected one of {list(FORMATTERS)}')
+
+    def stream() -> Iterator[str]:
+        with engine.connect() as conn:
+            yield from _stream_rows(conn, table_name, fmt, chunk_size)
+    return stream()
@@ -0,0 +1,67 @@
+'''Named counters in the task db, shared by all app processes
+
+Workers keep in-memory state (the arm index, report caches) and allocate
+recommendation ids without asking each other. A counter row serves as an id
+sequence or as a change version: a worker bumps it in the transaction of its
+write, and the others compare it with the version their state was built at.
+'''
+from typing import List
+import threading
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+RECOMMENDATION_IDS = 'recommendation' # last allocated recommendation id
+TASK_CHANGES = 'tasks' # bumped when tasks are added, finished or rescheduled
+REPORT_CHANGES = 'reports' # bumped when work logs or task summaries change
+
+
+def read_counter(conn: Connection, name: str) -> int:
+    '''Current value of a counter, 0 if it was never bumped'''
+    return conn.execute(text('SELECT value FROM counter WHERE name = :name'),
+                        {'name': name}).scalar() or 0
+
+
+def bump_counter(conn: Connection, name: str, amount: int = 1) -> int:
+    '''Add amount to a counter in the connection's transaction, returns the new value
+
+    The update takes the db write lock, so concurrent bumps from other
+    processes are serialized and never return the same value.
+    '''
+    return conn.execute(text(
+        'INSERT INTO counter (name, value) VALUES (:name, :amount) '
+        'ON CONFLICT (name) DO UPDATE SET value = value + :amount RETURNING value'),
+        {'name': name, 'amount': amount}).scalar_one()
+
+
+class IdBlocks:
+    '''Hands out ids from blocks reserved by bumping a counter
+
+    Only reserving a block writes to the db, so most allocations are served
+    from memory. Ids are unique across processes, but not ordered across
+    them, and the rest of the block of a stopped process is never used.
+    '''
+    def __init__(self, name: str, block_size: int = 100):
+        '''Initialize allocator of the counter with the given name, no block is reserved yet'''
+        self._name = name
+        self._block_size = block_size
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._end_id = 0 # first id after the reserved block
+
+    def allocate(self, session: Session, num_ids: int) -> List[int]:
+        '''Allocate num_ids consecutive ids, reserving a new block in the session if needed
+
+        A new block is committed right away, so it is not rolled back along
+        with a later failure of the caller, which may already use its ids.
+        '''
+        with self._lock:
+            if self._next_id + num_ids > self._end_id:
+                size = max(self._block_size, num_ids)
+                self._end_id = bump_counter(session.connection(), self._name, size) + 1
+                session.commit()
+                self._next_id = self._end_id - size
+            first_id = self._next_id
+            self._next_id += num_ids
+        return list(range(first_id, first_id + num_ids))
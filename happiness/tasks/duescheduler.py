@@ -0,0 +1,91 @@
+'''Background rescheduling of repeatable tasks once their next scheduled date is due'''
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable, Iterable, List, Optional, Tuple
+import heapq
+import threading
+
+from loguru import logger
+
+# Gets the ids of the tasks that came due, rescheduling them is up to the callback
+DueCallback = Callable[[List[int]], None]
+
+
+class DueScheduler:
+    '''Min-heap of (next scheduled date, task id), fired on a background thread
+
+    The thread sleeps until the earliest date is due (UTC midnight of it, the
+    dates are UTC days) and hands every due task to the callback, so tasks
+    are rescheduled even on days no one presses Start Day. Dates loaded from
+    the db that are already past fire right away, catching up days the app
+    was not running. Entries are only hints of when to wake: the callback
+    reschedules from the db, so entries outdated by later changes are harmless.
+    '''
+    def __init__(self, fire: DueCallback, clock: Optional[Callable[[], datetime]] = None,
+                 max_sleep: float = 3600.0):
+        '''Initialize an empty scheduler and start its thread
+
+        max_sleep bounds every wait, so clock jumps are noticed within it.
+        '''
+        self._fire = fire
+        self._clock = clock or (lambda: datetime.now(timezone.utc))
+        self._max_sleep = max_sleep
+        self._heap: List[Tuple[date, int]] = []
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='due-scheduler', daemon=True)
+        self._thread.start()
+
+    def __len__(self) -> int:
+        '''Number of queued entries'''
+        return len(self._heap)
+
+    def load(self, entries: Iterable[Tuple[int, date]]) -> None:
+        '''Queue (task id, next scheduled date) entries, e.g. all scheduled tasks at startup'''
+        with self._lock:
+            self._heap.extend((due_date, task_id) for task_id, due_date in entries)
+            heapq.heapify(self._heap)
+            logger.info(f'Due scheduler holds {len(self._heap)} scheduled tasks')
+        self._wake.set()
+
+    def add(self, task_id: int, due_date: date) -> None:
+        '''Queue a task to fire once due_date is due'''
+        with self._lock:
+            wake = not self._heap or due_date < self._heap[0][0]
+            heapq.heappush(self._heap, (due_date, task_id))
+        if wake:
+            self._wake.set()
+
+    def close(self) -> None:
+        '''Stop the scheduler thread'''
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+
+    def _pop_due(self) -> Tuple[List[int], float]:
+        '''Ids of the due tasks and the seconds until the next one is due'''
+        now = self._clock()
+        today = now.date()
+        task_ids = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= today:
+                task_ids.append(heapq.heappop(self._heap)[1])
+            if not self._heap:
+                return task_ids, self._max_sleep
+            due_at = datetime.combine(self._heap[0][0], time(), tzinfo=timezone.utc)
+        wait = (due_at - now.astimezone(timezone.utc)) / timedelta(seconds=1)
+        return task_ids, min(max(wait, 0.0), self._max_sleep)
+
+    def _run(self) -> None:
+        '''Scheduler thread loop'''
+        while not self._closed:
+            task_ids, wait = self._pop_due()
+            if task_ids:
+                try:
+                    self._fire(task_ids)
+                except Exception as err: # keep the thread alive, the next start day retries
+                    logger.exception(f'Failed to reschedule due tasks {task_ids}: {err}')
+            self._wake.wait(wait)
+            self._wake.clear()
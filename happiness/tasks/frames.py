@@ -0,0 +1,21 @@
+'''Column oriented loading of query results into dataframes'''
+from typing import Dict, List
+
+from sqlalchemy import Select
+from sqlalchemy.engine import Connection
+import pandas as pd
+
+
+def read_frame(conn: Connection, stmt: Select, dtypes: Dict[str, str] = None,
+               ts_columns: List[str] = (), tz=None) -> pd.DataFrame:
+    '''Load a core select straight into typed columns
+
+    Timestamp columns are stored as naive utc, they are parsed as utc and
+    converted to tz in one vectorized pass when tz is given.
+    '''
+    df = pd.read_sql(stmt, conn, dtype=dtypes, parse_dates={col: {'utc': True}
+                                                            for col in ts_columns})
+    if tz is not None:
+        for col in ts_columns:
+            df[col] = df[col].dt.tz_convert(tz)
+    return df
@@ -1,141 +1,261 @@
 '''A MAB based recommender for tasks'''
-from collections import defaultdict
 from datetime import datetime, timezone
-from typing import Dict, List
-import pickle
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 import random
+import threading
 
 from loguru import logger
+import numpy as np
+
+from happiness.tasks.armindex import ArmIndex
+from happiness.tasks.banditstate import BanditState
+from happiness.tasks.modelstore import ModelStore, import_pickle
 from happiness.tasks.recommender import TaskRecommenderInterface
-from happiness.tasks.task import TaskWrapper
+from happiness.tasks.slatepool import SlatePool
+from happiness.tasks.writebehind import WriteBehindQueue
 
 
 class MABRecommender(TaskRecommenderInterface):
     '''MAB Recommender'''
-    def __init__(self, mdl_file: str, epsilon: float = 0.3):
-        '''Initialize MAB recommender'''
+    SLATES_PER_CONTEXT = 1 # the greedy ranking only changes with the q-values
+    CONSUME_SLATES = False
+
+    def __init__(self, mdl_file: str, epsilon: float = 0.3, pkl_file: Optional[str] = None,
+                 writer: Optional[WriteBehindQueue] = None,
+                 clock: Optional[Callable[[], datetime]] = None, pool_slates: bool = False):
+        '''Initialize MAB recommender
+
+        mdl_file is the model store, pkl_file an optional trained model that is
+        imported into the store whenever it changes. With a writer, q-value
+        updates and rounds are persisted in the background. clock returns the
+        current UTC time the context is derived from, e.g. the event time
+        during a replay.
+        With pool_slates, arm rankings per context are precomputed in the
+        background and requests only walk the top of a ranking.
+
+        The store is the shared state of all app processes using it: it holds
+        the rewards and the last round. Requests open and close rounds in
+        memory, the store gets a copy. In memory state, the round included,
+        is reloaded whenever another process changed the store.
+        '''
+        self.clock = clock or (lambda: datetime.now(timezone.utc))
         self.mdl_file = mdl_file
-        self.qvalues, self.counts = self._load_model(self.mdl_file)
-        self.epsilon = epsilon
-        self.last_context = None
-        self.last_tasks = {} # last recs
-        self.task_chosen = False
+        self.pkl_file = pkl_file
+        self.store = ModelStore(mdl_file)
+        self.writer = writer
+        if writer is not None:
+            writer.register('qvalues', lambda _, updates: self.store.add_rewards_many(updates),
+                            after_commit=True)
+            # only the latest state of the round matters
+            writer.register('round', lambda _, rounds: self.store.set_round(*rounds[-1]),
+                            after_commit=True)
         self.ce = ContextEncoder(6, 22, 4) #TODO: load from config?
-        logger.info(f'Loaded MAB recommender with epsilon \
-                    {self.epsilon} and {len(self.qvalues)} contextual arms')
+        self.state = BanditState(self.ce.get_num_intervals())
+        self._state_lock = threading.RLock() # the slate pool ranks on its own thread
+        self.pool = None
+        if pool_slates:
+            self.pool = SlatePool(self.ce.get_num_intervals(), self._build_slate,
+                                  self.SLATES_PER_CONTEXT, consume=self.CONSUME_SLATES)
+        self._arm_index = None
+        self._arms_version = None
+        self._round_lock = threading.Lock()
+        self._round = self.store.get_round() # context, task id -> arm picks, is open
+        self._load_model()
+        self._data_version = self.store.data_version()
+        self.epsilon = epsilon
+        logger.info(f'Loaded MAB recommender with epsilon {self.epsilon} from {self.mdl_file}')
 
-    def _load_model(self, mdl_file: str) -> dict:
-        '''Load model from a pickle file'''
-        data = {'qvalues': {}, 'counts': {}}
+    def _load_model(self) -> None:
+        '''Import a changed trained model and drop the loaded contexts'''
+        if self.pkl_file:
+            import_pickle(self.store, self.pkl_file)
+        if self.store.is_empty():
+            logger.warning(f'Model store {self.mdl_file} has no trained values')
+        with self._state_lock:
+            self.state.reset()
+        if self.pool is not None:
+            self.pool.invalidate()
 
-        with open(mdl_file, 'rb') as f:
-            data = pickle.load(f)
-        logger.info(f'Loading a contextual MAB from model file {mdl_file}')
-        return data['qvalues'], data['counts']
+    def _ensure_context(self, ctx: int) -> None:
+        '''Read the values of a context from the store on first use'''
+        with self._state_lock:
+            if not self.state.is_loaded(ctx):
+                self.state.load_context(ctx, *self.store.get_context(ctx))
 
-    def _load_contextual_values(self) -> dict:
-        '''Load contextual model based on time of day'''
-        curr_hr = datetime.now(timezone.utc).hour
+    def _sync_state(self) -> None:
+        '''Drop the cached values if another process changed the store'''
+        version = self.store.data_version()
+        if version == self._data_version:
+            return
+        if self.writer is not None:
+            self.writer.flush() # reload our own queued rewards along with theirs
+        self._data_version = version
+        with self._state_lock:
+            self.state.reset()
+        with self._round_lock:
+            self._round = self.store.get_round() # another process may have opened one
+        if self.pool is not None:
+            self.pool.invalidate()
+        logger.debug(f'Model store {self.mdl_file} changed, dropped cached values')
+
+    def _load_contextual_values(self) -> Optional[int]:
+        '''Load contextual model based on time of day, returns None if it has no values'''
+        curr_hr = self.clock().hour
         ctx = self.ce.get_context(curr_hr)
-        self.last_context = ctx
-        ctx_qvalues = self.qvalues.get(ctx, None)
-        if not ctx_qvalues:
+        self._ensure_context(ctx)
+        if not self.state.has_values(ctx):
             logger.error(f'Could not load contextual values for {curr_hr}')
-            self.last_context = None
-        return ctx_qvalues
-
-    def _as_hashed_tasks(self, tasks: List[TaskWrapper]) -> Dict[int, List[TaskWrapper]]:
-        '''Convert tasks into a dict with hash as key and tasks as list'''
-        random.shuffle(tasks)
-        hashed_tasks = defaultdict(list)
-        for task in tasks:
-            if task.get_id() not in self.last_tasks: #ignore last recs
-                hashed_tasks[task.get_hash_code()].append(task)
-        return hashed_tasks
-
-    @staticmethod
-    def _sort_and_augment_qvalues(qvalues: dict, task_keys: set) -> list:
-        '''Sort qvalues and augment with missing keys if any'''
-        missing_keys = task_keys - qvalues.keys()
-        sorted_qvalues = sorted((qv for qv in qvalues.items() if qv[0] in task_keys),
-                         key = lambda x: x[1], reverse=True)
-        for k in missing_keys:
-            sorted_qvalues.append((k, 0))
-        return sorted_qvalues
-
-    def _run_mab(self, qvalues: Dict[int, float],
-                 hashed_tasks: Dict[int, List[TaskWrapper]],
-                 num_tasks: int) -> list:
-        '''Run multi arm bandit'''
-        self.last_tasks.clear()
+            return None
+        return ctx
+
+    def _rank(self, ctx: int, arms: List[int], k: int) -> Iterator[int]:
+        '''Iterate arms best first for the context, the top k are ranked up front'''
+        with self._state_lock:
+            return self.state.ranked_arms(ctx, arms, k)
+
+    def _build_slate(self, ctx: int) -> List[int]:
+        '''Rank every indexed arm for a context, run by the slate pool'''
+        if self._arm_index is None: # nothing was recommended yet
+            return []
+        arms = list(self._arm_index.get_arms())
+        self._ensure_context(ctx)
+        return list(self._rank(ctx, arms, len(arms)))
+
+    def _candidate_arms(self, ctx: int, arm_index: ArmIndex,
+                        num_tasks: int) -> Tuple[List[int], Iterator[int]]:
+        '''Arms to pull from and their ranking, from the slate pool if it has one'''
+        if self.pool is not None:
+            self._arm_index = arm_index
+            if arm_index.get_version() != self._arms_version:
+                self._arms_version = arm_index.get_version()
+                self.pool.invalidate()
+            slate = self.pool.get(ctx)
+            if slate is not None: # may hold arms emptied since, their pulls pick nothing
+                return slate, iter(slate)
+        arms = list(arm_index.get_arms())
+        return arms, self._rank(ctx, arms, num_tasks)
+
+    def _pull_arms(self, arms: List[int], ranked_arms: Iterator[int],
+                   pick_task: Callable[[int], object], num_tasks: int) -> List[tuple]:
+        '''Pull distinct arms until num_tasks tasks were picked or arms ran out'''
         recs = list()
-        arm_keys = hashed_tasks.keys()
-        sorted_qvalues = self._sort_and_augment_qvalues(qvalues, arm_keys)
-        logger.debug(f'Sorted qvalues: {sorted_qvalues}')
         arm_history = set()
-        while len(recs) < num_tasks:
-            task = None
+        while len(recs) < num_tasks and len(arm_history) < len(arms):
             if random.random() < self.epsilon:
-                # random pull
-                available_arms = list(arm_keys - arm_history)
-                selected_arm = random.choice(available_arms)
+                # random pull, redrawing among the arms not pulled yet keeps it uniform
+                selected_arm = random.choice(arms)
+                if selected_arm in arm_history:
+                    selected_arm = random.choice([arm for arm in arms if arm not in arm_history])
                 logger.debug(f'Random pull: {selected_arm}')
             else:
-                # select based on qvalue
-                for arm, _ in sorted_qvalues:
-                    if arm not in arm_history:
-                        selected_arm = arm
-                        logger.debug(f'Pulled arm {selected_arm}')
-                        break
+                # select based on qvalue, arms skipped here were already pulled
+                selected_arm = next(arm for arm in ranked_arms if arm not in arm_history)
+                logger.debug(f'Pulled arm {selected_arm}')
             arm_history.add(selected_arm)
-            task = hashed_tasks[selected_arm][0]
-            self.last_tasks[task.get_id()] = task.get_hash_code()
-            recs.append(task)
-
+            task = pick_task(selected_arm)
+            if task is not None:
+                recs.append((selected_arm, task))
         return recs
 
-    def _update_qvalues(self, task_id: int = None) -> None:
-        '''Set reward as 1 for selected task id, and 0 for others'''
-        for t_id, t_hash in self.last_tasks.items():
-            count = self.counts[self.last_context].get(t_hash, 0)
-            count += 1
-            reward = 1 if t_id == task_id else 0
-            qv = self.qvalues[self.last_context][t_hash]
-            qv += (reward - qv) * 1.0 / count
-            self.qvalues[self.last_context][t_hash] = qv
-            self.counts[self.last_context][t_hash] = count
-
-    def recommend_tasks(self, tasks: List[TaskWrapper], num_tasks: int) -> List[TaskWrapper]:
-        '''Contextual MAB recs'''
-        # Flush old recs and update qvalues, counts
-        if not self.task_chosen and self.last_context:
-            self._update_qvalues()
-
-        # load qvalues based on context
-        qvalues = self._load_contextual_values()
-        if qvalues:
-            hashed_tasks = self._as_hashed_tasks(tasks)
-            recs = self._run_mab(qvalues, hashed_tasks, num_tasks)
-            return recs
+    def _apply_rewards(self, ctx: int, picks: Dict[int, int], task_id: int = None) -> None:
+        '''Set reward as 1 for selected task id, and 0 for the other picks of a round'''
+        if ctx is None or not picks:
+            return
+        arms = list(picks.values())
+        rewards = [1 if t_id == task_id else 0 for t_id in picks]
+        with self._state_lock:
+            self._ensure_context(ctx) # the model may have been reloaded since
+            old_values = self.state.get_values(ctx, arms)
+            updates = self.state.update(ctx, arms, rewards)
+        if self.pool is not None:
+            new_values = np.array([qvalue for _, qvalue, _ in updates])
+            self.pool.add_drift(ctx, float(np.abs(new_values - old_values).sum()))
+        self._persist(ctx, list(zip(arms, rewards)))
+
+    def _persist(self, ctx: int, rewards: list) -> None:
+        '''Write (arm, reward) pairs of a context to the store'''
+        if self.writer is None:
+            self.store.add_rewards(ctx, rewards)
+        else:
+            self.writer.put('qvalues', (ctx, rewards))
+
+    def _persist_round(self, ctx: Optional[int], picks: Dict[int, int], is_open: bool) -> None:
+        '''Write the state of the round to the store'''
+        if self.writer is None:
+            self.store.set_round(ctx, picks, is_open)
         else:
+            self.writer.put('round', (ctx, picks, is_open))
+
+    def _open_round(self, ctx: int, picks: Dict[int, int]) -> None:
+        '''Make the task id -> arm picks the open round, replacing the previous round'''
+        with self._round_lock:
+            self._round = (ctx, picks, bool(picks))
+        self._persist_round(ctx, picks, bool(picks))
+
+    def _close_round(self) -> Tuple[Optional[int], Dict[int, int], bool]:
+        '''Close the last round, returns its context, task id -> arm picks and if it was open
+
+        Only one caller gets was_open for a round, so its rewards are applied
+        once. The picks are kept to exclude them next round.
+        '''
+        self._sync_state()
+        with self._round_lock:
+            ctx, picks, was_open = self._round
+            self._round = (ctx, picks, False)
+        if was_open:
+            self._persist_round(ctx, picks, False)
+        return ctx, picks, was_open
+
+    def _start_round(self) -> Tuple[Optional[int], Set[int]]:
+        '''Close the last round, returns the current context and the last recommended task ids
+
+        Recs of a round in which no task was chosen get a reward of 0.
+        '''
+        last_ctx, last_picks, was_open = self._close_round()
+        if was_open:
+            self._apply_rewards(last_ctx, last_picks)
+        return self._load_contextual_values(), set(last_picks)
+
+    def recommend_from_index(self, arm_index: ArmIndex, num_tasks: int) -> List[int]:
+        '''Contextual MAB recs pulling task ids from the arm index'''
+        ctx, last_recs = self._start_round() # do not recommend the same tasks twice in a row
+        if ctx is None: # the closed round stays the last one, random recs are not rewarded
             logger.warning('Returning random tasks')
-            return tasks[:num_tasks]
+            return arm_index.sample_tasks(num_tasks, last_recs)
+
+        arms, ranked_arms = self._candidate_arms(ctx, arm_index, num_tasks)
+        recs = self._pull_arms(arms, ranked_arms,
+                               lambda arm: arm_index.sample(arm, last_recs), num_tasks)
+        self._open_round(ctx, {task_id: arm for arm, task_id in recs})
+        return [task_id for _, task_id in recs]
 
     def update_chosen_task(self, task_id: int) -> None:
-        self.task_chosen = True
-        self._update_qvalues(task_id)
+        '''Reward the chosen task of the open round'''
+        ctx, picks, was_open = self._close_round()
+        if was_open:
+            self._apply_rewards(ctx, picks, task_id)
         return super().update_chosen_task(task_id)
 
+    def update_shown_tasks(self, task_ids: List[int], chosen_task_id: Optional[int]) -> None:
+        '''Reward the shown tasks of the open round, the other picks are closed unrewarded'''
+        ctx, picks, was_open = self._close_round()
+        if was_open:
+            shown = set(task_ids)
+            self._apply_rewards(ctx, {t_id: arm for t_id, arm in picks.items() if t_id in shown},
+                                chosen_task_id)
+
     def load(self):
         '''Reload model'''
-        self.qvalues, self.counts = self._load_model(self.mdl_file)
+        if self.writer is not None:
+            self.writer.flush() # queued updates must not land on an imported model
+        self._load_model()
 
     def save(self):
-        '''Save updated values'''
-        with open(self.mdl_file, 'wb') as f:
-            obj = {'qvalues': self.qvalues, 'counts': self.counts}
-            pickle.dump(obj, f)
-        logger.info('Saved model file')
+        '''Compact the store and write a snapshot, updates are already durable'''
+        if self.writer is not None:
+            self.writer.flush()
+        self.store.compact()
+        self.store.snapshot(f'{self.mdl_file}.snapshot')
         return super().save()
 
 class ContextEncoder:
@@ -157,6 +277,12 @@ class ContextEncoder:
             hr -= self.start_bound
             return int(hr / self.duration) + 1
 
+    def get_contexts(self, hrs: np.ndarray) -> np.ndarray:
+        '''Get contexts of an array of hours, vectorized get_context'''
+        contexts = (hrs - self.start_bound) // self.duration + 1
+        contexts = np.where(hrs < self.start_bound, 0, contexts)
+        return np.where(hrs >= self.end_bound, self.num_intervals - 1, contexts)
+
     def get_num_intervals(self):
         '''Get total number of intervals'''
         return self.num_intervals
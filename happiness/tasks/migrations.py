@@ -0,0 +1,128 @@
+'''Versioned schema migrations for the sqlite task db'''
+from typing import Callable, List, Union
+
+from loguru import logger
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+
+from happiness.tasks.armcode import ARM_FIELD_LOOKUPS, get_arm_code
+from happiness.tasks.counters import RECOMMENDATION_IDS, REPORT_CHANGES, TASK_CHANGES
+from happiness.tasks.recurrence import backfill_recurrences
+from happiness.tasks.rollups import backfill_rollups
+
+# A migration step is either a sql statement or a callable taking a connection
+Step = Union[str, Callable[[Connection], None]]
+
+
+class Migration:
+    '''A single schema version bump'''
+    def __init__(self, version: int, description: str, steps: List[Step]):
+        '''Initialize migration'''
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def apply(self, conn: Connection) -> None:
+        '''Run all steps of this migration on the given connection'''
+        for step in self.steps:
+            if callable(step):
+                step(conn)
+            else:
+                conn.execute(text(step))
+
+
+def _add_arm_code_column(conn: Connection) -> None:
+    '''Add the task.arm_code column unless create_all already did'''
+    columns = {row.name for row in conn.execute(text('PRAGMA table_info(task)'))}
+    if 'arm_code' not in columns:
+        conn.execute(text('ALTER TABLE task ADD COLUMN arm_code INTEGER'))
+
+
+def backfill_arm_codes(conn: Connection) -> None:
+    '''Compute the arm code of tasks that do not have one yet'''
+    fields = ', '.join(ARM_FIELD_LOOKUPS)
+    rows = conn.execute(text(f'SELECT id, {fields} FROM task WHERE arm_code IS NULL')).all()
+    if rows:
+        conn.execute(text('UPDATE task SET arm_code = :arm_code WHERE id = :id'), [
+            {'id': row.id, 'arm_code': get_arm_code(row._mapping)} for row in rows
+        ])
+    logger.info(f'Backfilled arm codes of {len(rows)} tasks')
+
+
+# Steps must be idempotent: a fresh db already gets the current schema from
+# db.create_all() and only has its version number bumped.
+MIGRATIONS = [
+    Migration(1, 'Indexes for hot query predicates', [
+        'CREATE INDEX IF NOT EXISTS ix_task_status ON task (status)',
+        'CREATE INDEX IF NOT EXISTS ix_task_repeatable_status ON task (repeatable, status)',
+        'CREATE INDEX IF NOT EXISTS ix_task_next_scheduled_repeatable '
+        'ON task (next_scheduled, repeatable)',
+        'CREATE INDEX IF NOT EXISTS ix_work_log_task_rec_end '
+        'ON work_log (task_id, rec_id, end_ts)',
+        'CREATE INDEX IF NOT EXISTS ix_work_log_start_end ON work_log (start_ts, end_ts)',
+        'CREATE INDEX IF NOT EXISTS ix_task_summary_task_ended '
+        'ON task_summary (task_id, has_ended)',
+        'CREATE INDEX IF NOT EXISTS ix_task_summary_ended_end_date '
+        'ON task_summary (has_ended, end_date)',
+        'ANALYZE',
+    ]),
+    Migration(2, 'Backfill daily report rollups', [
+        backfill_rollups,
+    ]),
+    Migration(3, 'Stored arm codes of tasks', [
+        _add_arm_code_column,
+        backfill_arm_codes,
+        'CREATE INDEX IF NOT EXISTS ix_task_status_arm_code ON task (status, arm_code)',
+    ]),
+    Migration(4, 'Counters shared by app processes', [
+        'CREATE TABLE IF NOT EXISTS counter ('
+        'name VARCHAR(40) NOT NULL PRIMARY KEY, value INTEGER NOT NULL)',
+        f"INSERT OR IGNORE INTO counter (name, value) "
+        f"SELECT '{RECOMMENDATION_IDS}', COALESCE(MAX(id), 0) FROM recommendation",
+        f"INSERT OR IGNORE INTO counter (name, value) VALUES ('{TASK_CHANGES}', 0)",
+        f"INSERT OR IGNORE INTO counter (name, value) VALUES ('{REPORT_CHANGES}', 0)",
+    ]),
+    Migration(5, 'Indexes for the sort keys of paged task tables', [
+        'CREATE INDEX IF NOT EXISTS ix_task_name ON task (name)',
+        'CREATE INDEX IF NOT EXISTS ix_task_complexity ON task (complexity)',
+        'CREATE INDEX IF NOT EXISTS ix_task_type ON task (type)',
+        'CREATE INDEX IF NOT EXISTS ix_task_priority ON task (priority)',
+        'ANALYZE',
+    ]),
+    Migration(6, 'Recurrence statistics of tasks', [
+        'CREATE TABLE IF NOT EXISTS task_recurrence ('
+        'task_id INTEGER NOT NULL PRIMARY KEY REFERENCES task (id), '
+        'last_start DATETIME NOT NULL, recent_intervals TEXT NOT NULL)',
+        backfill_recurrences,
+    ]),
+]
+
+
+def get_schema_version(conn: Connection) -> int:
+    '''Get the schema version stored in the db'''
+    return conn.execute(text('PRAGMA user_version')).scalar_one()
+
+
+def _set_schema_version(conn: Connection, version: int) -> None:
+    '''Store the schema version in the db'''
+    conn.execute(text(f'PRAGMA user_version = {int(version)}'))
+
+
+def migrate(engine: Engine, migrations: List[Migration] = None) -> int:
+    '''Apply pending migrations in order, returns the resulting schema version'''
+    if migrations is None:
+        migrations = MIGRATIONS
+
+    with engine.begin() as conn:
+        version = get_schema_version(conn)
+
+    for migration in sorted(migrations, key=lambda m: m.version):
+        if migration.version <= version:
+            continue
+        logger.info(f'Migrating schema to version {migration.version}: '
+                    f'{migration.description}')
+        with engine.begin() as conn:
+            migration.apply(conn)
+            _set_schema_version(conn, migration.version)
+        version = migration.version
+    return version
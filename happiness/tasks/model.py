@@ -1,9 +1,28 @@
 '''Task db model'''
 from datetime import datetime, timezone
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from happiness.tasks.armcode import ARM_FIELD_LOOKUPS, get_arm_code
 
 db = SQLAlchemy()
 
+
+def enable_concurrent_access(engine: Engine, busy_timeout_ms: int = 30000) -> None:
+    '''Let several threads and app processes share the sqlite task db
+
+    WAL lets readers run while another connection writes, and the busy timeout
+    makes writers queue for the lock instead of failing. Call it before the
+    first connection is opened.
+    '''
+    @event.listens_for(engine, 'connect')
+    def _set_pragmas(dbapi_conn, _):
+        cursor = dbapi_conn.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+        cursor.close()
+
 class Task(db.Model):
     '''Task model'''
     id = db.Column(db.Integer, primary_key=True)
@@ -13,8 +32,28 @@ class Task(db.Model):
     due_date = db.Column(db.String(10))
     priority = db.Column(db.String(10), nullable=False, default='low')
     repeatable = db.Column(db.Boolean, default=False)
-    status = db.Column(db.String(10), nullable=False, default='pending') #TODO: needs an index
+    status = db.Column(db.String(10), nullable=False, default='pending')
     next_scheduled = db.Column(db.Date)
+    arm_code = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_task_status', 'status'),
+        db.Index('ix_task_status_arm_code', 'status', 'arm_code'),
+        db.Index('ix_task_repeatable_status', 'repeatable', 'status'),
+        db.Index('ix_task_next_scheduled_repeatable', 'next_scheduled', 'repeatable'),
+        # sort keys of the paged task tables, sqlite appends the id to each index
+        db.Index('ix_task_name', 'name'),
+        db.Index('ix_task_complexity', 'complexity'),
+        db.Index('ix_task_type', 'type'),
+        db.Index('ix_task_priority', 'priority'),
+    )
+
+
+@event.listens_for(Task, 'before_insert')
+@event.listens_for(Task, 'before_update')
+def _set_arm_code(mapper, connection, target: Task) -> None:
+    '''Keep the stored arm code in sync with the task attributes'''
+    target.arm_code = get_arm_code({field: getattr(target, field) for field in ARM_FIELD_LOOKUPS})
 
 
 class Recommendation(db.Model):
@@ -35,6 +74,11 @@ class WorkLog(db.Model):
     task = db.relationship('Task', backref='worklogs')
     recommendation = db.relationship('Recommendation', backref='worklogs')
 
+    __table_args__ = (
+        db.Index('ix_work_log_task_rec_end', 'task_id', 'rec_id', 'end_ts'),
+        db.Index('ix_work_log_start_end', 'start_ts', 'end_ts'),
+    )
+
 class TaskSummary(db.Model):
     '''Task summary model'''
     id = db.Column(db.Integer, primary_key=True)
@@ -46,3 +90,68 @@ class TaskSummary(db.Model):
     rating = db.Column(db.Integer, nullable=False, default=1)
     has_ended = db.Column(db.Boolean, default=False)
     task = db.relationship('Task', backref='summary')
+
+    __table_args__ = (
+        db.Index('ix_task_summary_task_ended', 'task_id', 'has_ended'),
+        db.Index('ix_task_summary_ended_end_date', 'has_ended', 'end_date'),
+    )
+
+
+class TaskRecurrence(db.Model):
+    '''Last summary start of a task and the intervals between its latest starts'''
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'), primary_key=True)
+    last_start = db.Column(db.DateTime, nullable=False)
+    recent_intervals = db.Column(db.Text, nullable=False, default='') # days, comma separated
+
+
+class DailyTypeRollup(db.Model):
+    '''Time worked per local day and task type, work logs over 3 hours excluded'''
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    type = db.Column(db.String(20))
+    seconds_worked = db.Column(db.Integer, nullable=False, default=0)
+    num_worklogs = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_daily_type_rollup_day_type', 'day', 'type', unique=True),
+    )
+
+
+class DailySplitRollup(db.Model):
+    '''Time worked per local day, task priority and complexity'''
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    priority = db.Column(db.String(10))
+    complexity = db.Column(db.String(10))
+    seconds_worked = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_daily_split_rollup_day_priority_complexity',
+                 'day', 'priority', 'complexity', unique=True),
+    )
+
+
+class DailySwitchRollup(db.Model):
+    '''Task switches per local day'''
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False, unique=True)
+    task_switches = db.Column(db.Integer, nullable=False, default=0)
+    last_task_id = db.Column(db.Integer)
+
+
+class HourlyCompletionRollup(db.Model):
+    '''Completed tasks per local day and hour'''
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    hour = db.Column(db.Integer, nullable=False)
+    num_completed = db.Column(db.Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        db.Index('ix_hourly_completion_rollup_day_hour', 'day', 'hour', unique=True),
+    )
+
+
+class Counter(db.Model):
+    '''Named counter shared by all app processes, see happiness.tasks.counters'''
+    name = db.Column(db.String(40), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,229 @@
+'''Durable, incrementally updated storage for contextual bandit models'''
+from typing import Dict, Iterable, Optional, Tuple
+import os
+import pickle
+import sqlite3
+import threading
+
+from loguru import logger
+
+from happiness.tasks.armcode import ARM_CODE_VERSION
+
+# (arm, reward) pairs of one context
+ArmRewards = Iterable[Tuple[int, float]]
+
+_SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS arm_value (
+        context INTEGER NOT NULL,
+        arm INTEGER NOT NULL,
+        qvalue REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (context, arm)
+    ) WITHOUT ROWID''',
+    # sums and counts of the rewards applied online, kept apart to merge with retrained models
+    '''CREATE TABLE IF NOT EXISTS online_value (
+        context INTEGER NOT NULL,
+        arm INTEGER NOT NULL,
+        reward_sum REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (context, arm)
+    ) WITHOUT ROWID''',
+    '''CREATE TABLE IF NOT EXISTS model_meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS open_round (
+        task_id INTEGER PRIMARY KEY,
+        arm INTEGER NOT NULL
+    )''',
+]
+
+
+class ModelStore:
+    '''Q-values and counts keyed by context x arm in a sqlite file
+
+    Every update is upserted in its own small transaction, so values are durable
+    as soon as the update call returns. The db runs in WAL mode: writes append to
+    the log, compact() checkpoints it back into the db file and snapshot() writes
+    an atomic copy of the whole model. Contexts are read on demand, so opening
+    the store does not scale with the number of contextual arms.
+
+    Several app processes may share the file. Rewards are applied as increments
+    in sql, the last recommended round is persisted in the store, and
+    data_version() tells a process when another one changed the model.
+
+    Rewards applied online are also summed apart from the model. A retrained
+    model replaces only what was learnt from the history, the online sums
+    are merged back on top of it.
+    '''
+    def __init__(self, path: str, compact_every: int = 1000):
+        '''Open or create the store at path'''
+        self.path = path
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._num_writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL') # durable across app crashes
+        for stmt in _SCHEMA:
+            self._conn.execute(stmt)
+
+    def get_meta(self, key: str) -> Optional[str]:
+        '''Get a metadata value'''
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value FROM model_meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value) -> None:
+        '''Set a metadata value, caller holds the lock'''
+        self._conn.execute('INSERT OR REPLACE INTO model_meta (key, value) VALUES (?, ?)',
+                           (key, str(value)))
+
+    def is_empty(self) -> bool:
+        '''Check if the store holds no arm values'''
+        with self._lock:
+            return self._conn.execute('SELECT 1 FROM arm_value LIMIT 1').fetchone() is None
+
+    def get_context(self, context: int) -> Tuple[Dict[int, float], Dict[int, int]]:
+        '''Get the q-values and counts of all arms of a context'''
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT arm, qvalue, count FROM arm_value WHERE context = ?',
+                (context,)).fetchall()
+        return {arm: qv for arm, qv, _ in rows}, {arm: count for arm, _, count in rows}
+
+    def data_version(self) -> int:
+        '''Changes when another connection, e.g. another app process, commits to the store'''
+        with self._lock:
+            return self._conn.execute('PRAGMA data_version').fetchone()[0]
+
+    def add_rewards(self, context: int, rewards: ArmRewards) -> None:
+        '''Fold (arm, reward) pairs of a context into the running means in one transaction'''
+        self.add_rewards_many([(context, rewards)])
+
+    def add_rewards_many(self, updates: Iterable[Tuple[int, ArmRewards]]) -> None:
+        '''Fold (context, [(arm, reward)]) updates into the running means in one transaction
+
+        The mean is updated in sql from the stored count, so rewards written by
+        several processes add up instead of overwriting each other.
+        '''
+        rows = [(context, arm, reward) for context, rewards in updates for arm, reward in rewards]
+        if not rows:
+            return
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.executemany(
+                    'INSERT INTO arm_value (context, arm, qvalue, count) VALUES (?, ?, ?, 1) '
+                    'ON CONFLICT (context, arm) DO UPDATE '
+                    'SET qvalue = qvalue + (excluded.qvalue - qvalue) / (count + 1), '
+                    'count = count + 1', rows)
+                self._conn.executemany(
+                    'INSERT INTO online_value (context, arm, reward_sum, count) '
+                    'VALUES (?, ?, ?, 1) ON CONFLICT (context, arm) DO UPDATE '
+                    'SET reward_sum = reward_sum + excluded.reward_sum, count = count + 1', rows)
+            self._num_writes += 1
+            if self._num_writes >= self.compact_every:
+                self._compact()
+
+    def set_round(self, context: Optional[int], picks: Dict[int, int], is_open: bool) -> None:
+        '''Record the context and task id -> arm picks of the last round and if it is open'''
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                self._conn.execute('DELETE FROM open_round')
+                self._conn.executemany('INSERT INTO open_round (task_id, arm) VALUES (?, ?)',
+                                       picks.items())
+                if context is not None:
+                    self._set_meta('round_context', context)
+                self._set_meta('round_open', int(is_open))
+
+    def get_round(self) -> Tuple[Optional[int], Dict[int, int], bool]:
+        '''Get the context, task id -> arm picks and open flag of the last recorded round'''
+        with self._lock:
+            meta = dict(self._conn.execute(
+                "SELECT key, value FROM model_meta "
+                "WHERE key IN ('round_context', 'round_open')").fetchall())
+            picks = dict(self._conn.execute('SELECT task_id, arm FROM open_round').fetchall())
+        context = meta.get('round_context')
+        return (int(context) if context is not None else None), picks, meta.get('round_open') == '1'
+
+    def replace(self, qvalues: Dict[int, Dict[int, float]], counts: Dict[int, Dict[int, int]],
+                arm_code_version: Optional[int], **meta) -> None:
+        '''Replace the trained model, e.g. with a freshly trained one
+
+        The online rewards are merged into the new values, unless the arm
+        codes changed meaning, then they are dropped.
+        '''
+        rows = [(ctx, arm, qv, counts.get(ctx, {}).get(arm, 0))
+                for ctx, ctx_qvalues in qvalues.items() for arm, qv in ctx_qvalues.items()]
+        with self._lock:
+            with self._conn:
+                self._conn.execute('BEGIN IMMEDIATE')
+                row = self._conn.execute(
+                    "SELECT value FROM model_meta WHERE key = 'arm_code_version'").fetchone()
+                if row is not None and row[0] != str(arm_code_version):
+                    self._conn.execute('DELETE FROM online_value')
+                self._conn.execute('DELETE FROM arm_value')
+                self._conn.executemany(
+                    'INSERT INTO arm_value (context, arm, qvalue, count) VALUES (?, ?, ?, ?)',
+                    rows)
+                num_merged = self._conn.execute(
+                    'INSERT INTO arm_value (context, arm, qvalue, count) '
+                    'SELECT context, arm, reward_sum / count, count FROM online_value WHERE 1 '
+                    'ON CONFLICT (context, arm) DO UPDATE '
+                    'SET qvalue = (qvalue * count + excluded.qvalue * excluded.count) '
+                    '/ (count + excluded.count), count = count + excluded.count').rowcount
+                self._set_meta('arm_code_version', arm_code_version)
+                for key, value in meta.items():
+                    self._set_meta(key, value)
+            self._compact()
+        logger.info(f'Replaced model in {self.path} with {len(rows)} contextual arms, '
+                    f'merged online rewards of {num_merged}')
+
+    def _compact(self) -> None:
+        '''Fold the write-ahead log back into the db file, caller holds the lock'''
+        self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        self._num_writes = 0
+
+    def compact(self) -> None:
+        '''Fold the write-ahead log back into the db file'''
+        with self._lock:
+            self._compact()
+
+    def snapshot(self, path: str) -> None:
+        '''Atomically write a consistent copy of the model to path'''
+        tmp_path = f'{path}.tmp'
+        with self._lock:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            self._conn.execute('VACUUM INTO ?', (tmp_path,))
+        os.replace(tmp_path, path)
+        logger.info(f'Saved model snapshot {path}')
+
+    def close(self) -> None:
+        '''Compact and close the store'''
+        with self._lock:
+            self._compact()
+            self._conn.close()
+
+
+def import_pickle(store: ModelStore, pkl_file: str) -> bool:
+    '''Import a pickled model, e.g. from the training notebook, if it changed since last time'''
+    if not os.path.exists(pkl_file):
+        return False
+    mtime = os.path.getmtime(pkl_file)
+    imported_mtime = store.get_meta('pickle_mtime')
+    if imported_mtime is not None and float(imported_mtime) >= mtime:
+        return False
+
+    with open(pkl_file, 'rb') as f:
+        data = pickle.load(f)
+    logger.info(f'Importing a contextual MAB from model file {pkl_file}')
+    if data.get('arm_code_version') != ARM_CODE_VERSION:
+        logger.warning(f'Model file {pkl_file} was trained with arm code version '
+                       f'{data.get("arm_code_version")}, expected {ARM_CODE_VERSION}')
+    store.replace(data['qvalues'], data['counts'], data.get('arm_code_version'),
+                  pickle_mtime=mtime)
+    return True
@@ -0,0 +1,159 @@
+'''Report engine aggregating a cached weekly dataset in pandas'''
+from datetime import datetime
+
+from sqlalchemy import Select, func, select
+from sqlalchemy.orm import Session
+import pandas as pd
+
+from happiness.tasks.frames import read_frame
+from happiness.tasks.model import Task, TaskSummary, WorkLog
+from happiness.tasks.reportcache import ReportCache, ReportDataset
+from happiness.tasks.reportengine import ReportEngineInterface
+from happiness.tasks.rollups import MAX_WORKLOG_SECONDS
+from happiness.tasks.timeutils import to_db_ts
+
+WORKLOG_DTYPES = {'task_id': 'int64', 'type': 'category',
+                  'priority': 'category', 'complexity': 'category'}
+COMPLETION_DTYPES = {'task_id': 'Int64'}
+
+
+def worklogs_query(start_date: datetime, end_date: datetime) -> Select:
+    '''Closed worklogs started between the two dates with their task attributes'''
+    return select(
+        WorkLog.task_id, WorkLog.start_ts, WorkLog.end_ts,
+        Task.type, Task.priority, Task.complexity
+    ).join(
+        Task, Task.id == WorkLog.task_id
+    ).where(
+        WorkLog.start_ts >= to_db_ts(start_date),
+        WorkLog.start_ts < to_db_ts(end_date),
+        WorkLog.end_ts.is_not(None)
+    )
+
+
+def completions_query(start_date: datetime, end_date: datetime) -> Select:
+    '''Task summaries that ended between the two dates'''
+    return select(
+        TaskSummary.task_id, TaskSummary.start_date, TaskSummary.end_date
+    ).where(
+        TaskSummary.has_ended == 1,
+        TaskSummary.end_date >= to_db_ts(start_date),
+        TaskSummary.end_date < to_db_ts(end_date)
+    )
+
+
+class PandasReportEngine(ReportEngineInterface):
+    '''Loads raw rows once per date range and aggregates them in pandas'''
+    def __init__(self, db_session: Session, cache_size: int = 16):
+        '''Init'''
+        self._db_session = db_session
+        self._cache = ReportCache(cache_size)
+
+    def _load_worklogs(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Load closed worklogs started between the two dates with their task attributes'''
+        df = read_frame(self._db_session.connection(), worklogs_query(start_date, end_date),
+                        WORKLOG_DTYPES, ['start_ts', 'end_ts'], start_date.tzinfo)
+        df['seconds_worked'] = (df['end_ts'] - df['start_ts']).dt.total_seconds()
+        df['task_date'] = df['start_ts'].dt.tz_localize(None).dt.normalize()
+        return df
+
+    def _has_open_worklogs(self, start_date: datetime, end_date: datetime) -> bool:
+        '''Whether a worklog started between the two dates is still open'''
+        stmt = select(func.count()).select_from(WorkLog).where(
+            WorkLog.start_ts >= to_db_ts(start_date),
+            WorkLog.start_ts < to_db_ts(end_date),
+            WorkLog.end_ts.is_(None)
+        )
+        return self._db_session.execute(stmt).scalar_one() > 0
+
+    def _load_completions(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Load tasks completed between the two dates'''
+        df = read_frame(self._db_session.connection(), completions_query(start_date, end_date),
+                        COMPLETION_DTYPES, ['start_date', 'end_date'], start_date.tzinfo)
+        df['task_date'] = df['start_date'].dt.tz_localize(None).dt.normalize()
+        return df
+
+    def get_dataset(self, start_date: datetime, end_date: datetime) -> ReportDataset:
+        '''Get the (cached) dataset all reports for the date range are computed from'''
+        def build() -> ReportDataset:
+            # checked before loading, so a worklog closed in between is loaded
+            has_open_worklogs = self._has_open_worklogs(start_date, end_date)
+            return ReportDataset(
+                start_date, end_date,
+                self._load_worklogs(start_date, end_date),
+                self._load_completions(start_date, end_date),
+                has_open_worklogs
+            )
+        return self._cache.get(start_date, end_date, build)
+
+    def invalidate(self, ts: datetime) -> None:
+        '''Invalidate cached datasets affected by a worklog/summary write at ts'''
+        self._cache.invalidate(ts)
+
+    @staticmethod
+    def _get_task_switch_count(worklogs: pd.DataFrame) -> pd.DataFrame:
+        '''Count task switches by day'''
+        df = worklogs.sort_values('start_ts')
+        prev_task = df.groupby('task_date')['task_id'].shift()
+        df = df.assign(switched=prev_task.notna() & (df['task_id'] != prev_task))
+        switches = df[df['switched']].groupby('task_date').size()
+        return switches.rename('task_switches').reset_index()
+
+    @staticmethod
+    def _get_avg_task_time(worklogs: pd.DataFrame) -> pd.DataFrame:
+        '''Get avg time spent on tasks per day'''
+        df = worklogs[worklogs['seconds_worked'] <= MAX_WORKLOG_SECONDS]
+        df = df.assign(minutes_worked=df['seconds_worked'] / 60)
+        return df.groupby('task_date')['minutes_worked'].mean().reset_index()
+
+    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
+        '''Get a worklog summary between the two given dates'''
+        df = self.get_dataset(start_date, end_date).worklogs
+        df = df[df['seconds_worked'] <= MAX_WORKLOG_SECONDS]
+        summary = (df['seconds_worked'] / 3600).groupby(
+            [df['task_date'].dt.date.rename('start_date'), df['type']], observed=True).sum()
+        return summary.to_dict()
+
+    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get task completion counts by day of week + hour of day'''
+        end_dates = self.get_dataset(start_date, end_date).completions['end_date']
+        counts = pd.DataFrame({
+            'day_of_week': end_dates.dt.weekday,
+            'hour_of_day': end_dates.dt.hour
+        }).value_counts().rename('task_count').reset_index()
+        return counts.to_dict('records')
+
+    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get worklog splits by complexity and priority'''
+        df = self.get_dataset(start_date, end_date).worklogs
+        grouped = df.groupby(['priority', 'complexity'], observed=True)['seconds_worked'].sum()
+        return [(priority, complexity, total_time)
+                for (priority, complexity), total_time in grouped.items()]
+
+    def get_focus_summary(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Summarize focus by day as avg time worked per task and number of task switches'''
+        worklogs = self.get_dataset(start_date, end_date).worklogs
+        df_switches = self._get_task_switch_count(worklogs)
+        df_avg = self._get_avg_task_time(worklogs)
+        df_merged = df_switches.merge(df_avg, on='task_date')
+        return df_merged.fillna(0)
+
+    def get_completion_analysis(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Get task completion stats with total tasks and avg time spent'''
+        dataset = self.get_dataset(start_date, end_date)
+        worklogs = dataset.worklogs[dataset.worklogs['seconds_worked'] <= MAX_WORKLOG_SECONDS]
+        completions = dataset.completions[dataset.completions['start_date'] >= start_date]
+        worklog_summary = worklogs.groupby('task_date').agg(
+            total_tasks=('task_id', 'nunique'),  # Count unique tasks per day
+            avg_time_per_task=('seconds_worked', lambda x: (x / 60).mean())  # Convert to minutes
+        ).reset_index()
+        completion_summary = completions[
+            completions['task_date'] == completions['end_date'].dt.tz_localize(None).dt.normalize()
+            ].groupby('task_date').agg(
+                completed_tasks=('task_id', 'count')
+            ).reset_index()
+        df_merged = worklog_summary.merge(completion_summary, on='task_date')
+        df_merged['completion_pct'] = (
+            df_merged['completed_tasks'] / df_merged['total_tasks']
+        ) * 100
+        return df_merged.head(7) # hack
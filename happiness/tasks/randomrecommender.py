@@ -1,21 +1,24 @@
 '''A random recommender for tasks'''
-import random
-from typing import List
+from typing import List, Optional
 
+from happiness.tasks.armindex import ArmIndex
 from happiness.tasks.recommender import TaskRecommenderInterface
-from happiness.tasks.task import TaskWrapper
 
 
 class RandomRecommender(TaskRecommenderInterface):
     '''Random Recommender'''
-    def recommend_tasks(self, tasks: List[TaskWrapper], num_tasks: int) -> List[TaskWrapper]:
-        '''Recommend random tasks'''
-        return random.sample(tasks, num_tasks)
+    def recommend_from_index(self, arm_index: ArmIndex, num_tasks: int) -> List[int]:
+        '''Recommend random task ids'''
+        return arm_index.sample_tasks(num_tasks)
 
     def update_chosen_task(self, task_id: int) -> None:
         '''Callback for when the given task is chosen'''
         return
 
+    def update_shown_tasks(self, task_ids: List[int], chosen_task_id: Optional[int]) -> None:
+        '''Callback for the shown tasks of a round'''
+        return
+
     def load(self):
         '''Load/reload - NOOP for now'''
         return
@@ -1,19 +1,23 @@
 '''Task Recommender Interface'''
 from abc import ABC, abstractmethod
-from typing import List
+from typing import List, Optional
 
-from happiness.tasks.task import TaskWrapper
+from happiness.tasks.armindex import ArmIndex
 
 class TaskRecommenderInterface(ABC):
     '''Task Recommender Interface'''
     @abstractmethod
-    def recommend_tasks(self, tasks: List[TaskWrapper], num_tasks: int) -> List[TaskWrapper]:
-        '''Recommend tasks based on user's mood'''
+    def recommend_from_index(self, arm_index: ArmIndex, num_tasks: int) -> List[int]:
+        '''Recommend task ids drawn from an arm index'''
 
     @abstractmethod
     def update_chosen_task(self, task_id: int) -> None:
         '''Callback after a task is chosen'''
 
+    @abstractmethod
+    def update_shown_tasks(self, task_ids: List[int], chosen_task_id: Optional[int]) -> None:
+        '''Callback for a round of which only task_ids were shown, the rest is not rewarded'''
+
     @abstractmethod
     def load(self):
         '''Load/reload models as needed'''
@@ -0,0 +1,97 @@
+'''Recurrence statistics of tasks, maintained incrementally as task summaries start'''
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+from loguru import logger
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+from happiness.tasks.model import TaskRecurrence, TaskSummary
+
+# The next schedule date is the mean interval between this many latest starts
+RECENT_STARTS = 10
+_SECONDS_PER_DAY = 24 * 3600
+
+
+def _to_utc(ts: datetime) -> datetime:
+    '''Naive utc timestamp of a db timestamp (naive means utc) or an aware one'''
+    if ts.tzinfo is not None:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def _interval_days(start: datetime, end: datetime) -> float:
+    '''Days between two timestamps, as sqlite's julianday difference'''
+    return (_to_utc(end) - _to_utc(start)).total_seconds() / _SECONDS_PER_DAY
+
+
+def _encode(intervals: List[float]) -> str:
+    '''Stored form of the recent intervals, oldest first'''
+    return ','.join(repr(interval) for interval in intervals[-(RECENT_STARTS - 1):])
+
+
+def _decode(recent_intervals: str) -> List[float]:
+    '''Recent intervals of their stored form'''
+    return [float(interval) for interval in recent_intervals.split(',') if interval]
+
+
+class TaskRecurrences:
+    '''Last start and the intervals between the latest starts of every task
+
+    A summary starts each time a task is worked on after it was finished, so
+    the intervals between summary starts measure how often a repeatable task
+    recurs. Recording a start and reading the mean only touch the one row of
+    the task, instead of scanning all of its summaries.
+    '''
+    def __init__(self, db_session: Session):
+        '''Init'''
+        self._db_session = db_session
+
+    def record_start(self, task_id: int, start_date: datetime) -> None:
+        '''Fold the start of a new task summary into the task's recurrence row'''
+        row = self._db_session.get(TaskRecurrence, task_id)
+        if row is None:
+            self._db_session.add(TaskRecurrence(
+                task_id=task_id, last_start=_to_utc(start_date), recent_intervals=''))
+            return
+        intervals = _decode(row.recent_intervals)
+        intervals.append(_interval_days(row.last_start, start_date))
+        row.recent_intervals = _encode(intervals)
+        row.last_start = _to_utc(start_date)
+
+    def get_mean_interval(self, task_id: int) -> Optional[float]:
+        '''Mean days between the latest starts of a task, None before its second start'''
+        recent_intervals = self._db_session.execute(
+            select(TaskRecurrence.recent_intervals).where(TaskRecurrence.task_id == task_id)
+        ).scalar_one_or_none()
+        intervals = _decode(recent_intervals or '')
+        return sum(intervals) / len(intervals) if intervals else None
+
+    def backfill(self) -> None:
+        '''Rebuild the recurrence rows from the task summaries'''
+        backfill_recurrences(self._db_session.connection())
+        self._db_session.commit()
+
+
+def backfill_recurrences(conn: Connection) -> None:
+    '''Rebuild every task's recurrence row from its latest task summaries'''
+    rank = func.row_number().over(partition_by=TaskSummary.task_id,
+                                  order_by=TaskSummary.start_date.desc()).label('rank')
+    latest = select(TaskSummary.task_id, TaskSummary.start_date, rank).subquery()
+    rows = conn.execute(select(latest.c.task_id, latest.c.start_date)
+                        .where(latest.c.rank <= RECENT_STARTS)
+                        .order_by(latest.c.task_id, latest.c.start_date))
+
+    starts: Dict[int, List[datetime]] = {}
+    for row in rows:
+        starts.setdefault(row.task_id, []).append(row.start_date)
+    conn.execute(delete(TaskRecurrence))
+    if starts:
+        conn.execute(insert(TaskRecurrence), [{
+            'task_id': task_id,
+            'last_start': _to_utc(task_starts[-1]),
+            'recent_intervals': _encode([_interval_days(start, end)
+                                         for start, end in zip(task_starts, task_starts[1:])]),
+        } for task_id, task_starts in starts.items()])
+    logger.info(f'Backfilled recurrence statistics of {len(starts)} tasks')
@@ -0,0 +1,92 @@
+'''Week keyed cache of report datasets'''
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Tuple
+import threading
+
+from loguru import logger
+import pandas as pd
+
+
+class ReportDataset:
+    '''Raw rows backing all reports for one date range'''
+    def __init__(self, start_date: datetime, end_date: datetime,
+                 worklogs: pd.DataFrame, completions: pd.DataFrame,
+                 has_open_worklogs: bool = False):
+        '''Initialize dataset
+
+        worklogs: closed work logs joined with their task attributes
+        completions: ended task summaries with an end date in range
+        has_open_worklogs: a work log started in range was still open
+        '''
+        self.start_date = start_date
+        self.end_date = end_date
+        self.worklogs = worklogs
+        self.completions = completions
+        self.has_open_worklogs = has_open_worklogs
+
+
+class ReportCache:
+    '''LRU cache of report datasets keyed by date range
+
+    Datasets with open work logs are not cached: the work log joins the range
+    it started in once it is closed, possibly after that range ended, which
+    invalidating by the time of the write would miss.
+    '''
+    def __init__(self, max_size: int = 16):
+        '''Initialize cache'''
+        self._max_size = max_size
+        self._datasets = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    @staticmethod
+    def _key(start_date: datetime, end_date: datetime) -> Tuple[float, float]:
+        '''Cache key for a date range'''
+        return start_date.timestamp(), end_date.timestamp()
+
+    def get(self, start_date: datetime, end_date: datetime,
+            builder: Callable[[], ReportDataset]) -> ReportDataset:
+        '''Get the dataset for the range, building it at most once'''
+        key = self._key(start_date, end_date)
+        with self._lock:
+            dataset = self._datasets.get(key)
+            if dataset is not None:
+                self._datasets.move_to_end(key)
+                return dataset
+            build_lock = self._build_locks.setdefault(key, threading.Lock())
+
+        # concurrent callbacks for the same week wait for a single build
+        with build_lock:
+            with self._lock:
+                dataset = self._datasets.get(key)
+            if dataset is None:
+                logger.debug(f'Building report dataset for {start_date} - {end_date}')
+                dataset = builder()
+                if not dataset.has_open_worklogs:
+                    with self._lock:
+                        self._datasets[key] = dataset
+                        while len(self._datasets) > self._max_size:
+                            self._datasets.popitem(last=False)
+
+        with self._lock:
+            self._build_locks.pop(key, None)
+        return dataset
+
+    def invalidate(self, ts: datetime) -> None:
+        '''Drop datasets whose range covers a write at the given time
+
+        Ranges that ended before ts cannot change, so past weeks stay cached.
+        '''
+        point = ts.timestamp()
+        with self._lock:
+            stale = [key for key in self._datasets if key[0] <= point < key[1]]
+            for key in stale:
+                del self._datasets[key]
+        if stale:
+            logger.debug(f'Invalidated {len(stale)} report datasets')
+
+    def clear(self) -> None:
+        '''Drop all datasets'''
+        with self._lock:
+            self._datasets.clear()
@@ -0,0 +1,32 @@
+'''Report Engine Interface'''
+from abc import ABC, abstractmethod
+from datetime import datetime
+
+import pandas as pd
+
+
+class ReportEngineInterface(ABC):
+    '''Computes the report aggregates for a date range'''
+    @abstractmethod
+    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
+        '''Hours worked keyed by (local date, task type)'''
+
+    @abstractmethod
+    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
+        '''Completed task counts by day of week + hour of day'''
+
+    @abstractmethod
+    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
+        '''Seconds worked by (priority, complexity)'''
+
+    @abstractmethod
+    def get_focus_summary(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Avg minutes per work log and task switches by day'''
+
+    @abstractmethod
+    def get_completion_analysis(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Tasks worked, avg time per task and completion pct by day'''
+
+    def invalidate(self, ts: datetime) -> None:
+        '''Callback after worklogs or summaries were written at ts'''
+        return
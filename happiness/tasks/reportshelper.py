@@ -1,114 +1,69 @@
 '''Helper to query data for reports'''
-from datetime import datetime
+from datetime import datetime, timezone
 
-from sqlalchemy import func, text
 from sqlalchemy.orm import Session
-
 import pandas as pd
 
-from happiness.tasks.model import TaskSummary, WorkLog
+from happiness.tasks.counters import REPORT_CHANGES, read_counter
+from happiness.tasks.pandasreportengine import PandasReportEngine
+from happiness.tasks.rollupreportengine import RollupReportEngine
+from happiness.tasks.sqlreportengine import SqlReportEngine
+
+REPORT_ENGINES = {
+    'pandas': PandasReportEngine,
+    'sql': SqlReportEngine,
+    'rollup': RollupReportEngine
+}
 
 
 class ReportsHelper:
     '''Class to query data for reports'''
-    def __init__(self, db_session: Session):
-        '''Init'''
+    def __init__(self, db_session: Session, engine: str = 'rollup'):
+        '''Init with the name of the aggregation engine to use'''
+        if engine not in REPORT_ENGINES:
+            raise ValueError(f'Unknown report engine {engine}, '
+                             f'expected one of {list(REPORT_ENGINES)}')
         self._db_session = db_session
+        self._engine = REPORT_ENGINES[engine](db_session)
+        self._reports_version = None # REPORT_CHANGES counter the cached data is up to date with
+
+    def invalidate(self, ts: datetime) -> None:
+        '''Invalidate cached report data affected by a worklog/summary write at ts
 
-    def _get_worklogs(self, start_ts: int, end_ts: int) -> pd.DataFrame:
-        '''Query worklogs between the two dates'''
-        worklogs = self._db_session.query(WorkLog).filter(
-            func.strftime('%s', WorkLog.start_ts) >= str(start_ts),
-            func.strftime('%s', WorkLog.end_ts) < str(end_ts)
-        ).all()
-        data = [{
-            'start_ts': worklog.start_ts,
-            'end_ts': worklog.end_ts,
-            'task_id': worklog.task_id
-        } for worklog in worklogs]
-        df = pd.DataFrame(data)
+        The repository bumps REPORT_CHANGES in the transaction of the write,
+        so every app process, this one included, also syncs on its next report.
+        '''
+        self._engine.invalidate(ts)
 
-        df['seconds_worked'] = (df['end_ts'] - df['start_ts']).dt.total_seconds()
-        df = df[df['seconds_worked'] <= (3 * 3600)]
-        df['task_date'] = df['start_ts'].dt.date
-        df['task_date'] = pd.to_datetime(df['task_date'])
-        return df
+    def _sync(self) -> None:
+        '''Invalidate cached report data if another process wrote since it was cached'''
+        version = read_counter(self._db_session.connection(), REPORT_CHANGES)
+        if version != self._reports_version:
+            if self._reports_version is not None: # their writes happened about now
+                self._engine.invalidate(datetime.now(timezone.utc))
+            self._reports_version = version
 
-    def _get_task_completions(self, start_ts: int, end_ts: int) -> pd.DataFrame:
-        '''Get completed tasks between the given dates'''
-        summaries = self._db_session.query(TaskSummary).filter(
-            func.strftime('%s', TaskSummary.start_date) >= str(start_ts),
-            func.strftime('%s', TaskSummary.end_date) < str(end_ts),
-            TaskSummary.has_ended == 1
-        ).all()
-        df = pd.DataFrame([row.__dict__ for row in summaries])
-        df.drop(columns=["_sa_instance_state"], inplace=True)
-        df['task_date'] = df['start_date'].dt.date
-        df['task_date'] = pd.to_datetime(df['task_date'])
-        return df
+    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
+        '''Get a worklog summary between the two given dates'''
+        self._sync()
+        return self._engine.get_worklog_summary(start_date, end_date)
 
-    def _get_task_switch_count(self, start_ts: int, end_ts: int) -> pd.DataFrame:
-        '''Count task switches by day'''
-        query = f'''
-            WITH OrderedTasks AS (
-                SELECT
-                    task_id,
-                    start_ts,
-                    end_ts,
-                    DATE(start_ts) AS task_date,
-                    LAG(task_id) OVER (PARTITION BY DATE(start_ts) ORDER BY start_ts) AS prev_task
-                FROM work_log
-                WHERE strftime('%s', start_ts) >= '{start_ts}'
-                AND strftime('%s', end_ts) < '{end_ts}'
-            )
-            SELECT
-                task_date,
-                COUNT(*) AS task_switches
-            FROM OrderedTasks
-            WHERE task_id <> prev_task  -- Only count when task_id changes
-            GROUP BY task_date
-            ORDER BY task_date
-        '''
-        result = self._db_session.execute(text(query)).all()
-        return pd.DataFrame(result)
+    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get task completion counts by day of week + hour of day between given date range'''
+        self._sync()
+        return self._engine.get_task_completion_summary(start_date, end_date)
 
-    def _get_avg_task_time(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
-        '''Get avg time spent on tasks between the two given dates'''
-        df = self._get_worklogs(start_date, end_date)
-        df['task_date'] = df['start_ts'].dt.date
-        df['minutes_worked'] = df['seconds_worked'] / 60
-        grouped = df.groupby(['task_date'])['minutes_worked'].mean().reset_index()
-        return grouped
+    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get worklog splits by complexity and priority'''
+        self._sync()
+        return self._engine.get_worklog_splits(start_date, end_date)
 
     def get_focus_summary(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
         '''Summarize focus by day as avg time worked per task and number of task switches'''
-        start_ts = int(start_date.timestamp())
-        end_ts = int(end_date.timestamp())
-
-        df_switches = self._get_task_switch_count(start_ts, end_ts)
-        df_avg = self._get_avg_task_time(start_ts, end_ts)
-        df_avg['task_date'] = pd.to_datetime(df_avg['task_date'])
-        df_switches['task_date'] = pd.to_datetime(df_switches['task_date'])
-        df_merged = df_switches.merge(df_avg, on='task_date')
-        return df_merged.fillna(0)
+        self._sync()
+        return self._engine.get_focus_summary(start_date, end_date)
 
     def get_completion_analysis(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
         '''Get task completion stats with total tasks and avg time spent'''
-        start_ts = int(start_date.timestamp())
-        end_ts = int(end_date.timestamp())
-        worklogs = self._get_worklogs(start_ts, end_ts)
-        completions = self._get_task_completions(start_ts, end_ts)
-        worklog_summary = worklogs.groupby('task_date').agg(
-            total_tasks=('task_id', 'nunique'),  # Count unique tasks per day
-            avg_time_per_task=('seconds_worked', lambda x: (x / 60).mean())  # Convert to minutes
-        ).reset_index()
-        completion_summary = completions[
-            completions['task_date'] == completions['end_date'].dt.date
-            ].groupby('task_date').agg(
-                completed_tasks=('task_id', 'count')
-            ).reset_index()
-        df_merged = worklog_summary.merge(completion_summary, on='task_date')
-        df_merged['completion_pct'] = (
-            df_merged['completed_tasks'] / df_merged['total_tasks']
-        ) * 100
-        return df_merged.head(7) # hack
+        self._sync()
+        return self._engine.get_completion_analysis(start_date, end_date)
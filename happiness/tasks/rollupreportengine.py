@@ -0,0 +1,80 @@
+'''Report engine reading the incrementally maintained daily rollups'''
+from collections import defaultdict
+from datetime import datetime
+
+from sqlalchemy import func
+import pandas as pd
+
+from happiness.tasks.model import (DailySplitRollup, DailySwitchRollup, DailyTypeRollup,
+                                   HourlyCompletionRollup)
+from happiness.tasks.rollups import day_range
+from happiness.tasks.sqlreportengine import SqlReportEngine
+
+
+class RollupReportEngine(SqlReportEngine):
+    '''Reads daily rollups, falls back to sql aggregation for completion analysis'''
+    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
+        '''Get a worklog summary between the two given dates'''
+        start_day, end_day = day_range(start_date, end_date)
+        rows = self._db_session.query(
+            DailyTypeRollup.day, DailyTypeRollup.type, DailyTypeRollup.seconds_worked
+        ).filter(
+            DailyTypeRollup.day >= start_day,
+            DailyTypeRollup.day < end_day,
+            DailyTypeRollup.type.is_not(None)
+        ).all()
+        return {(day, task_type): seconds / 3600 for day, task_type, seconds in rows}
+
+    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get task completion counts by day of week + hour of day between given date range'''
+        start_day, end_day = day_range(start_date, end_date)
+        rows = self._db_session.query(
+            HourlyCompletionRollup.day, HourlyCompletionRollup.hour,
+            HourlyCompletionRollup.num_completed
+        ).filter(
+            HourlyCompletionRollup.day >= start_day,
+            HourlyCompletionRollup.day < end_day
+        ).all()
+        counts = defaultdict(int)
+        for day, hour, num_completed in rows:
+            counts[(day.weekday(), hour)] += num_completed
+        return [{'day_of_week': day_of_week, 'hour_of_day': hour_of_day, 'task_count': count}
+                for (day_of_week, hour_of_day), count in counts.items()]
+
+    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get worklog splits by complexity and priority'''
+        start_day, end_day = day_range(start_date, end_date)
+        data = self._db_session.query(
+            DailySplitRollup.priority, DailySplitRollup.complexity,
+            func.sum(DailySplitRollup.seconds_worked).label('total_time')
+        ).filter(
+            DailySplitRollup.day >= start_day,
+            DailySplitRollup.day < end_day
+        ).group_by(
+            DailySplitRollup.priority, DailySplitRollup.complexity
+        ).all()
+        return data
+
+    def get_focus_summary(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Summarize focus by day as avg time worked per task and number of task switches'''
+        start_day, end_day = day_range(start_date, end_date)
+        switches = self._db_session.query(
+            DailySwitchRollup.day, DailySwitchRollup.task_switches
+        ).filter(
+            DailySwitchRollup.day >= start_day,
+            DailySwitchRollup.day < end_day,
+            DailySwitchRollup.task_switches > 0
+        ).all()
+        avg_times = self._db_session.query(
+            DailyTypeRollup.day,
+            (func.sum(DailyTypeRollup.seconds_worked) / 60.0 /
+             func.sum(DailyTypeRollup.num_worklogs)).label('minutes_worked')
+        ).filter(
+            DailyTypeRollup.day >= start_day,
+            DailyTypeRollup.day < end_day
+        ).group_by(DailyTypeRollup.day).all()
+        df_switches = pd.DataFrame(switches, columns=['task_date', 'task_switches'])
+        df_avg = pd.DataFrame(avg_times, columns=['task_date', 'minutes_worked'])
+        df_merged = df_switches.merge(df_avg, on='task_date')
+        df_merged['task_date'] = pd.to_datetime(df_merged['task_date'])
+        return df_merged.fillna(0)
@@ -0,0 +1,141 @@
+'''Daily report rollups, maintained incrementally as work logs close'''
+from datetime import datetime, timezone
+
+from loguru import logger
+from sqlalchemy import delete, insert, select
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+import pandas as pd
+import tzlocal
+
+from happiness.tasks.frames import read_frame
+from happiness.tasks.model import (DailySplitRollup, DailySwitchRollup, DailyTypeRollup,
+                                   HourlyCompletionRollup, Task, TaskSummary, WorkLog)
+
+# work logs longer than this are treated as forgotten timers in time based reports
+MAX_WORKLOG_SECONDS = 3 * 3600
+
+ROLLUP_MODELS = [DailyTypeRollup, DailySplitRollup, DailySwitchRollup, HourlyCompletionRollup]
+
+
+def _to_local(ts: datetime) -> datetime:
+    '''Convert a db timestamp (naive means utc) to local time'''
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.astimezone(tzlocal.get_localzone())
+
+
+class ReportRollups:
+    '''Incremental maintenance of the daily rollup tables'''
+    def __init__(self, db_session: Session):
+        '''Init'''
+        self._db_session = db_session
+
+    def _get_or_create(self, model, defaults: dict, **keys):
+        '''Get the rollup row for the given keys, adding a new one if missing'''
+        row = self._db_session.query(model).filter_by(**keys).first()
+        if row is None:
+            row = model(**keys, **defaults)
+            self._db_session.add(row)
+        return row
+
+    def record_worklog(self, work_log: WorkLog, task: Task) -> None:
+        '''Fold a closed work log into the daily rollups'''
+        day = _to_local(work_log.start_ts).date()
+        seconds = int((work_log.end_ts - work_log.start_ts).total_seconds())
+
+        if seconds <= MAX_WORKLOG_SECONDS:
+            type_row = self._get_or_create(
+                DailyTypeRollup, {'seconds_worked': 0, 'num_worklogs': 0},
+                day=day, type=task.type)
+            type_row.seconds_worked += seconds
+            type_row.num_worklogs += 1
+
+        split_row = self._get_or_create(
+            DailySplitRollup, {'seconds_worked': 0},
+            day=day, priority=task.priority, complexity=task.complexity)
+        split_row.seconds_worked += seconds
+
+        # only one task runs at a time, so logs close in start order
+        switch_row = self._get_or_create(
+            DailySwitchRollup, {'task_switches': 0}, day=day)
+        if switch_row.last_task_id is not None and switch_row.last_task_id != task.id:
+            switch_row.task_switches += 1
+        switch_row.last_task_id = task.id
+
+    def record_completion(self, task_summary: TaskSummary) -> None:
+        '''Fold a finished task summary into the completion rollup'''
+        end_date = _to_local(task_summary.end_date)
+        row = self._get_or_create(
+            HourlyCompletionRollup, {'num_completed': 0},
+            day=end_date.date(), hour=end_date.hour)
+        row.num_completed += 1
+
+    def backfill(self) -> None:
+        '''Rebuild all rollups from the raw tables'''
+        backfill_rollups(self._db_session.connection())
+        self._db_session.commit()
+
+
+def _records(df: pd.DataFrame) -> list:
+    '''Dataframe rows as dicts with python scalars, NaN as None'''
+    return df.astype(object).where(df.notna(), None).to_dict('records')
+
+
+def backfill_rollups(conn: Connection) -> None:
+    '''Recompute every rollup table from work_log and task_summary'''
+    for model in ROLLUP_MODELS:
+        conn.execute(delete(model.__table__))
+
+    local_tz = tzlocal.get_localzone()
+    df = read_frame(conn, select(
+        WorkLog.task_id, WorkLog.start_ts, WorkLog.end_ts,
+        Task.type, Task.priority, Task.complexity
+    ).join(
+        Task, Task.id == WorkLog.task_id
+    ).where(
+        WorkLog.end_ts.is_not(None)
+    ), {'task_id': 'int64'}, ['start_ts', 'end_ts'], local_tz)
+    df['day'] = df['start_ts'].dt.date
+    df['seconds_worked'] = (df['end_ts'] - df['start_ts']).dt.total_seconds().astype(int)
+
+    type_rollup = df[df['seconds_worked'] <= MAX_WORKLOG_SECONDS].groupby(
+        ['day', 'type'], dropna=False).agg(
+            seconds_worked=('seconds_worked', 'sum'),
+            num_worklogs=('task_id', 'count')
+        ).reset_index()
+    split_rollup = df.groupby(
+        ['day', 'priority', 'complexity'], dropna=False
+    )['seconds_worked'].sum().reset_index()
+
+    df = df.sort_values('start_ts')
+    prev_task = df.groupby('day')['task_id'].shift()
+    df['switched'] = prev_task.notna() & (df['task_id'] != prev_task)
+    switch_rollup = df.groupby('day').agg(
+        task_switches=('switched', 'sum'),
+        last_task_id=('task_id', 'last')
+    ).reset_index()
+
+    completions = read_frame(conn, select(
+        TaskSummary.end_date
+    ).where(
+        TaskSummary.has_ended == 1, TaskSummary.end_date.is_not(None)
+    ), ts_columns=['end_date'], tz=local_tz)
+    completions['day'] = completions['end_date'].dt.date
+    completions['hour'] = completions['end_date'].dt.hour
+    completion_rollup = completions.groupby(['day', 'hour']).size().rename(
+        'num_completed').reset_index()
+
+    for model, rollup in [(DailyTypeRollup, type_rollup), (DailySplitRollup, split_rollup),
+                          (DailySwitchRollup, switch_rollup),
+                          (HourlyCompletionRollup, completion_rollup)]:
+        if not rollup.empty:
+            conn.execute(insert(model.__table__), _records(rollup))
+    logger.info(f'Backfilled rollups from {len(df)} work logs and '
+                f'{len(completions)} completions')
+
+
+def day_range(start_date: datetime, end_date: datetime) -> tuple:
+    '''Local day bounds [start, end) for a date range'''
+    return _to_local(start_date).date(), _to_local(end_date).date()
+
@@ -0,0 +1,116 @@
+'''Precomputed ranked arm slates per context, refreshed in the background'''
+from collections import deque
+from typing import Callable, Deque, List, Optional
+import threading
+import time
+
+from loguru import logger
+
+# A builder gets a context and returns one slate of it, a ranking of every
+# indexed arm, best first
+SlateBuilder = Callable[[int], List[int]]
+
+
+class SlatePool:
+    '''Serves ranked arm slates per context, rebuilding stale ones on a background thread
+
+    Contexts only change every few hours, so the ranking of the arms is
+    computed off the request path and a request just walks the first arms of
+    a slate. A context goes stale when it is invalidated (e.g. the indexed
+    arms changed) or its q-values drifted by more than drift_threshold since
+    its slates were built. The previous slates are served until the rebuilt
+    ones land. With consume, every slate is handed out once, as Thompson
+    draws must be, and the pool is refilled once it runs half empty.
+    '''
+    def __init__(self, num_contexts: int, build: SlateBuilder, slates_per_context: int = 1,
+                 drift_threshold: float = 0.05, consume: bool = False):
+        '''Initialize an empty pool and start the refresh thread'''
+        self._build = build
+        self._slates_per_context = slates_per_context
+        self._drift_threshold = drift_threshold
+        self._consume = consume
+        self._slates: List[Deque[List[int]]] = [deque() for _ in range(num_contexts)]
+        self._drift = [0.0] * num_contexts
+        self._stale = [True] * num_contexts
+        self._generation = [0] * num_contexts # bumped by invalidations during a build
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='slate-pool', daemon=True)
+        self._thread.start()
+
+    def get(self, ctx: int) -> Optional[List[int]]:
+        '''Slate of a context, None until one was built or while a consumed pool is empty'''
+        with self._lock:
+            slates = self._slates[ctx]
+            if not slates:
+                slate = None
+            elif self._consume:
+                slate = slates.popleft()
+                if len(slates) * 2 < self._slates_per_context:
+                    self._stale[ctx] = True
+            else:
+                slate = slates[0]
+            if self._stale[ctx]:
+                self._wake.set()
+        return slate
+
+    def invalidate(self, ctx: Optional[int] = None) -> None:
+        '''Rebuild the slates of a context, or of all contexts'''
+        with self._lock:
+            for idx in range(len(self._slates)) if ctx is None else [ctx]:
+                self._stale[idx] = True
+                self._generation[idx] += 1
+        self._wake.set()
+
+    def add_drift(self, ctx: int, drift: float) -> None:
+        '''Record a q-value change of a context, invalidating it past the threshold'''
+        with self._lock:
+            self._drift[ctx] += drift
+            if self._drift[ctx] <= self._drift_threshold:
+                return
+        self.invalidate(ctx)
+
+    def close(self) -> None:
+        '''Stop the refresh thread'''
+        if self._closed:
+            return
+        self._closed = True
+        self._wake.set()
+        self._thread.join()
+
+    def _refresh(self, ctx: int) -> bool:
+        '''Rebuild the slates of one context, returns True if it was invalidated meanwhile'''
+        with self._lock:
+            generation = self._generation[ctx]
+        slates = deque()
+        for _ in range(self._slates_per_context):
+            slate = self._build(ctx)
+            if not slate:
+                break
+            slates.append(slate)
+            time.sleep(0) # hand the GIL to waiting requests between slates
+        with self._lock:
+            self._slates[ctx] = slates
+            invalidated = self._generation[ctx] != generation
+            if not invalidated:
+                self._stale[ctx] = False
+                self._drift[ctx] = 0.0
+        logger.debug(f'Rebuilt {len(slates)} slates of context {ctx}')
+        return invalidated
+
+    def _run(self) -> None:
+        '''Refresh thread loop'''
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            if self._closed:
+                return
+            for ctx, stale in enumerate(list(self._stale)):
+                if not stale:
+                    continue
+                try:
+                    if self._refresh(ctx):
+                        self._wake.set()
+                except Exception as err: # keep the thread alive, the next get() retries
+                    logger.exception(f'Failed to rebuild slates of context {ctx}: {err}')
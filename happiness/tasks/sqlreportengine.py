@@ -0,0 +1,158 @@
+'''Report engine pushing all aggregations down into sqlite'''
+from datetime import date, datetime
+
+from sqlalchemy import DateTime, bindparam, text
+from sqlalchemy.orm import Session
+import pandas as pd
+
+from happiness.tasks.reportengine import ReportEngineInterface
+from happiness.tasks.rollups import MAX_WORKLOG_SECONDS
+from happiness.tasks.timeutils import to_db_ts
+
+# Closed work logs are attributed to the range and local day they started in.
+# Days and hours are bucketed with sqlite's 'localtime' modifier, i.e. the
+# timezone of the server process
+WORKLOGS_CTE = '''
+    worklogs AS (
+        SELECT
+            w.task_id,
+            w.start_ts,
+            t.type,
+            t.priority,
+            t.complexity,
+            DATE(w.start_ts, 'localtime') AS task_date,
+            (julianday(w.end_ts) - julianday(w.start_ts)) * 86400.0 AS seconds_worked
+        FROM work_log w
+        JOIN task t ON t.id = w.task_id
+        WHERE w.start_ts >= :start_ts
+        AND w.start_ts < :end_ts
+        AND w.end_ts IS NOT NULL
+    )
+'''
+
+
+class SqlReportEngine(ReportEngineInterface):
+    '''Runs GROUP BY queries so only aggregated rows leave the db'''
+    def __init__(self, db_session: Session):
+        '''Init'''
+        self._db_session = db_session
+
+    def _execute(self, query: str, start_date: datetime, end_date: datetime) -> list:
+        '''Run a report query bound to the given date range'''
+        stmt = text(query).bindparams(
+            bindparam('start_ts', type_=DateTime),
+            bindparam('end_ts', type_=DateTime)
+        )
+        return self._db_session.execute(stmt, {
+            'start_ts': to_db_ts(start_date),
+            'end_ts': to_db_ts(end_date),
+            'max_seconds': MAX_WORKLOG_SECONDS
+        }).all()
+
+    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
+        '''Get a worklog summary between the two given dates'''
+        rows = self._execute(f'''
+            WITH {WORKLOGS_CTE}
+            SELECT task_date, type, SUM(seconds_worked) / 3600.0 AS hours_worked
+            FROM worklogs
+            WHERE seconds_worked <= :max_seconds
+            AND type IS NOT NULL
+            GROUP BY task_date, type
+        ''', start_date, end_date)
+        return {(date.fromisoformat(task_date), task_type): hours
+                for task_date, task_type, hours in rows}
+
+    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get task completion counts by day of week + hour of day'''
+        rows = self._execute('''
+            SELECT
+                (CAST(strftime('%w', end_date, 'localtime') AS INTEGER) + 6) % 7 AS day_of_week,
+                CAST(strftime('%H', end_date, 'localtime') AS INTEGER) AS hour_of_day,
+                COUNT(*) AS task_count
+            FROM task_summary
+            WHERE has_ended = 1
+            AND end_date >= :start_ts
+            AND end_date < :end_ts
+            GROUP BY day_of_week, hour_of_day
+        ''', start_date, end_date)
+        return [row._asdict() for row in rows]
+
+    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
+        '''Get worklog splits by complexity and priority'''
+        return self._execute(f'''
+            WITH {WORKLOGS_CTE}
+            SELECT priority, complexity, SUM(seconds_worked) AS total_time
+            FROM worklogs
+            GROUP BY priority, complexity
+        ''', start_date, end_date)
+
+    def get_focus_summary(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Summarize focus by day as avg time worked per task and number of task switches'''
+        rows = self._execute(f'''
+            WITH {WORKLOGS_CTE},
+            ordered_tasks AS (
+                SELECT
+                    task_date,
+                    task_id,
+                    LAG(task_id) OVER (PARTITION BY task_date ORDER BY start_ts) AS prev_task
+                FROM worklogs
+            ),
+            switches AS (
+                SELECT task_date, COUNT(*) AS task_switches
+                FROM ordered_tasks
+                WHERE task_id <> prev_task  -- Only count when task_id changes
+                GROUP BY task_date
+            ),
+            avg_times AS (
+                SELECT task_date, AVG(seconds_worked) / 60.0 AS minutes_worked
+                FROM worklogs
+                WHERE seconds_worked <= :max_seconds
+                GROUP BY task_date
+            )
+            SELECT s.task_date, s.task_switches, a.minutes_worked
+            FROM switches s
+            JOIN avg_times a ON a.task_date = s.task_date
+            ORDER BY s.task_date
+        ''', start_date, end_date)
+        df = pd.DataFrame(rows, columns=['task_date', 'task_switches', 'minutes_worked'])
+        df['task_date'] = pd.to_datetime(df['task_date'])
+        return df.fillna(0)
+
+    def get_completion_analysis(self, start_date: datetime, end_date: datetime) -> pd.DataFrame:
+        '''Get task completion stats with total tasks and avg time spent'''
+        rows = self._execute(f'''
+            WITH {WORKLOGS_CTE},
+            worklog_summary AS (
+                SELECT
+                    task_date,
+                    COUNT(DISTINCT task_id) AS total_tasks,
+                    AVG(seconds_worked) / 60.0 AS avg_time_per_task
+                FROM worklogs
+                WHERE seconds_worked <= :max_seconds
+                GROUP BY task_date
+            ),
+            completion_summary AS (
+                SELECT DATE(start_date, 'localtime') AS task_date, COUNT(task_id) AS completed_tasks
+                FROM task_summary
+                WHERE has_ended = 1
+                AND end_date >= :start_ts
+                AND end_date < :end_ts
+                AND start_date >= :start_ts
+                AND DATE(start_date, 'localtime') = DATE(end_date, 'localtime')
+                GROUP BY DATE(start_date, 'localtime')
+            )
+            SELECT
+                w.task_date,
+                w.total_tasks,
+                w.avg_time_per_task,
+                c.completed_tasks,
+                c.completed_tasks * 100.0 / w.total_tasks AS completion_pct
+            FROM worklog_summary w
+            JOIN completion_summary c ON c.task_date = w.task_date
+            ORDER BY w.task_date
+            LIMIT 7
+        ''', start_date, end_date)
+        df = pd.DataFrame(rows, columns=['task_date', 'total_tasks', 'avg_time_per_task',
+                                         'completed_tasks', 'completion_pct'])
+        df['task_date'] = pd.to_datetime(df['task_date'])
+        return df
@@ -1,23 +1,19 @@
 '''Task wrapper over db model'''
+from abc import ABC, abstractmethod
+
+from sqlalchemy import Row
+
+from happiness.tasks.armcode import ARM_FIELD_LOOKUPS, get_arm_code
 from happiness.tasks.model import Task
 
 
-class TaskWrapper:
-    '''Task wrapper over db model'''
-    def __init__(self, data: Task):
-        '''Initialize task wrapper'''
-        self._task_model = data
-        self._rec_id = None
-        self.hash_field_lookup = {
-            'complexity': {'simple': 0, 'medium': 1, 'hard': 2},
-            'type': {'chores': 0, 'learning': 1, 'constructive': 2, 'creative': 3},
-            'priority': {'low': 0, 'medium': 1, 'high': 2},
-            'repeatable': {1: 0, 0: 1}
-        }
+class TaskAttributes(ABC):
+    '''Getters of a task over an abstract attribute accessor'''
+    __slots__ = ()
 
+    @abstractmethod
     def _get_attr(self, attr: str):
-        '''Helper method to get attribute from task model'''
-        return getattr(self._task_model, attr)
+        '''Get a task attribute by column name'''
 
     def get_id(self) -> int:
         '''Get task id'''
@@ -51,27 +47,45 @@ class TaskWrapper:
         '''Get task status'''
         return self._get_attr('status')
 
-    def get_rec_id(self) -> int:
-        '''Get recommendation ID'''
-        return self._rec_id
+    def get_hash_code(self) -> int:
+        '''Get the arm code, computed for tasks that were not stored yet'''
+        arm_code = self._get_attr('arm_code')
+        if arm_code is None:
+            arm_code = get_arm_code({field: self._get_attr(field) for field in ARM_FIELD_LOOKUPS})
+        return arm_code
+
+
+class TaskWrapper(TaskAttributes):
+    '''Task wrapper over db model'''
+    __slots__ = ('_task_model',)
+
+    def __init__(self, data: Task):
+        '''Initialize task wrapper'''
+        self._task_model = data
 
-    def set_rec_id(self, rec_id: int) -> None:
-        '''Set recommendation ID'''
-        self._rec_id = rec_id
+    def _get_attr(self, attr: str):
+        '''Helper method to get attribute from task model'''
+        return getattr(self._task_model, attr)
 
     @staticmethod
     def from_dict(data: dict):
         '''Create task wrapper from dictionary'''
         return TaskWrapper(Task(**data))
 
-    def get_hash_code(self):
-        '''Return a hash value computed over fields'''
-        value = 0
-        for field, lookups in self.hash_field_lookup.items():
-            fval = self._get_attr(field)
-            val = lookups.get(fval, len(lookups))
-            value = value << 3
-            value += val
-            if val not in lookups:
-                lookups[fval] = val
-        return value
+
+# Columns a TaskView is selected with
+TASK_VIEW_COLUMNS = (Task.id, Task.name, Task.complexity, Task.type, Task.due_date,
+                     Task.priority, Task.repeatable, Task.status, Task.arm_code)
+
+
+class TaskView(TaskAttributes):
+    '''Read-only task over a Core row of TASK_VIEW_COLUMNS, without an ORM instance behind it'''
+    __slots__ = ('_row',)
+
+    def __init__(self, row: Row):
+        '''Initialize task view'''
+        self._row = row
+
+    def _get_attr(self, attr: str):
+        '''Get a column of the row'''
+        return getattr(self._row, attr)
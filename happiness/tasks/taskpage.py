@@ -0,0 +1,180 @@
+'''Keyset paged, sorted and filtered task queries'''
+from typing import Any, List, Mapping, Optional, Tuple
+import base64
+import json
+import re
+
+from sqlalchemy import Select, and_, or_, tuple_
+from sqlalchemy.sql.elements import ColumnElement
+
+from happiness.tasks.model import Task
+
+# Table fields tasks can be sorted and filtered by, each is the first column
+# of an index so sqlite walks the index in (field, id) order
+TASK_FIELDS = {
+    'task_id': Task.id,
+    'name': Task.name,
+    'complexity': Task.complexity,
+    'type': Task.type,
+    'priority': Task.priority,
+    'repeatable': Task.repeatable,
+    'status': Task.status,
+}
+NULLABLE_FIELDS = {'type', 'repeatable'}
+MAX_PAGE_SIZE = 1000
+
+# One clause of a DataTable filter_query, e.g. {name} contains "report", operators
+# may carry an s/i case prefix which sqlite's LIKE and = ignore
+_CLAUSE = re.compile(r'^\{(?P<field>[^}]+)\}\s*[si]?'
+                     r'(?P<op>contains|datestartswith|eq|ne|le|lt|ge|gt|!=|<=|>=|=|<|>)'
+                     r'\s*(?P<value>.*)$')
+_OPERATORS = {
+    'eq': '=', 'ne': '!=', 'le': '<=', 'lt': '<', 'ge': '>=', 'gt': '>',
+}
+
+
+def _parse_value(field: str, raw: str) -> Any:
+    '''Convert a filter value to the type of the field'''
+    raw = raw.strip()
+    if len(raw) >= 2 and raw[0] == raw[-1] and raw[0] in '"\'`':
+        raw = raw[1:-1].replace(f'\\{raw[0]}', raw[0])
+    if field == 'task_id':
+        try:
+            return int(raw)
+        except ValueError as err:
+            raise ValueError(f'Task id filter value {raw} is not a number') from err
+    if field == 'repeatable':
+        if raw.lower() not in ('true', 'false', '1', '0'):
+            raise ValueError(f'Repeatable filter value {raw} is not a boolean')
+        return raw.lower() in ('true', '1')
+    return raw
+
+
+def parse_filter_query(filter_query: Optional[str]) -> List[ColumnElement]:
+    '''Translate a DataTable filter_query into sql conditions on TASK_FIELDS'''
+    conditions = []
+    for clause in (filter_query or '').split(' && '):
+        if not clause.strip():
+            continue
+        match = _CLAUSE.match(clause.strip())
+        if match is None or match['field'] not in TASK_FIELDS:
+            raise ValueError(f'Unsupported task filter {clause}')
+        field = match['field']
+        column = TASK_FIELDS[field]
+        op = _OPERATORS.get(match['op'], match['op'])
+        value = _parse_value(field, match['value'])
+        if isinstance(value, bool) and op in ('contains', 'datestartswith'):
+            op = '=' # the table filters every column with contains, a bool is not text
+        if op == 'contains':
+            conditions.append(column.contains(str(value), autoescape=True))
+        elif op == 'datestartswith':
+            conditions.append(column.startswith(str(value), autoescape=True))
+        elif op == '=':
+            conditions.append(column == value)
+        elif op == '!=':
+            conditions.append(column != value)
+        elif op == '<':
+            conditions.append(column < value)
+        elif op == '<=':
+            conditions.append(column <= value)
+        elif op == '>':
+            conditions.append(column > value)
+        else:
+            conditions.append(column >= value)
+    return conditions
+
+
+def encode_cursor(row_key: Tuple[Any, int]) -> str:
+    '''Opaque cursor of the (sort value, id) key of the last row of a page'''
+    return base64.urlsafe_b64encode(json.dumps(list(row_key)).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[Any, int]:
+    '''(sort value, id) key of a cursor'''
+    try:
+        value, task_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return value, int(task_id)
+    except (ValueError, TypeError) as err:
+        raise ValueError(f'Invalid page cursor {cursor}') from err
+
+
+class TaskPage:
+    '''One page of a task listing, sorted by a field and seeking past a cursor
+
+    Pages after the first continue from the (sort value, id) key of the last
+    row of the previous page, so the db seeks into the sort index instead of
+    skipping rows. Without a cursor, offset rows are skipped, e.g. when a
+    table jumps to a page it has no cursor for.
+    '''
+    def __init__(self, sort_by: str = 'task_id', descending: bool = False,
+                 filters: Optional[List[ColumnElement]] = None, page_size: int = 100,
+                 after: Optional[str] = None, offset: int = 0):
+        '''Initialize page, raises ValueError for unknown fields or bad sizes'''
+        if sort_by not in TASK_FIELDS:
+            raise ValueError(f'Unknown sort field {sort_by}, expected one of {list(TASK_FIELDS)}')
+        if page_size <= 0 or offset < 0:
+            raise ValueError(f'Invalid page size {page_size} or offset {offset}')
+        self.sort_by = sort_by
+        self.descending = descending
+        self.filters = filters or []
+        self.page_size = min(page_size, MAX_PAGE_SIZE)
+        self.after = decode_cursor(after) if after else None
+        self.offset = offset
+
+    @staticmethod
+    def from_args(args: Mapping[str, str]) -> 'TaskPage':
+        '''Page of request args: sort, order (asc/desc), filter, limit, after, offset'''
+        try:
+            page_size = int(args.get('limit', 100))
+            offset = int(args.get('offset', 0))
+        except ValueError as err:
+            raise ValueError(f'Invalid limit or offset: {err}') from err
+        return TaskPage(sort_by=args.get('sort', 'task_id'),
+                        descending=args.get('order', 'asc') == 'desc',
+                        filters=parse_filter_query(args.get('filter')), page_size=page_size,
+                        after=args.get('after'), offset=offset)
+
+    @staticmethod
+    def from_table(page_current: int, page_size: int, sort_by: Optional[List[dict]],
+                   filter_query: Optional[str], after: Optional[str] = None) -> 'TaskPage':
+        '''Page of a DataTable in custom paging mode, after is the cursor of page_current'''
+        sort = sort_by[0] if sort_by else {'column_id': 'task_id', 'direction': 'asc'}
+        return TaskPage(sort_by=sort['column_id'], descending=sort['direction'] == 'desc',
+                        filters=parse_filter_query(filter_query), page_size=page_size,
+                        after=after, offset=0 if after else page_current * page_size)
+
+    def _seek(self) -> ColumnElement:
+        '''Condition for rows after the cursor key, sqlite sorts NULLs first'''
+        column = TASK_FIELDS[self.sort_by]
+        value, task_id = self.after
+        if self.sort_by == 'task_id':
+            return Task.id < task_id if self.descending else Task.id > task_id
+        if value is None:
+            if self.descending: # NULLs come last
+                return and_(column.is_(None), Task.id < task_id)
+            return or_(and_(column.is_(None), Task.id > task_id), column.isnot(None))
+        if self.descending:
+            seek = tuple_(column, Task.id) < tuple_(value, task_id)
+            return or_(seek, column.is_(None)) if self.sort_by in NULLABLE_FIELDS else seek
+        return tuple_(column, Task.id) > tuple_(value, task_id)
+
+    def apply(self, stmt: Select) -> Select:
+        '''Add the filters, seek, order and limit of this page to a task select'''
+        column = TASK_FIELDS[self.sort_by]
+        stmt = stmt.where(*self.filters) if self.filters else stmt
+        if self.after is not None:
+            stmt = stmt.where(self._seek())
+        order = [column.desc(), Task.id.desc()] if self.descending else [column, Task.id]
+        if self.sort_by == 'task_id':
+            order = order[1:]
+        # one row more than the page tells if there is a next page
+        stmt = stmt.order_by(*order).limit(self.page_size + 1)
+        return stmt.offset(self.offset) if self.offset else stmt
+
+    def split(self, rows: list) -> Tuple[list, Optional[str]]:
+        '''Rows of this page and the cursor of the next page, None on the last page'''
+        if len(rows) <= self.page_size:
+            return rows, None
+        rows = rows[:self.page_size]
+        last = rows[-1]
+        return rows, encode_cursor((getattr(last, TASK_FIELDS[self.sort_by].key), last.id))
@@ -1,24 +1,93 @@
 '''Task Repository'''
 from datetime import datetime, timedelta, timezone
-from typing import List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+import threading
 
 from loguru import logger
-from sqlalchemy import and_, not_, func, text
+from sqlalchemy import insert, not_, select, update
+from sqlalchemy.engine import Connection, Engine
 from sqlalchemy.orm import Session
-import pandas as pd
 
 from happiness import MODEL_DIR
+from happiness.tasks.armindex import ArmIndex
+from happiness.tasks.bulktasks import ImportResult, export_table, import_tasks
+from happiness.tasks.counters import (RECOMMENDATION_IDS, REPORT_CHANGES, TASK_CHANGES,
+                                      IdBlocks, bump_counter, read_counter)
+from happiness.tasks.duescheduler import DueScheduler
 from happiness.tasks.model import Recommendation, Task, TaskSummary, WorkLog
 from happiness.tasks.mabrecommender import MABRecommender
-from happiness.tasks.task import TaskWrapper
+from happiness.tasks.randomrecommender import RandomRecommender
+from happiness.tasks.recommender import TaskRecommenderInterface
+from happiness.tasks.recurrence import TaskRecurrences
+from happiness.tasks.rollups import ReportRollups
+from happiness.tasks.task import TASK_VIEW_COLUMNS, TaskAttributes, TaskView, TaskWrapper
+from happiness.tasks.taskpage import TaskPage
+from happiness.tasks.thompsonrecommender import ThompsonRecommender
+from happiness.tasks.training import update_model
+from happiness.tasks.writebehind import WriteBehindQueue
+
+#TODO: Fix hardcoded file names
+MODEL_FILE = f'{MODEL_DIR}/eps-cmab.db'
+TRAINED_MODEL_FILE = f'{MODEL_DIR}/eps-cmab.pkl'
+REC_ID_BLOCK = 100 # recommendation ids reserved per counter write
+
+# Recommender factories by name, given the optional write-behind queue and
+# whether to serve from precomputed slates
+RECOMMENDERS = {
+    'random': lambda writer, pool_slates: RandomRecommender(),
+    'epsilon-greedy': lambda writer, pool_slates: MABRecommender(
+        mdl_file=MODEL_FILE, pkl_file=TRAINED_MODEL_FILE, writer=writer,
+        pool_slates=pool_slates),
+    'thompson': lambda writer, pool_slates: ThompsonRecommender(
+        mdl_file=MODEL_FILE, pkl_file=TRAINED_MODEL_FILE, writer=writer,
+        pool_slates=pool_slates),
+}
+
+
+def insert_recommendations(conn: Connection, batches: List[List[dict]]) -> None:
+    '''Insert batches of recommendation rows with their ids in one executemany'''
+    rows = [row for batch in batches for row in batch]
+    conn.execute(insert(Recommendation.__table__), rows)
+
 
 class TaskRepository:
     '''Task Repository'''
-    def __init__(self, db_session: Session):
-        '''Initialize task repository'''
+    def __init__(self, db_session: Session, writer: Optional[WriteBehindQueue] = None,
+                 recommender: str = 'epsilon-greedy', retrain_on_start_day: bool = False,
+                 pool_slates: bool = False, scheduler: Optional[DueScheduler] = None):
+        '''Initialize task repository
+
+        With a writer, recommendation rows and q-value updates are written in
+        the background instead of inside the request. recommender is the name
+        of one of RECOMMENDERS. With retrain_on_start_day, recommendations
+        since the last training are folded into the trained model on a
+        background thread at day start, the recommender reloads it when done.
+        With pool_slates, the bandits rank arms per context in the background.
+        With a scheduler, finished repeatable tasks are queued on it to be
+        rescheduled in the background once their next date is due.
+
+        db_session is meant to be a scoped session such as Flask-SQLAlchemy's
+        db.session, so each request thread works in its own session. State
+        kept in memory is either lock protected or checked against counters
+        in the db, so several threads and processes can serve the same db.
+        '''
+        if recommender not in RECOMMENDERS:
+            raise ValueError(f'Unknown recommender {recommender}, '
+                             f'expected one of {list(RECOMMENDERS)}')
         self._db_session = db_session
-        #TODO: Fix hardcoded file name
-        self._recommender = MABRecommender(mdl_file=f'{MODEL_DIR}/eps-cmab.pkl')
+        self._writer = writer
+        self._scheduler = scheduler
+        self._retrain_on_start_day = retrain_on_start_day
+        self._retrain_thread: Optional[threading.Thread] = None
+        self._retrain_lock = threading.Lock()
+        self._rec_ids = IdBlocks(RECOMMENDATION_IDS, REC_ID_BLOCK)
+        self._rollups = ReportRollups(db_session)
+        self._recurrences = TaskRecurrences(db_session)
+        self._arm_index = ArmIndex()
+        self._tasks_version = None # TASK_CHANGES counter the arm index is up to date with
+        self._recommender: TaskRecommenderInterface = RECOMMENDERS[recommender](writer, pool_slates)
+        if writer is not None:
+            writer.register('recommendations', insert_recommendations)
 
     def add_task(self, task: TaskWrapper) -> None:
         '''Add a new task'''
@@ -30,54 +99,102 @@ class TaskRepository:
             repeatable=task.is_repeatable()
         )
         self._db_session.add(new_task)
-        self._db_session.commit()
+        self._commit_task_changes(lambda: self._arm_index.add(new_task.id, new_task.arm_code))
 
-    def get_tasks(self) -> List[TaskWrapper]:
-        '''Get all pending tasks'''
-        tasks = self._db_session.query(Task).filter(not_(Task.status == 'done')).all()
-        return [TaskWrapper(task) for task in tasks]
+    def import_tasks(self, lines: Iterable[str], fmt: str) -> ImportResult:
+        '''Bulk insert the tasks of an NDJSON or CSV stream in batched transactions
 
-    def recommend_tasks(self, num_tasks: int) -> List[TaskWrapper]:
-        '''Recommend tasks based on user's mood'''
-        tasks = self.get_tasks()
-        recommendations = self._recommender.recommend_tasks(tasks, num_tasks)
-        self.save_recommendations(recommendations, num_tasks)
-        return recommendations
+        Each batch bumps TASK_CHANGES, so the arm index is reloaded once on
+        its next use instead of being updated per task.
+        '''
+        return import_tasks(self._db_session.get_bind(), lines, fmt)
 
-    def save_recommendations(self, tasks: List[TaskWrapper], num_tasks: int) -> None:
-        '''Save recommended tasks'''
-        curr_ts = datetime.now(timezone.utc)
-        recommendations = [Recommendation(
-            task_id=task.get_id(),
-            rec_ts=curr_ts
-            ) for task in tasks]
-        self._db_session.add_all(recommendations)
-        self._db_session.commit()
+    def export_table(self, table_name: str, fmt: str) -> Iterator[str]:
+        '''Stream a table as NDJSON or CSV chunks, see bulktasks.export_table'''
+        return export_table(self._db_session.get_bind(), table_name, fmt)
 
-        assert len(recommendations) == num_tasks, 'Recommendations not saved properly'
+    def _commit_task_changes(self, update_index: Callable[[], None]) -> None:
+        '''Commit writes changing the set of open tasks, then apply them to the arm index
 
-        for idx in range(num_tasks):
-            logger.debug(f'Setting rec_id {recommendations[idx].id} for task {tasks[idx].get_id()}')
-            tasks[idx].set_rec_id(recommendations[idx].id) #copy rec_id back to task
+        Bumping TASK_CHANGES in the same transaction makes other processes
+        reload their arm index. Ours is only updated in place if no other
+        process changed tasks since it was loaded.
+        '''
+        version = bump_counter(self._db_session.connection(), TASK_CHANGES)
+        self._db_session.commit()
+        update_index()
+        if self._tasks_version == version - 1:
+            self._tasks_version = version
+
+    def _get_task_views(self, *criteria) -> List[TaskView]:
+        '''Get read-only views of the tasks matching the criteria'''
+        rows = self._db_session.execute(select(*TASK_VIEW_COLUMNS).where(*criteria)).all()
+        return [TaskView(row) for row in rows]
+
+    def _get_task_page(self, page: TaskPage, *criteria) -> Tuple[List[TaskView], Optional[str]]:
+        '''Get a page of the tasks matching the criteria and the cursor of the next page'''
+        rows = self._db_session.execute(
+            page.apply(select(*TASK_VIEW_COLUMNS).where(*criteria))).all()
+        rows, next_cursor = page.split(rows)
+        return [TaskView(row) for row in rows], next_cursor
+
+    def get_tasks(self, page: TaskPage) -> Tuple[List[TaskView], Optional[str]]:
+        '''Get a page of pending tasks and the cursor of the next page'''
+        return self._get_task_page(page, not_(Task.status == 'done'))
+
+    def _get_arm_index(self) -> ArmIndex:
+        '''Get the arm index of pending tasks, loading it on first use or if tasks changed'''
+        version = read_counter(self._db_session.connection(), TASK_CHANGES)
+        if not self._arm_index.is_loaded() or version != self._tasks_version:
+            rows = self._db_session.query(Task.id, Task.arm_code).filter(
+                not_(Task.status == 'done')).all()
+            self._arm_index.load(rows)
+            self._tasks_version = version
+            logger.info(f'Loaded arm index with {len(self._arm_index)} tasks')
+        return self._arm_index
+
+    def _get_tasks_by_ids(self, task_ids: List[int]) -> List[TaskView]:
+        '''Get tasks with the given ids, in the same order'''
+        tasks_by_id = {task.get_id(): task for task in self._get_task_views(Task.id.in_(task_ids))}
+        return [tasks_by_id[task_id] for task_id in task_ids if task_id in tasks_by_id]
+
+    def recommend_tasks(self, num_tasks: int) -> List[Tuple[TaskView, int]]:
+        '''Recommend tasks based on user's mood, returns (task, recommendation id) pairs'''
+        task_ids = self._recommender.recommend_from_index(self._get_arm_index(), num_tasks)
+        recommendations = self._get_tasks_by_ids(task_ids)
+        rec_ids = self.save_recommendations(recommendations, len(recommendations))
+        return list(zip(recommendations, rec_ids))
+
+    def save_recommendations(self, tasks: List[TaskAttributes], num_tasks: int) -> List[int]:
+        '''Save recommended tasks, returns their recommendation ids in the same order'''
+        assert len(tasks) == num_tasks, 'Recommendations not saved properly'
+        if not tasks:
+            return []
+        curr_ts = datetime.now(timezone.utc)
+        rec_ids = self._rec_ids.allocate(self._db_session, num_tasks)
+        rows = []
+        for task, rec_id in zip(tasks, rec_ids):
+            logger.debug(f'Saving rec_id {rec_id} for task {task.get_id()}')
+            rows.append({'id': rec_id, 'task_id': task.get_id(), 'rec_ts': curr_ts})
+
+        if self._writer is None:
+            insert_recommendations(self._db_session.connection(), [rows])
+            self._db_session.commit()
+        else: # only reserving a new id block writes inside the request
+            self._writer.put('recommendations', rows)
+        return rec_ids
 
-    def get_reschedulable_tasks(self) -> List[TaskWrapper]:
-        '''Get repeatable tasks that have been completed'''
-        tasks = self._db_session.query(Task).filter(
-            and_(Task.repeatable == 1, Task.status == 'done')).all() # TODO: index?
-        return [TaskWrapper(task) for task in tasks]
+    def get_reschedulable_tasks(self, page: TaskPage) -> Tuple[List[TaskView], Optional[str]]:
+        '''Get a page of repeatable tasks that have been completed and the next cursor'''
+        return self._get_task_page(page, Task.repeatable == 1, Task.status == 'done')
 
     def _update_task_status(self, task_id: int,
-                            current_status: str, new_status: str,
-                            clear_dt: bool = False) -> Task:
+                            current_status: str, new_status: str) -> Task:
         '''Update task status'''
         task = self._db_session.query(Task).filter_by(id=task_id, status=current_status).first()
         if task is None:
             raise ValueError(f'Task with id {task_id} is not in {current_status} state')
         task.status = new_status
-
-        if clear_dt:
-            task.next_scheduled = None
-
         return task
 
     def _create_work_log(self, task_id: int, rec_id: int):
@@ -124,6 +241,7 @@ class TaskRepository:
                 start_date=datetime.now(timezone.utc)
             )
             self._db_session.add(task_summary)
+            self._recurrences.record_start(task_id, task_summary.start_date)
         logger.debug(f'Task summary: {task_summary}')
         return task_summary
 
@@ -136,9 +254,15 @@ class TaskRepository:
         return worklog.rec_id
 
     def _find_resched_tasks(self, tgt_date: datetime.date) -> List[int]:
-        '''Find tasks that are to be rescheduled on the given date'''
-        rows = self._db_session.query(Task).filter_by(next_scheduled=tgt_date, repeatable=1).all()
-        return [row.id for row in rows] if rows else []
+        '''Find tasks that are to be rescheduled by the given date, missed dates included'''
+        return list(self._db_session.execute(select(Task.id).where(
+            Task.next_scheduled <= tgt_date, Task.repeatable == 1)).scalars())
+
+    def get_scheduled_tasks(self) -> List[Tuple[int, datetime.date]]:
+        '''(id, next scheduled date) of the done repeatable tasks waiting to be rescheduled'''
+        return [tuple(row) for row in self._db_session.execute(
+            select(Task.id, Task.next_scheduled).where(
+                Task.next_scheduled.isnot(None), Task.repeatable == 1, Task.status == 'done'))]
 
     def _stop_inprogress_tasks(self):
         '''Stop all tasks in progress'''
@@ -167,11 +291,13 @@ class TaskRepository:
             task = self._update_task_status(task_id, 'pending', 'in_progress')
             self._create_work_log(task_id, rec_id)
             self._update_task_summary(task_id)
+            bump_counter(self._db_session.connection(), REPORT_CHANGES)
             self._db_session.commit()
             self._recommender.update_chosen_task(task_id)
             return f'Task {task.name} started successfully!'
         except ValueError as err:
             logger.exception(err)
+            self._db_session.rollback()
             return str(err)
 
     def stop_task(self, task_id: int, rec_id: int) -> str:
@@ -184,10 +310,13 @@ class TaskRepository:
             work_log = self._update_work_log(task_id, rec_id)
             time_worked = (work_log.end_ts - work_log.start_ts).seconds
             self._update_task_summary(task_id, time_worked=time_worked)
+            self._rollups.record_worklog(work_log, task)
+            bump_counter(self._db_session.connection(), REPORT_CHANGES)
             self._db_session.commit()
             return f'Task {task.name} stopped successfully!'
         except ValueError as err:
             logger.exception(err)
+            self._db_session.rollback()
             return str(err)
 
     def finish_task(self, task_id: int, rec_id: int, rating: int = 1) -> str:
@@ -199,160 +328,121 @@ class TaskRepository:
             task = self._update_task_status(task_id, 'in_progress', 'done')
             work_log = self._update_work_log(task_id, rec_id)
             time_worked = (work_log.end_ts - work_log.start_ts).seconds
-            self._update_task_summary(task_id, time_worked=time_worked,
-                                      has_end_date=True, rating=rating)
+            task_summary = self._update_task_summary(task_id, time_worked=time_worked,
+                                                     has_end_date=True, rating=rating)
+            self._rollups.record_worklog(work_log, task)
+            self._rollups.record_completion(task_summary)
 
             # auto-schedule
+            next_date = None
             if task.repeatable:
                 next_date = self._find_next_schedule_date(task_id)
                 if next_date:
                     task.next_scheduled = next_date
 
-            self._db_session.commit()
+            bump_counter(self._db_session.connection(), REPORT_CHANGES)
+            self._commit_task_changes(lambda: self._arm_index.remove(task_id))
+            if next_date and self._scheduler is not None:
+                self._scheduler.add(task_id, next_date)
             return f'Task {task.name} finished successfully!'
         except ValueError as err:
             logger.exception(err)
+            self._db_session.rollback()
             return str(err)
 
     def start_day(self):
         '''Day start'''
+        if self._retrain_on_start_day:
+            # end_day stopped all tasks, so rewards of earlier recommendations are final
+            self.flush()
+            self._start_retraining(self._db_session.get_bind())
         self._recommender.load()
 
+    def _start_retraining(self, engine: Engine) -> None:
+        '''Fold new recommendations into the trained model off the request path'''
+        with self._retrain_lock:
+            if self._retrain_thread is not None and self._retrain_thread.is_alive():
+                logger.info('Model retraining is still running, not starting another one')
+                return
+            self._retrain_thread = threading.Thread(target=self._retrain, args=(engine,),
+                                                    name='retrain', daemon=True)
+            self._retrain_thread.start()
+
+    def _retrain(self, engine: Engine) -> None:
+        '''Retraining thread, reloads the recommender once the model file changed'''
+        try:
+            with engine.connect() as conn:
+                if update_model(conn, TRAINED_MODEL_FILE):
+                    self._recommender.load()
+        except Exception as err: # the thread must not die silently, the next day start retries
+            logger.exception(f'Failed to retrain the model: {err}')
+
     def end_day(self):
         '''Day end'''
+        self.flush()
         self._recommender.save()
         self._stop_inprogress_tasks()
 
-    def reschedule_tasks(self, task_ids: List[int], auto: bool = False) -> str:
-        '''Reschedule tasks with given ids'''
-        tasks = []
-        message = None
-        if not task_ids:
-            return 'No tasks rescheduled'
+    def flush(self) -> None:
+        '''Wait until all background writes have been applied'''
+        if self._writer is not None:
+            self._writer.flush()
 
-        try:
-            for task_id in task_ids:
-                task = self._update_task_status(task_id, 'done', 'pending', True)
-                tasks.append(task)
-        except ValueError as err:
-            logger.exception(err)
-            message = str(err)
+    def reschedule_tasks(self, task_ids: List[int],
+                         auto: bool = False) -> Tuple[str, Dict[int, str]]:
+        '''Reschedule done tasks with given ids, returns a message and the result per id
 
-        if not message:
-            self._db_session.commit()
-            task_names = [task.name for task in tasks]
+        One UPDATE ... RETURNING moves every done task back to pending, ids
+        that are not done are skipped instead of failing the others. A
+        result is 'rescheduled', 'not found' or the status of a skipped task.
+        '''
+        task_ids = list(dict.fromkeys(task_ids))
+        if not task_ids:
+            return 'No tasks rescheduled', {}
+
+        rows = self._db_session.execute(
+            update(Task).where(Task.id.in_(task_ids), Task.status == 'done')
+            .values(status='pending', next_scheduled=None)
+            .returning(Task.id, Task.name, Task.arm_code)
+            .execution_options(synchronize_session='fetch')).all()
+        results = {row.id: 'rescheduled' for row in rows}
+        skipped = [task_id for task_id in task_ids if task_id not in results]
+        if skipped:
+            results.update(self._db_session.execute(
+                select(Task.id, Task.status).where(Task.id.in_(skipped))).all())
+        results = {task_id: results.get(task_id, 'not found') for task_id in task_ids}
+
+        messages = []
+        if rows:
+            def add_to_index():
+                for row in rows:
+                    self._arm_index.add(row.id, row.arm_code)
+            self._commit_task_changes(add_to_index)
+            task_names = [row.name for row in rows]
             auto_prefix = 'automatically ' if auto else ''
-            message = f'Tasks {task_names} {auto_prefix} rescheduled succesfully!'
-        return message
-
-    def get_worklog_summary(self, start_date: datetime, end_date: datetime) -> dict:
-        '''Get a worklog summary between the two given dates'''
-        #query worklog - use tz aware dates directly
-        worklogs = self._db_session.query(WorkLog, Task).filter(
-            WorkLog.start_ts >= start_date,
-            WorkLog.end_ts < end_date
-        ).filter(WorkLog.task_id == Task.id).all()
-        data = [{
-            'start_ts': worklog[0].start_ts.astimezone(start_date.tzinfo),
-            'end_ts': worklog[0].end_ts.astimezone(start_date.tzinfo),
-            'type': worklog[1].type
-        } for worklog in worklogs]
-        df = pd.DataFrame(data)
-
-        # group by + sum
-        df['hours_worked'] = (df['end_ts'] - df['start_ts']).dt.total_seconds() / 3600
-        df['start_date'] = df['start_ts'].dt.date
-        # data filtering
-        df = df[df['hours_worked'] <= 3]
-
-        summary = df.groupby(['start_date', 'type'])['hours_worked'].sum().to_dict()
-        return summary
-
-    def get_task_completion_summary(self, start_date: datetime, end_date: datetime) -> list:
-        '''Get task completions by day of week + hour of day between given date range'''
-        # Query for heatmap data
-        heatmap_data = (
-            self._db_session.query(TaskSummary.end_date)
-            .filter(
-                TaskSummary.has_ended == 1,
-                TaskSummary.end_date >= start_date,
-                TaskSummary.end_date < end_date
-            )
-            .all()
-        )
-
-        # convert timestamps
-        local_tz = start_date.tzinfo
-        converted_data = [
-            row[0].astimezone(local_tz)  # Directly convert to local timezone
-            for row in heatmap_data
-        ]
-
-        # Aggregate tasks by day of week and hour
-        data_list = [{"day_of_week": dt.weekday(), "hour_of_day": dt.hour} for dt in converted_data]
-        return data_list
-
-    def get_worklog_splits(self, start_date: datetime, end_date: datetime) -> list:
-        '''Get worklog splits by complexity and priority'''
-        subquery = self._db_session.query(
-            WorkLog.task_id,
-            (
-                func.strftime('%s', WorkLog.end_ts) - func.strftime('%s', WorkLog.start_ts)
-            ).label('time_worked')
-        ).filter(
-            WorkLog.start_ts >= start_date,
-            WorkLog.end_ts < end_date
-        ).subquery()
-
-        data = self._db_session.query(
-            Task.priority, Task.complexity,
-            func.sum(subquery.c.time_worked).label('total_time')
-        ).join(
-            Task, Task.id == subquery.c.task_id
-        ).group_by(
-            Task.priority, Task.complexity
-        ).all()
-        return data
+            messages.append(f'Tasks {task_names} {auto_prefix}rescheduled succesfully!')
+        else:
+            self._db_session.rollback()
+        if skipped:
+            reasons = ', '.join(f'{task_id} ({results[task_id]})' for task_id in skipped)
+            logger.warning(f'Tasks not rescheduled, not done: {reasons}')
+            messages.append(f'Tasks not rescheduled, not done: {reasons}')
+        return ' '.join(messages), results
 
     def _find_next_schedule_date(self, task_id: int) -> datetime.date:
         '''Find next auto schedule date for given task'''
-        query = f'''
-            SELECT avg(interval_days) as avg_interval
-            FROM (
-                WITH task_intervals AS (
-                    SELECT
-                        ts.task_id,
-                        ts.start_date,
-                        LEAD(ts.start_date) OVER (PARTITION BY ts.task_id ORDER BY ts.start_date) AS next_start_date,
-                        ROW_NUMBER() OVER (PARTITION BY ts.task_id ORDER BY ts.start_date DESC) AS rn
-                    FROM
-                        task_summary ts
-                    JOIN task t ON ts.task_id = t.id
-                    WHERE t.repeatable = 1
-                    AND t.id = {task_id}
-                )
-                SELECT
-                    task_id,
-                    julianday(next_start_date) - julianday(start_date) AS interval_days
-                FROM
-                    task_intervals
-                WHERE
-                    next_start_date IS NOT NULL
-                    AND rn <= 10
-            )
-        '''
-        result = self._db_session.execute(text(query)).scalar_one_or_none()
+        mean_interval = self._recurrences.get_mean_interval(task_id)
         next_date = None
-        if result:
-            interval = round(result)
+        if mean_interval:
+            interval = round(mean_interval)
             next_date = datetime.now(timezone.utc) + timedelta(days=interval)
             next_date = next_date.date()
             logger.info(f'Setting next scheduled date {next_date} for task id {task_id}')
 
         return next_date
 
-    def auto_reschedule(self, tgt_date: datetime.date = None) -> str:
-        '''Automatically reschedule tasks due on given target date'''
+    def auto_reschedule(self, tgt_date: datetime.date = None) -> Tuple[str, Dict[int, str]]:
+        '''Automatically reschedule tasks due by the given target date'''
         if tgt_date is None:
             tgt_date = datetime.now(timezone.utc).date()
 
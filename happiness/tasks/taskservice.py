@@ -0,0 +1,128 @@
+'''Task service shared by the Flask routes and the Dash callbacks'''
+from datetime import datetime, timezone
+from typing import Iterable, Iterator, List
+
+from loguru import logger
+
+from happiness.tasks.reportshelper import ReportsHelper
+from happiness.tasks.task import TaskWrapper
+from happiness.tasks.taskpage import TaskPage
+from happiness.tasks.taskrepository import TaskRepository
+
+
+class TaskService:
+    '''In-process service layer, returns json serializable payloads'''
+    def __init__(self, repository: TaskRepository, helper: ReportsHelper):
+        '''Initialize task service'''
+        self._repository = repository
+        self._helper = helper
+
+    def add_task(self, data: dict) -> dict:
+        '''Add a new task'''
+        logger.info(f'add_task invoked with {data}')
+        task = TaskWrapper.from_dict(data)
+        task_name = data['name']
+        self._repository.add_task(task)
+        return {'message': f'Task "{task_name}" added successfully!'}
+
+    def import_tasks(self, lines: Iterable[str], fmt: str = 'ndjson') -> dict:
+        '''Bulk import tasks from NDJSON or CSV lines'''
+        result = self._repository.import_tasks(lines, fmt)
+        return {'message': f'Imported {result.imported} tasks, rejected {result.rejected} lines',
+                **result.to_dict()}
+
+    def export_table(self, table_name: str, fmt: str = 'ndjson') -> Iterator[str]:
+        '''Stream tasks, worklogs or summaries as NDJSON or CSV chunks'''
+        logger.info(f'Exporting {table_name} as {fmt}')
+        return self._repository.export_table(table_name, fmt)
+
+    def get_tasks(self, page: TaskPage = None) -> dict:
+        '''Get a page of pending tasks, next_cursor continues it'''
+        tasks, next_cursor = self._repository.get_tasks(page or TaskPage())
+        tasks_list = [
+            {
+                'task_id': task.get_id(),
+                'name': task.get_name(),
+                'complexity': task.get_complexity(),
+                'type': task.get_type(),
+                'priority': task.get_priority(),
+                'repeatable': task.is_repeatable(),
+                'status': task.get_status()
+            } for task in tasks
+        ]
+        logger.info(f'Returning get_tasks with {len(tasks)} tasks')
+        return {'tasks': tasks_list, 'next_cursor': next_cursor}
+
+    def get_reschedulable_tasks(self, page: TaskPage = None) -> dict:
+        '''Get a page of tasks that can be rescheduled, next_cursor continues it'''
+        tasks, next_cursor = self._repository.get_reschedulable_tasks(page or TaskPage())
+        tasks_list = [
+            {
+                'task_id': task.get_id(),
+                'name': task.get_name(),
+                'complexity': task.get_complexity(),
+                'type': task.get_type(),
+                'priority': task.get_priority(),
+            } for task in tasks
+        ]
+        logger.info(f'Returning get_resched_tasks with {len(tasks)} tasks')
+        return {'tasks': tasks_list, 'next_cursor': next_cursor}
+
+    def recommend_tasks(self, num_tasks: int = 5) -> dict:
+        '''Recommend tasks based on user's mood'''
+        recommendations = self._repository.recommend_tasks(num_tasks)
+        tasks_list = [
+            {
+                'task_id': task.get_id(),
+                'rec_id': rec_id,
+                'name': task.get_name(),
+                'type': task.get_type(),
+                'priority': task.get_priority(),
+            } for task, rec_id in recommendations
+        ]
+        logger.debug(f'Recommended tasks: {tasks_list}')
+        return {'tasks': tasks_list}
+
+    def transact_task(self, data: dict) -> dict:
+        '''Start, stop or end a task'''
+        logger.info(f'transact_task called with {data}')
+        task_id = data['task_id']
+        rec_id = data['rec_id']
+        action = data['action']
+
+        message = 'Invalid request'
+
+        if action == 'start':
+            message = self._repository.start_task(task_id, rec_id)
+        elif action == 'stop':
+            message = self._repository.stop_task(task_id, rec_id)
+        elif action == 'end':
+            rating = data['rating']
+            message = self._repository.finish_task(task_id, rec_id, rating)
+
+        # worklogs and summaries changed, cached reports covering now are stale
+        self._helper.invalidate(datetime.now(timezone.utc))
+        return {'message': message}
+
+    def reschedule_tasks(self, task_ids: List) -> dict:
+        '''Reschedule selected tasks'''
+        logger.info(f'reschedule_tasks called with {task_ids}')
+        message, results = self._repository.reschedule_tasks(
+            task_ids=[int(task_id) for task_id in task_ids])
+        return {'message': message, 'results': results}
+
+    def start_day(self) -> dict:
+        '''Start day'''
+        self._repository.start_day()
+        return self.auto_reschedule()
+
+    def auto_reschedule(self) -> dict:
+        '''Reschedule the repeatable tasks due by today'''
+        message, results = self._repository.auto_reschedule()
+        return {'message': message, 'results': results}
+
+    def end_day(self) -> dict:
+        '''End day'''
+        self._repository.end_day()
+        self._helper.invalidate(datetime.now(timezone.utc))
+        return {}
@@ -0,0 +1,39 @@
+'''A Thompson sampling recommender for tasks'''
+from datetime import datetime
+from typing import Callable, Iterator, List, Optional
+
+import numpy as np
+
+from happiness.tasks.mabrecommender import MABRecommender
+from happiness.tasks.writebehind import WriteBehindQueue
+
+
+class ThompsonRecommender(MABRecommender):
+    '''Contextual Thompson sampling recommender
+
+    Shares the model store and reward updates of the epsilon greedy MAB, but
+    ranks the candidate arms by one draw from each arm's Beta posterior instead
+    of mixing greedy and random pulls.
+    '''
+    SLATES_PER_CONTEXT = 16 # every request needs a fresh draw
+    CONSUME_SLATES = True
+
+    def __init__(self, mdl_file: str, pkl_file: Optional[str] = None,
+                 writer: Optional[WriteBehindQueue] = None,
+                 clock: Optional[Callable[[], datetime]] = None, seed: Optional[int] = None,
+                 pool_slates: bool = False):
+        '''Initialize Thompson sampling recommender'''
+        self.rng = np.random.default_rng(seed)
+        super().__init__(mdl_file, epsilon=0, pkl_file=pkl_file, writer=writer, clock=clock,
+                         pool_slates=pool_slates)
+
+    def _load_contextual_values(self) -> Optional[int]:
+        '''Load contextual model based on time of day, untrained arms draw from Beta(1, 1)'''
+        ctx = self.ce.get_context(self.clock().hour)
+        self._ensure_context(ctx)
+        return ctx
+
+    def _rank(self, ctx: int, arms: List[int], k: int) -> Iterator[int]:
+        '''Iterate arms in the order of one posterior draw each'''
+        with self._state_lock:
+            return self.state.sampled_arms(ctx, arms, k, self.rng)
@@ -0,0 +1,9 @@
+'''Timestamp helpers for db queries'''
+from datetime import datetime, timezone
+
+
+def to_db_ts(dt: datetime) -> datetime:
+    '''Convert a datetime to the naive utc form timestamps are stored in'''
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone(timezone.utc).replace(tzinfo=None)
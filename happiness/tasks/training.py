@@ -0,0 +1,216 @@
+'''Training of the contextual MAB model from the recommendation history
+
+Usage: python -m happiness.tasks.training --db instance/tasks.db [--out models/eps-cmab.pkl]
+                                         [--incremental]
+'''
+from typing import Dict, Iterator, List, Optional
+import argparse
+import json
+import os
+import pickle
+
+from loguru import logger
+from sqlalchemy import create_engine, text
+from sqlalchemy.engine import Connection, Engine
+import numpy as np
+import pandas as pd
+
+from happiness import MODEL_DIR
+from happiness.tasks.armcode import ARM_CODE_VERSION, NUM_ARM_CODES
+from happiness.tasks.mabrecommender import ContextEncoder
+
+# One reward per recommendation, 1 when one of its work logs lasted over a minute.
+# pending is a json array of ids at or below after_id that were not written yet
+# when the model was last trained.
+HISTORY_QUERY = '''
+    SELECT R.id AS rec_id, CAST(strftime('%H', R.rec_ts) AS INTEGER) AS hour, T.arm_code,
+    MAX(CASE
+        WHEN W.id IS NOT NULL
+            AND CAST((julianday(W.end_ts) - julianday(W.start_ts)) * 24 * 60 * 60
+                     AS INTEGER) > 60
+        THEN 1
+        ELSE 0
+    END) AS reward
+    FROM recommendation R
+    INNER JOIN task T ON T.id = R.task_id
+    LEFT JOIN work_log W ON R.id = W.rec_id
+    WHERE (R.id > :after_id OR R.id IN (SELECT value FROM json_each(:pending)))
+        AND T.arm_code IS NOT NULL
+    GROUP BY R.id
+    ORDER BY R.id
+'''
+HISTORY_DTYPES = {'rec_id': 'int64', 'hour': 'int64', 'arm_code': 'int64', 'reward': 'float64'}
+# Trainings a missing recommendation id is looked for before it is considered lost
+PENDING_TRAININGS = 7
+
+
+class RewardTotals:
+    '''Reward sums and counts per context x arm code
+
+    The incremental mean the recommender updates online equals the grouped
+    mean of the rewards, so totals of any set of chunks can simply be added.
+
+    Recommendation ids come from one sequence shared by all app processes.
+    Each process hands them out from its own reserved block and writes its
+    rows later from its own write-behind queue. So rows below the highest
+    trained id can still be missing at training time. Their ids are kept as
+    pending and folded in by one of the next PENDING_TRAININGS trainings.
+    Rows that are still missing then, e.g. ids of a block whose process
+    stopped, are considered lost.
+    '''
+    def __init__(self, num_contexts: int):
+        '''Initialize empty totals'''
+        self.num_contexts = num_contexts
+        self.sums = np.zeros((num_contexts, NUM_ARM_CODES))
+        self.counts = np.zeros((num_contexts, NUM_ARM_CODES), dtype=np.int64)
+        self.last_rec_id = 0
+        self.pending_rec_ids: Dict[int, int] = {} # missing id -> trainings left
+
+    @staticmethod
+    def from_model(model: dict, num_contexts: int) -> Optional['RewardTotals']:
+        '''Totals of a trained model, None if it does not record its last rec id'''
+        if 'last_rec_id' not in model or model.get('arm_code_version') != ARM_CODE_VERSION:
+            return None
+        totals = RewardTotals(num_contexts)
+        for ctx, ctx_counts in model['counts'].items():
+            arms = np.fromiter(ctx_counts.keys(), dtype=np.int64, count=len(ctx_counts))
+            counts = np.fromiter(ctx_counts.values(), dtype=np.int64, count=len(ctx_counts))
+            qvalues = np.array([model['qvalues'][ctx][arm] for arm in ctx_counts])
+            totals.counts[ctx, arms] = counts
+            totals.sums[ctx, arms] = qvalues * counts # running mean -> reward sum
+        totals.last_rec_id = model['last_rec_id']
+        totals.pending_rec_ids = model.get('pending_rec_ids', {})
+        return totals
+
+    def add(self, contexts: np.ndarray, arms: np.ndarray, rewards: np.ndarray) -> None:
+        '''Add rewards of (context, arm) events'''
+        size = self.num_contexts * NUM_ARM_CODES
+        keys = contexts * NUM_ARM_CODES + arms
+        self.sums += np.bincount(keys, weights=rewards, minlength=size).reshape(self.sums.shape)
+        self.counts += np.bincount(keys, minlength=size).reshape(self.counts.shape)
+
+    def add_chunk(self, chunk: pd.DataFrame, ce: ContextEncoder) -> None:
+        '''Add a chunk of HISTORY_QUERY rows'''
+        if chunk.empty:
+            return
+        self.add(ce.get_contexts(chunk['hour'].to_numpy()), chunk['arm_code'].to_numpy(),
+                 chunk['reward'].to_numpy())
+        self.last_rec_id = max(self.last_rec_id, int(chunk['rec_id'].max()))
+
+    def to_model(self) -> dict:
+        '''Model in the format MABRecommender imports'''
+        qvalues, counts = {}, {}
+        for ctx in range(self.num_contexts):
+            arms = np.flatnonzero(self.counts[ctx])
+            ctx_counts = self.counts[ctx, arms]
+            qvalues[ctx] = dict(zip(arms.tolist(), (self.sums[ctx, arms] / ctx_counts).tolist()))
+            counts[ctx] = dict(zip(arms.tolist(), ctx_counts.tolist()))
+        return {'qvalues': qvalues, 'counts': counts, 'arm_code_version': ARM_CODE_VERSION,
+                'last_rec_id': self.last_rec_id, 'pending_rec_ids': self.pending_rec_ids}
+
+
+def read_history(conn: Connection, chunk_size: int = 100_000, after_id: int = 0,
+                 pending_ids: Optional[List[int]] = None) -> Iterator[pd.DataFrame]:
+    '''Stream rewarded recommendations with ids above after_id or in pending_ids in chunks'''
+    params = {'after_id': after_id, 'pending': json.dumps(pending_ids or [])}
+    yield from pd.read_sql(text(HISTORY_QUERY), conn, params=params,
+                           chunksize=chunk_size, dtype=HISTORY_DTYPES)
+
+
+def _missing_ids(prev_id: int, rec_ids: np.ndarray) -> List[int]:
+    '''Ids between prev_id and the ascending rec_ids that are not among them'''
+    ids = np.concatenate(([prev_id], rec_ids))
+    return [missing for start, end in zip(ids[:-1].tolist(), ids[1:].tolist())
+            for missing in range(start + 1, end)]
+
+
+def _fold(conn: Connection, totals: RewardTotals, chunk_size: int, ce: ContextEncoder) -> int:
+    '''Add recommendations after the watermark of totals and its pending ones
+
+    Returns how many were added. Ids skipped over by the new watermark become
+    pending, pending ids that are still missing lose one of their trainings.
+    '''
+    watermark = totals.last_rec_id
+    prev_id, new_pending, found = watermark, [], set()
+    num_events = 0
+    for chunk in read_history(conn, chunk_size, watermark, list(totals.pending_rec_ids)):
+        totals.add_chunk(chunk, ce)
+        num_events += len(chunk)
+        rec_ids = chunk['rec_id'].to_numpy()
+        found.update(rec_ids[rec_ids <= watermark].tolist())
+        rec_ids = rec_ids[rec_ids > watermark] # chunks come in id order
+        if len(rec_ids):
+            new_pending.extend(_missing_ids(prev_id, rec_ids))
+            prev_id = int(rec_ids[-1])
+    if num_events:
+        pending = {rec_id: left - 1 for rec_id, left in totals.pending_rec_ids.items()
+                   if rec_id not in found and left > 1}
+        pending.update(dict.fromkeys(new_pending, PENDING_TRAININGS))
+        totals.pending_rec_ids = pending
+    return num_events
+
+
+def train(engine: Engine, chunk_size: int = 100_000, ce: ContextEncoder = None) -> RewardTotals:
+    '''Compute reward totals over the whole recommendation history'''
+    if ce is None:
+        ce = ContextEncoder(6, 22, 4)
+    totals = RewardTotals(ce.get_num_intervals())
+    with engine.connect() as conn:
+        _fold(conn, totals, chunk_size, ce)
+    logger.info(f'Trained on {int(totals.counts.sum())} recommendations up to id '
+                f'{totals.last_rec_id}')
+    return totals
+
+
+def update_model(conn: Connection, path: str, chunk_size: int = 100_000,
+                 ce: ContextEncoder = None) -> bool:
+    '''Fold recommendations newer than the model's watermark into the model file
+
+    Cost is proportional to the new recommendations. A missing model, or one
+    without a watermark (e.g. from an older notebook), is trained from scratch.
+    Returns True if the model file was rewritten.
+    '''
+    if ce is None:
+        ce = ContextEncoder(6, 22, 4)
+    totals = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            totals = RewardTotals.from_model(pickle.load(f), ce.get_num_intervals())
+    if totals is None:
+        logger.info(f'Model {path} has no usable watermark, training on the full history')
+        totals = RewardTotals(ce.get_num_intervals())
+
+    num_events = _fold(conn, totals, chunk_size, ce)
+    if not num_events:
+        logger.info(f'No recommendations after id {totals.last_rec_id}, model is up to date')
+        return False
+    save_model(totals.to_model(), path)
+    logger.info(f'Folded {num_events} recommendations into {path}, up to id '
+                f'{totals.last_rec_id}')
+    return True
+
+
+def save_model(model: dict, path: str) -> None:
+    '''Atomically write a model pickle, MABRecommender imports it once its mtime changes'''
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(model, f)
+    os.replace(tmp_path, path)
+    logger.info(f'Saved model file {path}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--db', required=True, help='sqlite task db')
+    parser.add_argument('--out', default=f'{MODEL_DIR}/eps-cmab.pkl')
+    parser.add_argument('--chunk-size', type=int, default=100_000)
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fold recommendations newer than the model into it')
+    args = parser.parse_args()
+    db_engine = create_engine(f'sqlite:///{args.db}')
+    if args.incremental:
+        with db_engine.connect() as db_conn:
+            update_model(db_conn, args.out, args.chunk_size)
+    else:
+        save_model(train(db_engine, args.chunk_size).to_model(), args.out)
+    db_engine.dispose()
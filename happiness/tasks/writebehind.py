@@ -0,0 +1,140 @@
+'''Bounded background writer that applies bookkeeping writes in batches'''
+from collections import defaultdict
+from typing import Any, Callable, Dict, List, Optional
+import queue
+import sqlite3
+import threading
+import time
+
+from loguru import logger
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.exc import OperationalError
+
+# A handler gets a connection in the batch transaction and the queued items of
+# its kind, in submission order. Handlers registered with after_commit write
+# elsewhere, they run once the transaction committed and get None.
+Handler = Callable[[Optional[Connection], List[Any]], None]
+
+# Errors of a busy, locked or temporarily unavailable db, worth retrying
+TRANSIENT_ERRORS = (OperationalError, sqlite3.OperationalError)
+
+_STOP = object()
+
+
+class WriteBehindQueue:
+    '''Queues writes and applies them on a background thread
+
+    Items queued within a short window are grouped by kind and handed to the
+    registered handlers in one db transaction. The queue is bounded, so a slow
+    disk applies backpressure on put() instead of growing memory.
+
+    Items were already acknowledged to the caller, so transient db errors are
+    retried with exponential backoff until the write succeeds, meanwhile the
+    queue fills up and put() blocks. Only items that fail otherwise (e.g. an
+    integrity error), which no retry can write, are logged and dropped.
+    '''
+    def __init__(self, engine: Engine, maxsize: int = 10000, batch_size: int = 500,
+                 retry_delay: float = 0.1, max_retry_delay: float = 30.0):
+        '''Initialize the queue and start the writer thread'''
+        self._engine = engine
+        self._batch_size = batch_size
+        self._retry_delay = retry_delay
+        self._max_retry_delay = max_retry_delay
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._handlers: Dict[str, Handler] = {}
+        self._after_commit: Dict[str, bool] = {}
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def register(self, kind: str, handler: Handler, after_commit: bool = False) -> None:
+        '''Register the handler applying items of the given kind
+
+        Handlers writing to another store are registered with after_commit,
+        so they only run once the rows of the batch are committed and a retry
+        of the transaction does not apply their items twice.
+        '''
+        if kind in self._handlers:
+            raise ValueError(f'A write-behind handler for {kind} is already registered')
+        self._handlers[kind] = handler
+        self._after_commit[kind] = after_commit
+
+    def put(self, kind: str, item: Any) -> None:
+        '''Queue an item, blocks while the queue is full'''
+        if self._closed:
+            raise RuntimeError('Write-behind queue is closed')
+        if kind not in self._handlers:
+            raise ValueError(f'No write-behind handler registered for {kind}')
+        self._queue.put((kind, item))
+
+    def flush(self) -> None:
+        '''Block until every queued item has been applied'''
+        self._queue.join()
+
+    def close(self) -> None:
+        '''Apply the queued items and stop the writer thread'''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        logger.info('Write-behind queue closed')
+
+    def _next_batch(self) -> list:
+        '''Block for one item, then take what else is queued up to the batch size'''
+        batch = [self._queue.get()]
+        while len(batch) < self._batch_size and batch[-1] is not _STOP:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _retry(self, write: Callable[[], None], description: str) -> None:
+        '''Run write until it succeeds, backing off on transient db errors'''
+        delay = self._retry_delay
+        while True:
+            try:
+                write()
+                return
+            except TRANSIENT_ERRORS as err:
+                logger.warning(f'Failed to apply {description}, retrying in {delay:.1f} s: {err}')
+                time.sleep(delay)
+                delay = min(delay * 2, self._max_retry_delay)
+            except Exception as err: # keep the writer alive, no retry can apply these
+                logger.exception(f'Dropping {description}, they cannot be applied: {err}')
+                return
+
+    def _apply(self, entries: list) -> None:
+        '''Apply a batch of (kind, item) entries in one transaction, then the after commit ones'''
+        items_by_kind = defaultdict(list)
+        for kind, item in entries:
+            items_by_kind[kind].append(item)
+        in_transaction = {kind: items for kind, items in items_by_kind.items()
+                          if not self._after_commit[kind]}
+
+        def write_transaction():
+            with self._engine.begin() as conn:
+                for kind, items in in_transaction.items():
+                    self._handlers[kind](conn, items)
+        if in_transaction:
+            self._retry(write_transaction, f'write-behind items {list(in_transaction)}: '
+                        f'{in_transaction}')
+        for kind, items in items_by_kind.items():
+            if self._after_commit[kind]:
+                self._retry(lambda kind=kind, items=items: self._handlers[kind](None, items),
+                            f'write-behind items {kind}: {items}')
+        logger.debug(f'Applied {len(entries)} write-behind items')
+
+    def _run(self) -> None:
+        '''Writer thread loop'''
+        while True:
+            batch = self._next_batch()
+            stop = batch[-1] is _STOP
+            entries = batch[:-1] if stop else batch
+            if entries:
+                self._apply(entries)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
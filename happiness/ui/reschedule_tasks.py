@@ -1,6 +1,6 @@
 '''Reschedule tasks tab layout'''
 import dash_bootstrap_components as dbc
-from dash import dash_table, html
+from dash import dash_table, dcc, html
 
 reschedule_tasks_layout = dbc.Container([
     dbc.Row([
@@ -17,13 +17,20 @@ reschedule_tasks_layout = dbc.Container([
                 {'name': 'Priority', 'id': 'priority', 'type': 'text'}
             ],
             data=[],
+            page_current=0,
+            page_size=10,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='single',
+            filter_action='custom',
             row_selectable='multi',
             hidden_columns=['task_id'],
             style_table={'overflowX': 'auto'},
             style_header={'backgroundColor': 'rgb(30, 30, 30)', 'color': 'white'},
             style_cell={'backgroundColor': 'rgb(50, 50, 50)', 'color': 'white'},
             css=[{"selector": ".show-hide", "rule": "display: none"}],
-        ), width=12)
+        ), width=12),
+        dcc.Store(id='reschedule-tasks-table-cursors')
     ]),
     dbc.Row([
         dbc.Col(dbc.Button(
@@ -1,6 +1,6 @@
 '''View tasks tab layout'''
 import dash_bootstrap_components as dbc
-from dash import dash_table, html
+from dash import dash_table, dcc, html
 
 view_tasks_layout = dbc.Container([
     dbc.Row([
@@ -20,15 +20,17 @@ view_tasks_layout = dbc.Container([
             ],
             page_current=0,
             page_size=10,
-            page_action='native',
-            sort_action='native',
-            filter_action='native',
+            page_action='custom', # pages are sorted, filtered and cut by the server
+            sort_action='custom',
+            sort_mode='single',
+            filter_action='custom',
             row_selectable='single',
             hidden_columns=['task_id'],
             style_table={'overflowX': 'auto'},
             style_cell={'backgroundColor': 'rgb(50, 50, 50)', 'color': 'white'},
             css=[{"selector": ".show-hide", "rule": "display: none"}]
-        ), width='auto', className='dbc')
+        ), width='auto', className='dbc'),
+        dcc.Store(id='tasks-table-cursors')
     ]),
     dbc.Row([
         dbc.Col(dbc.Button(